@@ -17,10 +17,31 @@ MAPILLARY_GRAPH_API_ENDPOINT = os.getenv(
     "MAPILLARY_GRAPH_API_ENDPOINT", "https://graph.mapillary.com"
 )
 REQUESTS_TIMEOUT = 60  # 1 minutes
+# Max number of idle connections kept alive per host. It should be no less than
+# the number of concurrent upload sessions, otherwise connections are discarded after use
+REQUESTS_POOL_MAXSIZE = 32
+
+
+def create_session(pool_maxsize: int = REQUESTS_POOL_MAXSIZE) -> requests.Session:
+    """
+    Create a session that keeps connections alive, so that the TCP and TLS handshakes
+    are paid once per connection instead of once per request (e.g. per upload chunk)
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=4, pool_maxsize=pool_maxsize
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# Shared by all API calls and upload sessions in the process
+SESSION = create_session()
 
 
 def get_upload_token(email: str, password: str) -> requests.Response:
-    resp = requests.post(
+    resp = SESSION.post(
         f"{MAPILLARY_GRAPH_API_ENDPOINT}/login",
         params={"access_token": MAPILLARY_CLIENT_TOKEN},
         json={"email": email, "password": password, "locale": "en_US"},
@@ -33,7 +54,7 @@ def get_upload_token(email: str, password: str) -> requests.Response:
 def fetch_organization(
     user_access_token: str, organization_id: Union[int, str]
 ) -> requests.Response:
-    resp = requests.get(
+    resp = SESSION.get(
         f"{MAPILLARY_GRAPH_API_ENDPOINT}/{organization_id}",
         params={
             "fields": ",".join(["slug", "description", "name"]),
@@ -55,7 +76,7 @@ ActionType = Literal[
 def logging(
     access_token: str, action_type: ActionType, properties: T.Dict
 ) -> requests.Response:
-    resp = requests.post(
+    resp = SESSION.post(
         f"{MAPILLARY_GRAPH_API_ENDPOINT}/logging",
         json={
             "action_type": action_type,
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import logging
+import ssl
+import typing as T
+import urllib.parse
+import urllib.request
+
+import requests
+import requests.structures
+import requests.utils
+
+LOG = logging.getLogger(__name__)
+# Size of the blocks that the request bodies are written in
+WRITE_BLOCK_SIZE = 64 * 1024
+
+_ConnectionKey = T.Tuple[str, str, int]
+_Connection = T.Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+def environment_proxy(url: str) -> T.Optional[str]:
+    """
+    Return the proxy that the environment (e.g. HTTPS_PROXY) configures for the URL if any.
+    AsyncHTTPClient does not support proxies since it connects to the hosts directly.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    proxies = urllib.request.getproxies()
+    if parsed.scheme not in proxies:
+        return None
+    if urllib.request.proxy_bypass(parsed.hostname or ""):
+        return None
+    return proxies[parsed.scheme]
+
+
+class AsyncHTTPClient:
+    """
+    A minimal HTTP/1.1 client on asyncio streams, so that the requests wait for the network
+    on the event loop instead of holding a thread each. The connections are kept alive
+    and reused across requests like requests.Session does.
+
+    The responses are returned as requests.Response, and the errors are raised as the
+    requests exceptions, so that they are handled the same way as the requests ones.
+    """
+
+    def __init__(self, ssl_context: T.Optional[ssl.SSLContext] = None):
+        self._ssl_context = ssl_context
+        self._idle: T.Dict[_ConnectionKey, T.List[_Connection]] = {}
+
+    def _get_ssl_context(self) -> ssl.SSLContext:
+        if self._ssl_context is None:
+            # Verify with the same CA bundle as requests
+            self._ssl_context = ssl.create_default_context(
+                cafile=requests.utils.DEFAULT_CA_BUNDLE_PATH
+            )
+        return self._ssl_context
+
+    async def _connect(self, key: _ConnectionKey) -> T.Tuple[_Connection, bool]:
+        """
+        Return an idle connection to the host, or a new one. The flag tells if it is reused.
+        """
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if reader.at_eof() or writer.transport.is_closing():
+                writer.close()
+                continue
+            return (reader, writer), True
+
+        scheme, host, port = key
+        reader, writer = await asyncio.open_connection(
+            host,
+            port,
+            ssl=self._get_ssl_context() if scheme == "https" else None,
+        )
+        return (reader, writer), False
+
+    def _release(self, key: _ConnectionKey, conn: _Connection) -> None:
+        self._idle.setdefault(key, []).append(conn)
+
+    def close(self) -> None:
+        for conns in self._idle.values():
+            for _, writer in conns:
+                writer.close()
+        self._idle.clear()
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        headers: T.Optional[T.Dict[str, str]] = None,
+        data: T.Union[bytes, memoryview, None] = None,
+        json_data: T.Any = None,
+        timeout: T.Optional[float] = None,
+        throttle: T.Optional[T.Callable[[int], T.Awaitable[None]]] = None,
+    ) -> requests.Response:
+        """
+        Send the request and return the response. The body is written block by block,
+        and each block awaits throttle(size) first if it is specified.
+        """
+        if json_data is not None:
+            data = json.dumps(json_data).encode("utf-8")
+            headers = {**(headers or {}), "Content-Type": "application/json"}
+        try:
+            return await asyncio.wait_for(
+                self._request(method, url, headers or {}, data or b"", throttle),
+                timeout,
+            )
+        except asyncio.TimeoutError as ex:
+            raise requests.Timeout(
+                f"{method} {url} timed out after {timeout} seconds"
+            ) from ex
+
+    async def _request(
+        self,
+        method: str,
+        url: str,
+        headers: T.Dict[str, str],
+        data: T.Union[bytes, memoryview],
+        throttle: T.Optional[T.Callable[[int], T.Awaitable[None]]],
+    ) -> requests.Response:
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ["http", "https"] or not parsed.hostname:
+            raise requests.exceptions.InvalidURL(f"Invalid URL {url}")
+        default_port = 443 if parsed.scheme == "https" else 80
+        port = parsed.port or default_port
+        key = (parsed.scheme, parsed.hostname, port)
+        target = urllib.parse.urlunsplit(("", "", parsed.path or "/", parsed.query, ""))
+        host = parsed.hostname if port == default_port else f"{parsed.hostname}:{port}"
+        head = "".join(
+            f"{name}: {value}\r\n"
+            for name, value in {
+                "Host": host,
+                "User-Agent": requests.utils.default_user_agent(),
+                "Accept": "*/*",
+                "Connection": "keep-alive",
+                **headers,
+                "Content-Length": str(len(data)),
+            }.items()
+        )
+        request_head = f"{method} {target} HTTP/1.1\r\n{head}\r\n".encode("latin-1")
+
+        while True:
+            try:
+                conn, reused = await self._connect(key)
+            except (OSError, asyncio.IncompleteReadError) as ex:
+                raise requests.ConnectionError(ex) from ex
+            try:
+                resp, keep_alive = await self._send(conn, request_head, data, throttle)
+            except (OSError, asyncio.IncompleteReadError) as ex:
+                conn[1].close()
+                # The server might have closed the idle connection, so retry on another one
+                if reused:
+                    LOG.debug("Retrying on a new connection: %s", ex)
+                    continue
+                raise requests.ConnectionError(ex) from ex
+            except BaseException:
+                conn[1].close()
+                raise
+            if keep_alive:
+                self._release(key, conn)
+            else:
+                conn[1].close()
+            break
+
+        resp.url = url
+        resp.request = requests.Request(method, url).prepare()
+        return resp
+
+    async def _send(
+        self,
+        conn: _Connection,
+        request_head: bytes,
+        data: T.Union[bytes, memoryview],
+        throttle: T.Optional[T.Callable[[int], T.Awaitable[None]]],
+    ) -> T.Tuple[requests.Response, bool]:
+        reader, writer = conn
+        writer.write(request_head)
+        view = memoryview(data)
+        for start in range(0, len(view), WRITE_BLOCK_SIZE):
+            block = view[start : start + WRITE_BLOCK_SIZE]
+            if throttle is not None:
+                await throttle(len(block))
+            # The transport might keep the block (a view of the caller's buffer) until it is sent,
+            # which is no later than the response
+            writer.write(block)
+            await writer.drain()
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed without response")
+        version, status, *reason = status_line.decode("latin-1").split(None, 2)
+
+        headers = requests.structures.CaseInsensitiveDict()
+        while True:
+            line = await reader.readline()
+            if line in [b"\r\n", b"\n"]:
+                break
+            if not line:
+                raise asyncio.IncompleteReadError(b"", None)
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip()] = value.strip()
+
+        keep_alive = (
+            version == "HTTP/1.1" and headers.get("Connection", "").lower() != "close"
+        )
+        if "chunked" in headers.get("Transfer-Encoding", "").lower():
+            parts = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # Skip the trailers
+                    while (await reader.readline()) not in [b"\r\n", b"\n", b""]:
+                        pass
+                    break
+                parts.append(await reader.readexactly(size))
+                await reader.readline()
+            content = b"".join(parts)
+        elif "Content-Length" in headers:
+            content = await reader.readexactly(int(headers["Content-Length"]))
+        else:
+            content = await reader.read()
+            keep_alive = False
+
+        resp = requests.Response()
+        resp.status_code = int(status)
+        resp.reason = reason[0].strip() if reason else ""
+        resp.headers = headers
+        resp.encoding = requests.utils.get_encoding_from_headers(headers)
+        resp._content = content
+        return resp, keep_alive
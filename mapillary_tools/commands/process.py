@@ -37,6 +37,20 @@ class Command:
             default=False,
             required=False,
         )
+        parser.add_argument(
+            "--incremental",
+            help=f"Geotag only the images added or modified since the last run, and reuse the geotag results of the others (kept in {{IMPORT_PATH}}/{constants.GEOTAG_STATE_FILENAME}). The sequences are processed over all images. Only works for geotagging from exif, gpx or nmea.",
+            action="store_true",
+            default=False,
+            required=False,
+        )
+        parser.add_argument(
+            "--workers",
+            help="Number of processes extracting the image EXIF (only when geotagging from exif) and testing EXIF writing in parallel. [default: %(default)s]",
+            type=int,
+            default=1,
+            required=False,
+        )
         group = parser.add_argument_group(
             f"{constants.ANSI_BOLD}PROCESS EXIF OPTIONS{constants.ANSI_RESET_ALL}"
         )
@@ -28,6 +28,46 @@ class Command:
             default=False,
             required=False,
         )
+        group.add_argument(
+            "--upload_workers",
+            help="Number of sequences, ZIP files or BlackVue videos to upload concurrently. [default: %(default)s]",
+            type=int,
+            default=1,
+            required=False,
+        )
+        group.add_argument(
+            "--upload_engine",
+            help="How to run the concurrent uploads. threads: each upload runs in a thread; asyncio: all uploads (image sequences, ZIP files or BlackVue videos) are multiplexed on one event loop with non-blocking requests, so that waiting for the network, retries or the rate limit holds no thread. It does not support HTTP(S) proxies. [default: %(default)s]",
+            choices=["threads", "asyncio"],
+            default="threads",
+            required=False,
+        )
+        group.add_argument(
+            "--upload_rate_limit",
+            help="Limit the total upload speed (in MB/s) of all the uploads. [default: no limit]",
+            type=float,
+            default=None,
+            required=False,
+        )
+        group.add_argument(
+            "--share_upload_rate_limit",
+            help=f"Share the upload rate limit with the other mapillary_tools processes on this host that enable this option too, so that their total upload speed is limited. The budget is kept in {constants.UPLOAD_BANDWIDTH_BUDGET_PATH}. [default: %(default)s]",
+            action="store_true",
+            default=False,
+            required=False,
+        )
+        group.add_argument(
+            "--upload_metrics_path",
+            help="Write the upload metrics (histograms of chunk latency and throughput, offset fetching time, retries, etc.) to this file when finished. In the Prometheus text format if it ends with .prom, otherwise JSON.",
+            default=None,
+            required=False,
+        )
+        group.add_argument(
+            "--upload_time_windows",
+            help='Upload only in these windows of the local time, e.g. "22:00-06:00,12:00-13:30". Uploading pauses outside the windows. [default: any time]',
+            default=None,
+            required=False,
+        )
 
     def add_basic_arguments(self, parser):
         group = parser.add_argument_group(
@@ -39,6 +79,62 @@ class Command:
             default=None,
             required=False,
         )
+        group.add_argument(
+            "--zip_prefetch",
+            help="Number of sequence ZIPs to build in the background ahead of uploading. Set 0 to build each ZIP right before it is uploaded. [default: %(default)s]",
+            type=int,
+            default=1,
+            required=False,
+        )
+        group.add_argument(
+            "--zip_prefetch_max_size",
+            help="Limit the total size (in MB) of the sequence ZIPs built in the temporary directory. [default: no limit]",
+            type=float,
+            default=None,
+            required=False,
+        )
+        group.add_argument(
+            "--zip_compression",
+            help="How to compress the images in ZIPs. auto: store images that are compressed already (e.g. JPEG) and deflate the others (e.g. TIFF); stored: store all images; deflated: deflate all images. [default: %(default)s]",
+            choices=["auto", "stored", "deflated"],
+            default="auto",
+            required=False,
+        )
+        group.add_argument(
+            "--zip_workers",
+            help="Number of threads preparing the images (reading, hashing and EXIF writing) for each ZIP, and hashing the images to check the upload history or the BlackVue videos to upload. [default: %(default)s]",
+            type=int,
+            default=1,
+            required=False,
+        )
+        group.add_argument(
+            "--zip_cache_dir",
+            help="Keep the sequence ZIPs in this directory until they are uploaded, so that an interrupted upload resumes without rebuilding them. [default: no cache]",
+            default=None,
+            required=False,
+        )
+        group.add_argument(
+            "--zip_cache_max_size",
+            help="Limit the total size (in MB) of the ZIP cache directory by removing the least recently used ZIPs. [default: no limit]",
+            type=float,
+            default=None,
+            required=False,
+        )
+        group.add_argument(
+            "--zip_cache_max_age",
+            help="Remove the ZIPs not used for this many days from the ZIP cache directory, e.g. the ones of cancelled uploads. [default: %(default)s]",
+            type=float,
+            default=constants.ZIP_CACHE_MAX_AGE_DAYS,
+            required=False,
+        )
+        group.add_argument(
+            "--no_zip_stream",
+            help="Build the sequence ZIPs in temporary files instead of streaming them from the images directly. The ZIPs of JPEG images are streamed by default, and rebuilt in temporary files if the images change while uploading.",
+            dest="zip_stream",
+            action="store_false",
+            default=True,
+            required=False,
+        )
         Command.add_common_upload_options(group)
 
     def run(self, vars_args: dict):
@@ -23,6 +23,20 @@ class Command:
             default=None,
             required=False,
         )
+        parser.add_argument(
+            "--zip_compression",
+            help="How to compress the images in ZIPs. auto: store images that are compressed already (e.g. JPEG) and deflate the others (e.g. TIFF); stored: store all images; deflated: deflate all images. [default: %(default)s]",
+            choices=["auto", "stored", "deflated"],
+            default="auto",
+            required=False,
+        )
+        parser.add_argument(
+            "--zip_workers",
+            help="Number of threads preparing the images (reading, hashing and EXIF writing) for each ZIP. [default: %(default)s]",
+            type=int,
+            default=1,
+            required=False,
+        )
 
     def run(self, vars_args: dict):
         zip_images(
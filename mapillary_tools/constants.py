@@ -18,11 +18,41 @@ FFMPEG_PATH: str = os.getenv(_ENV_PREFIX + "FFMPEG_PATH", "ffmpeg")
 IMAGE_DESCRIPTION_FILENAME = os.getenv(
     _ENV_PREFIX + "IMAGE_DESCRIPTION_FILENAME", "mapillary_image_description.json"
 )
+# The geotag results kept in the import directory for the incremental processing
+GEOTAG_STATE_FILENAME = os.getenv(
+    _ENV_PREFIX + "GEOTAG_STATE_FILENAME", "mapillary_geotag_state.json"
+)
 SAMPLED_VIDEO_FRAMES_FILENAME = os.getenv(
     _ENV_PREFIX + "SAMPLED_VIDEO_FRAMES_FILENAME", "mapillary_sampled_video_frames"
 )
 MAX_SEQUENCE_LENGTH = int(os.getenv(_ENV_PREFIX + "MAX_SEQUENCE_LENGTH", 500))
+# The maximum number of images sent to a worker process at a time
+# when processing (e.g. reading or verifying EXIF) with multiple workers
+PROCESS_MAX_CHUNK_SIZE = int(os.getenv(_ENV_PREFIX + "PROCESS_MAX_CHUNK_SIZE", 64))
 USER_DATA_DIR = appdirs.user_data_dir(appname="mapillary_tools", appauthor="Mapillary")
+# Disable if it's set to empty
+FILE_HASH_CACHE_PATH = os.getenv(
+    _ENV_PREFIX + "FILE_HASH_CACHE_PATH",
+    os.path.join(USER_DATA_DIR, "file_hash_cache.sqlite3"),
+)
+# Disable if it's set to empty
+EXIF_CACHE_PATH = os.getenv(
+    _ENV_PREFIX + "EXIF_CACHE_PATH",
+    os.path.join(USER_DATA_DIR, "exif_cache.sqlite3"),
+)
+# Lock files that keep the processes on the host from uploading the same content at the same time.
+# Disable if it's set to empty
+UPLOAD_LOCK_DIR = os.getenv(
+    _ENV_PREFIX + "UPLOAD_LOCK_DIR", os.path.join(USER_DATA_DIR, "upload_locks")
+)
+# The bandwidth budget shared by the upload processes on the host
+UPLOAD_BANDWIDTH_BUDGET_PATH = os.getenv(
+    _ENV_PREFIX + "UPLOAD_BANDWIDTH_BUDGET_PATH",
+    os.path.join(USER_DATA_DIR, "upload_bandwidth_budget.json"),
+)
+# The cached sequence zips (see --zip_cache_dir) not used for this many days are removed,
+# e.g. the ones of the cancelled or abandoned uploads
+ZIP_CACHE_MAX_AGE_DAYS = float(os.getenv(_ENV_PREFIX + "ZIP_CACHE_MAX_AGE_DAYS", 7))
 # This is DoP value, the lower the better
 # See https://github.com/gopro/gpmf-parser#hero5-black-with-gps-enabled-adds
 GOPRO_MAX_GPS_PRECISION = int(os.getenv(_ENV_PREFIX + "GOPRO_MAX_GPS_PRECISION", 1000))
@@ -0,0 +1,207 @@
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import typing as T
+
+from . import constants, file_hash_cache, VERSION
+from .exif_read import ExifRead
+
+
+LOG = logging.getLogger(__name__)
+
+_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+class CachedExif:
+    """
+    The fields extracted from the image EXIF, with the same extract_* methods as ExifRead.
+    """
+
+    def __init__(self, fields: T.Dict[str, T.Any]):
+        self.fields = fields
+
+    @classmethod
+    def from_exif(cls, exif: ExifRead) -> "CachedExif":
+        capture_time = exif.extract_capture_time()
+        return cls(
+            {
+                "lon_lat": list(exif.extract_lon_lat()),
+                "capture_time": None
+                if capture_time is None
+                else capture_time.strftime(_DATETIME_FORMAT),
+                "direction": exif.extract_direction(),
+                "altitude": exif.extract_altitude(),
+                "orientation": exif.extract_orientation(),
+                "make": exif.extract_make(),
+                "model": exif.extract_model(),
+            }
+        )
+
+    def extract_lon_lat(self) -> T.Tuple[T.Optional[float], T.Optional[float]]:
+        lon, lat = self.fields["lon_lat"]
+        return lon, lat
+
+    def extract_capture_time(self) -> T.Optional[datetime.datetime]:
+        capture_time = self.fields["capture_time"]
+        if capture_time is None:
+            return None
+        return datetime.datetime.strptime(capture_time, _DATETIME_FORMAT)
+
+    def extract_direction(self) -> T.Optional[float]:
+        return self.fields["direction"]
+
+    def extract_altitude(self) -> T.Optional[float]:
+        return self.fields["altitude"]
+
+    def extract_orientation(self) -> int:
+        return self.fields["orientation"]
+
+    def extract_make(self) -> T.Optional[str]:
+        return self.fields["make"]
+
+    def extract_model(self) -> T.Optional[str]:
+        return self.fields["model"]
+
+
+class ExifCache:
+    """
+    Persist the fields extracted from the image EXIF in a SQLite database, so that re-processing
+    the same images only stats them.
+
+    The cached fields are returned only if the file signature (size, mtime, inode and device) is unchanged,
+    and they were extracted by the same version of mapillary_tools.
+    The cache is best effort: if the database can not be opened or written, EXIF is read as usual.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn: T.Optional[sqlite3.Connection] = None
+        self._disabled = False
+
+    def _connect(self) -> T.Optional[sqlite3.Connection]:
+        if self._conn is None and not self._disabled:
+            try:
+                conn = file_hash_cache.connect_cache_db(
+                    self.db_path,
+                    """
+                    CREATE TABLE IF NOT EXISTS image_exif (
+                        path TEXT PRIMARY KEY,
+                        size INTEGER NOT NULL,
+                        mtime_ns INTEGER NOT NULL,
+                        inode INTEGER NOT NULL,
+                        device INTEGER NOT NULL,
+                        version TEXT NOT NULL,
+                        fields TEXT NOT NULL
+                    )
+                    """,
+                )
+            except (OSError, sqlite3.Error):
+                LOG.warning("Disabled the EXIF cache %s", self.db_path, exc_info=True)
+                self._disabled = True
+                return None
+            self._conn = conn
+        return self._conn
+
+    def get(
+        self, path: str, signature: file_hash_cache.FileSignature
+    ) -> T.Optional[CachedExif]:
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return None
+            try:
+                row = conn.execute(
+                    "SELECT size, mtime_ns, inode, device, version, fields FROM image_exif WHERE path = ?",
+                    (os.path.realpath(path),),
+                ).fetchone()
+            except sqlite3.Error:
+                LOG.warning("Error reading the EXIF cache", exc_info=True)
+                return None
+        if row is None or tuple(row[:4]) != signature or row[4] != VERSION:
+            return None
+        return CachedExif(json.loads(row[5]))
+
+    def put(
+        self, path: str, signature: file_hash_cache.FileSignature, exif: CachedExif
+    ) -> None:
+        """
+        Cache the fields extracted after the file signature was taken.
+        """
+        try:
+            current_signature = file_hash_cache.file_signature(path)
+        except OSError:
+            return
+        # Modified while reading
+        if current_signature != signature:
+            return
+        _size, mtime_ns, _inode, _device = signature
+        if time.time() - mtime_ns / 1e9 < file_hash_cache.RACY_INTERVAL:
+            return
+
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO image_exif (path, size, mtime_ns, inode, device, version, fields) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        os.path.realpath(path),
+                        *signature,
+                        VERSION,
+                        json.dumps(exif.fields),
+                    ),
+                )
+                conn.commit()
+            except sqlite3.Error:
+                LOG.warning("Error writing the EXIF cache", exc_info=True)
+
+    def read_exif(self, path: str) -> T.Union[ExifRead, CachedExif]:
+        signature = file_hash_cache.file_signature(path)
+        cached = self.get(path, signature)
+        if cached is not None:
+            return cached
+
+        exif = ExifRead(path)
+        try:
+            cached = CachedExif.from_exif(exif)
+        except Exception:
+            # Leave the errors to the callers as if it is not cached
+            return exif
+        self.put(path, signature, cached)
+        return cached
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_DEFAULT_CACHE: T.Optional[ExifCache] = None
+# SQLite connections must not be used across fork, so the worker processes open their own
+_DEFAULT_CACHE_PID: T.Optional[int] = None
+_DEFAULT_CACHE_LOCK = threading.Lock()
+
+
+def default_cache() -> T.Optional[ExifCache]:
+    global _DEFAULT_CACHE, _DEFAULT_CACHE_PID
+    if not constants.EXIF_CACHE_PATH:
+        return None
+    with _DEFAULT_CACHE_LOCK:
+        if _DEFAULT_CACHE is None or _DEFAULT_CACHE_PID != os.getpid():
+            _DEFAULT_CACHE = ExifCache(constants.EXIF_CACHE_PATH)
+            _DEFAULT_CACHE_PID = os.getpid()
+        return _DEFAULT_CACHE
+
+
+def read_exif(path: str) -> T.Union[ExifRead, CachedExif]:
+    cache = default_cache()
+    if cache is None:
+        return ExifRead(path)
+    return cache.read_exif(path)
@@ -1,9 +1,10 @@
 import datetime
 import os
-from typing import Any, List, Optional, Tuple, Type, Union
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple, Type, Union
 
 import exifread
 
+from . import simple_exif_parser
 from .geo import normalize_bearing
 
 
@@ -73,6 +74,16 @@ def exif_gps_date_fields() -> List[List[str]]:
     return [["GPS GPSDate", "EXIF GPS GPSDate"]]
 
 
+def _process_file(fp: BinaryIO, details: bool) -> Dict[str, Any]:
+    if not details:
+        # Decode only the tags used here, which is much faster than exifread
+        try:
+            return simple_exif_parser.parse_jpeg_exif(fp)
+        except simple_exif_parser.UnsupportedExifError:
+            pass
+    return exifread.process_file(fp, details=details, debug=True)
+
+
 class ExifRead:
     """
     EXIF class for reading exif from an image
@@ -85,9 +96,9 @@ class ExifRead:
         self.filename = filename
         if isinstance(filename, str):
             with open(filename, "rb") as fp:
-                self.tags = exifread.process_file(fp, details=details, debug=True)
+                self.tags = _process_file(fp, details)
         else:
-            self.tags = exifread.process_file(filename, details=details, debug=True)
+            self.tags = _process_file(filename, details)
 
     def _extract_alternative_fields(
         self,
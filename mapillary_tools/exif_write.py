@@ -2,6 +2,8 @@ import datetime
 import io
 import json
 import logging
+import os
+import struct
 import typing as T
 
 import piexif
@@ -12,13 +14,87 @@ from .geo import decimal_to_dms
 LOG = logging.getLogger(__name__)
 
 
+def _jpeg_segment_offsets(data: bytes) -> T.List[int]:
+    """
+    Return the offsets of the JPEG segments after SOI, where the last one is the offset of SOS.
+    It splits segments in the same way as piexif but without copying the image data
+    """
+    if data[0:2] != b"\xff\xd8":
+        raise piexif.InvalidImageDataError("Given data isn't JPEG.")
+
+    offsets = []
+    head = 2
+    while True:
+        offsets.append(head)
+        if data[head : head + 2] == b"\xff\xda":
+            break
+        if len(data) < head + 4:
+            raise piexif.InvalidImageDataError("Wrong JPEG data.")
+        length = struct.unpack(">H", data[head + 2 : head + 4])[0]
+        head = head + length + 2
+        if len(data) <= head:
+            raise piexif.InvalidImageDataError("Wrong JPEG data.")
+    return offsets
+
+
+def jpeg_header_size(fp: T.BinaryIO) -> T.Optional[int]:
+    """
+    Return the size of the JPEG segments up to and including the SOS marker, seeking over them
+    in the same way as _jpeg_segment_offsets. Return None if it is not a valid JPEG
+    """
+    fp.seek(0, io.SEEK_END)
+    size = fp.tell()
+    fp.seek(0)
+    if fp.read(2) != b"\xff\xd8":
+        return None
+
+    head = 2
+    while True:
+        fp.seek(head)
+        header = fp.read(4)
+        if header[0:2] == b"\xff\xda":
+            return head + 2
+        if len(header) < 4:
+            return None
+        length = struct.unpack(">H", header[2:4])[0]
+        head = head + length + 2
+        if size <= head:
+            return None
+
+
+def read_image_header(path: str) -> bytes:
+    """
+    Read the JPEG segments up to the SOS marker, i.e. the metadata without the image data,
+    which is all ExifEdit needs to load and dump EXIF.
+    The whole file is read if it is not a valid JPEG, so that piexif handles (or rejects) it as usual
+    """
+    with open(path, "rb") as fp:
+        header_size = jpeg_header_size(fp)
+        fp.seek(0)
+        if header_size is None:
+            return fp.read()
+        return fp.read(header_size)
+
+
+def _load_exif(filename_or_bytes: T.Union[str, bytes]) -> T.Dict:
+    if isinstance(filename_or_bytes, bytes):
+        try:
+            offsets = _jpeg_segment_offsets(filename_or_bytes)
+        except piexif.InvalidImageDataError:
+            pass
+        else:
+            # Parse the header (up to the SOS marker) only to avoid copying the image data
+            return piexif.load(filename_or_bytes[: offsets[-1] + 2])
+    return piexif.load(filename_or_bytes)
+
+
 class ExifEdit:
     _filename_or_bytes: T.Union[str, bytes]
 
     def __init__(self, filename_or_bytes: T.Union[str, bytes]):
         """Initialize the object"""
         self._filename_or_bytes = filename_or_bytes
-        self._ef = piexif.load(filename_or_bytes)
+        self._ef = _load_exif(filename_or_bytes)
 
     def add_image_description(self, data: T.Dict) -> None:
         """Add a dict to image description."""
@@ -127,12 +203,73 @@ class ExifEdit:
 
         return exif_bytes
 
+    def _dump_app1(self) -> bytes:
+        exif_bytes = self._safe_dump()
+        return b"\xff\xe1" + struct.pack(">H", len(exif_bytes) + 2) + exif_bytes
+
+    def verify_dump(self) -> None:
+        """
+        Raise the errors that dump_image_bytes() would raise, but only dump the EXIF segment
+        instead of inserting it into a copy of the image
+        """
+        if isinstance(self._filename_or_bytes, bytes):
+            try:
+                _jpeg_segment_offsets(self._filename_or_bytes)
+            except piexif.InvalidImageDataError:
+                pass
+            else:
+                self._dump_app1()
+                return
+        self.dump_image_bytes()
+
     def dump_image_bytes(self) -> bytes:
         exif_bytes = self._safe_dump()
         output = io.BytesIO()
         piexif.insert(exif_bytes, self._filename_or_bytes, output)
         return output.read()
 
+    def dump_image_chunks(self) -> T.List[T.Union[bytes, memoryview]]:
+        """
+        Same as dump_image_bytes() but return the image in chunks, where
+        the image data after the new EXIF segment refers to the original bytes without copying
+        """
+        if not isinstance(self._filename_or_bytes, bytes):
+            return [self.dump_image_bytes()]
+
+        data = self._filename_or_bytes
+        try:
+            offsets = _jpeg_segment_offsets(data)
+        except piexif.InvalidImageDataError:
+            # Let piexif handle (or reject) the other formats
+            return [self.dump_image_bytes()]
+
+        app1 = self._dump_app1()
+
+        def _is_app0(idx: int) -> bool:
+            return idx < len(offsets) and data[offsets[idx] : offsets[idx] + 2] == (
+                b"\xff\xe0"
+            )
+
+        def _is_exif(idx: int) -> bool:
+            return (
+                idx < len(offsets)
+                and data[offsets[idx] : offsets[idx] + 2] == b"\xff\xe1"
+                and data[offsets[idx] + 4 : offsets[idx] + 10] == b"Exif\x00\x00"
+            )
+
+        # Replace the segments in the same way as piexif.insert:
+        # APP0 followed by EXIF is replaced by the new EXIF,
+        # otherwise the leading APP0 or EXIF is replaced,
+        # otherwise the new EXIF is inserted after SOI
+        if _is_app0(0) and _is_exif(1):
+            keep_from = offsets[2]
+        elif _is_app0(0) or _is_exif(0):
+            keep_from = offsets[1]
+        else:
+            keep_from = offsets[0]
+
+        return [b"\xff\xd8", app1, memoryview(data)[keep_from:]]
+
     def write(self, filename=None):
         """Save exif data to file."""
         if filename is None:
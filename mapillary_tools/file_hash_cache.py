@@ -0,0 +1,189 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+import typing as T
+
+from . import constants, utils
+
+
+LOG = logging.getLogger(__name__)
+
+# A file modified within this many seconds is not cached, because another modification
+# within the mtime resolution of the filesystem would leave the signature unchanged
+RACY_INTERVAL = 2
+
+# (size, mtime in nanoseconds, inode, device)
+FileSignature = T.Tuple[int, int, int, int]
+
+
+def file_signature(path: str) -> FileSignature:
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+
+def connect_cache_db(db_path: str, create_table: str) -> sqlite3.Connection:
+    """
+    Open the cache database (shared by the threads and processes hashing or reading files) and create its table.
+    """
+    dirname = os.path.dirname(db_path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+    try:
+        # Let the readers run along the writer, and commit without syncing every file.
+        # Losing the last entries on power loss is fine for a cache
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(create_table)
+        conn.commit()
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+
+class FileHashCache:
+    """
+    Persist the md5sums of files in a SQLite database, so that unchanged files are not rehashed across runs.
+
+    A cached md5sum is returned only if the file signature (size, mtime, inode and device) is unchanged.
+    The cache is best effort: if the database can not be opened or written, files are hashed as usual.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn: T.Optional[sqlite3.Connection] = None
+        self._disabled = False
+
+    def _connect(self) -> T.Optional[sqlite3.Connection]:
+        if self._conn is None and not self._disabled:
+            try:
+                conn = connect_cache_db(
+                    self.db_path,
+                    """
+                    CREATE TABLE IF NOT EXISTS file_md5sums (
+                        path TEXT PRIMARY KEY,
+                        size INTEGER NOT NULL,
+                        mtime_ns INTEGER NOT NULL,
+                        inode INTEGER NOT NULL,
+                        device INTEGER NOT NULL,
+                        md5sum TEXT NOT NULL
+                    )
+                    """,
+                )
+            except (OSError, sqlite3.Error):
+                LOG.warning(
+                    "Disabled the file hash cache %s", self.db_path, exc_info=True
+                )
+                self._disabled = True
+                return None
+            self._conn = conn
+        return self._conn
+
+    def get(self, path: str, signature: FileSignature) -> T.Optional[str]:
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return None
+            try:
+                row = conn.execute(
+                    "SELECT size, mtime_ns, inode, device, md5sum FROM file_md5sums WHERE path = ?",
+                    (os.path.realpath(path),),
+                ).fetchone()
+            except sqlite3.Error:
+                LOG.warning("Error reading the file hash cache", exc_info=True)
+                return None
+        if row is None or tuple(row[:4]) != signature:
+            return None
+        return row[4]
+
+    def put(self, path: str, signature: FileSignature, md5sum: str) -> None:
+        """
+        Cache the md5sum of the file content read after its signature was taken.
+        """
+        try:
+            current_signature = file_signature(path)
+        except OSError:
+            return
+        # Modified while hashing
+        if current_signature != signature:
+            return
+        _size, mtime_ns, _inode, _device = signature
+        if time.time() - mtime_ns / 1e9 < RACY_INTERVAL:
+            return
+
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO file_md5sums (path, size, mtime_ns, inode, device, md5sum) VALUES (?, ?, ?, ?, ?, ?)",
+                    (os.path.realpath(path), *signature, md5sum),
+                )
+                conn.commit()
+            except sqlite3.Error:
+                LOG.warning("Error writing the file hash cache", exc_info=True)
+
+    def file_md5sum(self, path: str) -> str:
+        signature = file_signature(path)
+        md5sum = self.get(path, signature)
+        if md5sum is None:
+            md5sum = utils.file_md5sum(path)
+            self.put(path, signature, md5sum)
+        return md5sum
+
+    def read_file(self, path: str) -> T.Tuple[bytes, str]:
+        """
+        Read the file content, and return it with its md5sum.
+        """
+        signature = file_signature(path)
+        md5sum = self.get(path, signature)
+        with open(path, "rb") as fp:
+            content = fp.read()
+        # Modified before reading
+        if md5sum is not None and file_signature(path) != signature:
+            md5sum = None
+        if md5sum is None:
+            md5sum = utils.md5sum_bytes(content)
+            self.put(path, signature, md5sum)
+        return content, md5sum
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_DEFAULT_CACHE: T.Optional[FileHashCache] = None
+_DEFAULT_CACHE_LOCK = threading.Lock()
+
+
+def default_cache() -> T.Optional[FileHashCache]:
+    global _DEFAULT_CACHE
+    if not constants.FILE_HASH_CACHE_PATH:
+        return None
+    with _DEFAULT_CACHE_LOCK:
+        if _DEFAULT_CACHE is None:
+            _DEFAULT_CACHE = FileHashCache(constants.FILE_HASH_CACHE_PATH)
+        return _DEFAULT_CACHE
+
+
+def file_md5sum(path: str) -> str:
+    cache = default_cache()
+    if cache is None:
+        return utils.file_md5sum(path)
+    return cache.file_md5sum(path)
+
+
+def read_file(path: str) -> T.Tuple[bytes, str]:
+    cache = default_cache()
+    if cache is None:
+        with open(path, "rb") as fp:
+            content = fp.read()
+        return content, utils.md5sum_bytes(content)
+    return cache.read_file(path)
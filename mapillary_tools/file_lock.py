@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import typing as T
+
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+
+# Seconds between attempts when waiting for a lock on Windows
+_POLL_INTERVAL = 0.1
+
+
+def _lock(fd: int, blocking: bool) -> bool:
+    if sys.platform == "win32":
+        # msvcrt.locking locks from the current position
+        os.lseek(fd, 0, os.SEEK_SET)
+        while True:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+                return True
+            except OSError:
+                if not blocking:
+                    return False
+            time.sleep(_POLL_INTERVAL)
+    else:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return False
+        return True
+
+
+def _unlock(fd: int) -> None:
+    if sys.platform == "win32":
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class FileLock:
+    """
+    An advisory lock on a file, exclusive across processes (and across the FileLock instances in a process).
+    An instance is not reentrant and must not be shared by threads without synchronization.
+
+    If remove is enabled, the file is removed on release, so that the lock files (e.g. one per key)
+    do not accumulate. The lock taken on a file removed in the meantime is retaken on the new file.
+    """
+
+    def __init__(self, path: str, remove: bool = False):
+        self.path = path
+        self.remove = remove
+        self._fd: T.Optional[int] = None
+
+    @property
+    def fd(self) -> int:
+        assert self._fd is not None, "The lock is not acquired"
+        return self._fd
+
+    @property
+    def locked(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        assert self._fd is None, "The lock is acquired already"
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                locked = _lock(fd, blocking)
+            except BaseException:
+                os.close(fd)
+                raise
+            if not locked:
+                os.close(fd)
+                return False
+
+            try:
+                same_file = os.path.samestat(os.fstat(fd), os.stat(self.path))
+            except FileNotFoundError:
+                same_file = False
+            if same_file:
+                self._fd = fd
+                return True
+
+            # Removed (and possibly recreated) by the previous holder
+            _unlock(fd)
+            os.close(fd)
+
+    def release(self) -> None:
+        fd = self.fd
+        self._fd = None
+        try:
+            # Remove before unlocking so that the waiters find the file gone
+            if self.remove and sys.platform != "win32":
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+            _unlock(fd)
+        finally:
+            os.close(fd)
+        # Windows does not remove files open by others
+        if self.remove and sys.platform == "win32":
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.release()
@@ -1,90 +1,120 @@
+import concurrent.futures
+import functools
 import logging
 import os
 import typing as T
 
 from tqdm import tqdm
 
-from .. import types
+from .. import constants, exif_cache, types
 from ..exceptions import MapillaryGeoTaggingError
-from ..exif_read import ExifRead
-
 from .geotag_from_generic import GeotagFromGeneric
 
 LOG = logging.getLogger(__name__)
 
 
+def _image_to_description(
+    image_dir: str, image: str
+) -> types.ImageDescriptionFileOrError:
+    image_path = os.path.join(image_dir, image)
+
+    try:
+        exif = exif_cache.read_exif(image_path)
+    except Exception as exc0:
+        LOG.warning(
+            "Unknown error reading EXIF from image %s",
+            image_path,
+            exc_info=True,
+        )
+        return {"error": types.describe_error(exc0), "filename": image}
+
+    lon, lat = exif.extract_lon_lat()
+    if lat is None or lon is None:
+        exc = MapillaryGeoTaggingError(
+            "Unable to extract GPS Longitude or GPS Latitude from the image"
+        )
+        return {"error": types.describe_error(exc), "filename": image}
+
+    timestamp = exif.extract_capture_time()
+    if timestamp is None:
+        exc = MapillaryGeoTaggingError("Unable to extract timestamp from the image")
+        return {"error": types.describe_error(exc), "filename": image}
+
+    angle = exif.extract_direction()
+
+    desc: types.ImageDescriptionFile = {
+        "MAPLatitude": lat,
+        "MAPLongitude": lon,
+        "MAPCaptureTime": types.datetime_to_map_capture_time(timestamp),
+        "filename": image,
+    }
+    if angle is not None:
+        desc["MAPCompassHeading"] = {
+            "TrueHeading": angle,
+            "MagneticHeading": angle,
+        }
+
+    altitude = exif.extract_altitude()
+    if altitude is not None:
+        desc["MAPAltitude"] = altitude
+
+    desc["MAPOrientation"] = exif.extract_orientation()
+
+    make = exif.extract_make()
+    if make is not None:
+        desc["MAPDeviceMake"] = make
+
+    model = exif.extract_model()
+    if model is not None:
+        desc["MAPDeviceModel"] = model
+
+    return desc
+
+
 class GeotagFromEXIF(GeotagFromGeneric):
-    def __init__(self, image_dir: str, images: T.Sequence[str]):
+    def __init__(self, image_dir: str, images: T.Sequence[str], workers: int = 1):
         self.image_dir = image_dir
         self.images = images
+        self.workers = workers
         super().__init__()
 
-    def to_description(self) -> T.List[types.ImageDescriptionFileOrError]:
-        descs: T.List[types.ImageDescriptionFileOrError] = []
+    def _chunksize(self) -> int:
+        # Small enough to balance the workers and update the progress bar smoothly,
+        # large enough to amortize the inter-process communication
+        return max(
+            1,
+            min(
+                constants.PROCESS_MAX_CHUNK_SIZE,
+                len(self.images) // (self.workers * 4),
+            ),
+        )
 
-        for image in tqdm(
-            self.images,
+    def to_description(self) -> T.List[types.ImageDescriptionFileOrError]:
+        with tqdm(
+            total=len(self.images),
             desc=f"Processing",
             unit="images",
             disable=LOG.getEffectiveLevel() <= logging.DEBUG,
-        ):
-            image_path = os.path.join(self.image_dir, image)
-
-            try:
-                exif = ExifRead(image_path)
-            except Exception as exc0:
-                LOG.warning(
-                    "Unknown error reading EXIF from image %s",
-                    image_path,
-                    exc_info=True,
-                )
-                descs.append({"error": types.describe_error(exc0), "filename": image})
-                continue
-
-            lon, lat = exif.extract_lon_lat()
-            if lat is None or lon is None:
-                exc = MapillaryGeoTaggingError(
-                    "Unable to extract GPS Longitude or GPS Latitude from the image"
-                )
-                descs.append({"error": types.describe_error(exc), "filename": image})
-                continue
-
-            timestamp = exif.extract_capture_time()
-            if timestamp is None:
-                exc = MapillaryGeoTaggingError(
-                    "Unable to extract timestamp from the image"
-                )
-                descs.append({"error": types.describe_error(exc), "filename": image})
-                continue
-
-            angle = exif.extract_direction()
-
-            desc: types.ImageDescriptionFile = {
-                "MAPLatitude": lat,
-                "MAPLongitude": lon,
-                "MAPCaptureTime": types.datetime_to_map_capture_time(timestamp),
-                "filename": image,
-            }
-            if angle is not None:
-                desc["MAPCompassHeading"] = {
-                    "TrueHeading": angle,
-                    "MagneticHeading": angle,
-                }
-
-            altitude = exif.extract_altitude()
-            if altitude is not None:
-                desc["MAPAltitude"] = altitude
-
-            desc["MAPOrientation"] = exif.extract_orientation()
-
-            make = exif.extract_make()
-            if make is not None:
-                desc["MAPDeviceMake"] = make
-
-            model = exif.extract_model()
-            if model is not None:
-                desc["MAPDeviceModel"] = model
-
-            descs.append(desc)
-
-        return descs
+        ) as pbar:
+            if self.workers <= 1 or len(self.images) <= 1:
+                descs = []
+                for image in self.images:
+                    descs.append(_image_to_description(self.image_dir, image))
+                    pbar.update(1)
+                return descs
+
+            # Parsing EXIF is CPU bound in pure Python, so use processes instead of threads.
+            # The errors reading EXIF are returned as ImageDescriptionFileError entries, while the others
+            # (e.g. raised by extract_*) propagate through map() as in the serial loop above
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers
+            ) as executor:
+                descs = []
+                for desc in executor.map(
+                    functools.partial(_image_to_description, self.image_dir),
+                    self.images,
+                    chunksize=self._chunksize(),
+                ):
+                    descs.append(desc)
+                    pbar.update(1)
+                return descs
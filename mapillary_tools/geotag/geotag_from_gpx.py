@@ -2,13 +2,12 @@ import logging
 import os
 import typing as T
 
-from .. import geo, types
+from .. import exif_cache, geo, types
 from ..exceptions import (
     MapillaryGeoTaggingError,
     MapillaryGPXEmptyError,
     MapillaryOutsideGPXTrackError,
 )
-from ..exif_read import ExifRead
 
 from .geotag_from_generic import GeotagFromGeneric
 
@@ -36,7 +35,7 @@ class GeotagFromGPX(GeotagFromGeneric):
 
     def read_image_time(self, image: str) -> T.Optional[float]:
         image_path = os.path.join(self.image_dir, image)
-        image_time = ExifRead(image_path).extract_capture_time()
+        image_time = exif_cache.read_exif(image_path).extract_capture_time()
         if image_time is None:
             return None
         return geo.as_unix_time(image_time)
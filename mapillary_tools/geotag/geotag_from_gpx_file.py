@@ -5,7 +5,7 @@ import typing as T
 import gpxpy
 from tqdm import tqdm
 
-from .. import exif_read, geo, types
+from .. import exif_cache, geo, types
 
 from .geotag_from_generic import GeotagFromGeneric
 from .geotag_from_gpx import GeotagFromGPXWithProgress
@@ -44,7 +44,7 @@ class GeotagFromGPXFile(GeotagFromGeneric):
         image_path = os.path.join(self.image_dir, desc["filename"])
 
         try:
-            exif = exif_read.ExifRead(image_path)
+            exif = exif_cache.read_exif(image_path)
         except Exception as exc:
             LOG.warning(
                 "Unknown error reading EXIF from image %s",
@@ -0,0 +1,64 @@
+import collections
+import concurrent.futures
+import logging
+import os
+import time
+import typing as T
+
+from . import file_hash_cache
+
+
+LOG = logging.getLogger(__name__)
+
+_T = T.TypeVar("_T")
+_R = T.TypeVar("_R")
+
+
+def imap_ordered(
+    func: T.Callable[[_T], _R], items: T.Iterable[_T], max_workers: int = 1
+) -> T.Generator[_R, None, None]:
+    """
+    Yield func(item) for the items in order, running up to max_workers of them in threads.
+    Threads are enough for reading and hashing files because hashlib and the reads release the GIL.
+    The items are submitted gradually so that at most 2 * max_workers results are held in memory.
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures: T.Deque[concurrent.futures.Future] = collections.deque()
+        try:
+            for item in items:
+                futures.append(executor.submit(func, item))
+                if 2 * max_workers <= len(futures):
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            # On errors or when the caller stops early
+            for future in futures:
+                future.cancel()
+
+
+def file_md5sums(paths: T.Iterable[str], max_workers: int = 1) -> T.List[str]:
+    """
+    Return the md5sums of the files in order, looked up in (and saved to) the default file hash cache.
+    The first error is re-raised after the running workers finish.
+    """
+    paths = list(paths)
+    start_time = time.monotonic()
+    md5sums = list(
+        imap_ordered(file_hash_cache.file_md5sum, paths, max_workers=max_workers)
+    )
+    elapsed = time.monotonic() - start_time
+    total_size = sum(os.path.getsize(path) for path in paths)
+    LOG.debug(
+        "Hashed %d files (%.1f MB) in %.2f seconds (%.1f MB/s including the cached ones)",
+        len(paths),
+        total_size / 1024 / 1024,
+        elapsed,
+        total_size / 1024 / 1024 / elapsed if 0 < elapsed else 0.0,
+    )
+    return md5sums
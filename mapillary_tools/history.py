@@ -0,0 +1,297 @@
+import json
+import logging
+import os
+import sqlite3
+import string
+import threading
+import time
+import typing as T
+import zlib
+
+from . import types
+
+
+LOG = logging.getLogger(__name__)
+
+HISTORY_DB_FILENAME = "upload_history.sqlite3"
+# SQLite limits the number of host parameters in a statement (999 in old versions)
+_BATCH_SIZE = 500
+
+# Increase it and add the migration to _MIGRATIONS when changing the schema
+_MIGRATIONS: T.List[T.List[str]] = [
+    # Version 1
+    [
+        """
+        CREATE TABLE uploads (
+            md5sum TEXT PRIMARY KEY,
+            sequence_uuid TEXT,
+            finished_at REAL NOT NULL,
+            params TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            descs BLOB,
+            descs_compressed INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX uploads_sequence_uuid ON uploads (sequence_uuid)",
+    ],
+    # Version 2
+    [
+        # The legacy history subfolders imported, and their mtimes when imported
+        """
+        CREATE TABLE legacy_history_dirs (
+            name TEXT PRIMARY KEY,
+            mtime_ns INTEGER NOT NULL
+        )
+        """,
+    ],
+]
+
+
+def _validate_hexdigits(md5sum: str):
+    try:
+        assert set(md5sum).issubset(string.hexdigits)
+        assert 4 <= len(md5sum)
+        _ = int(md5sum, 16)
+    except Exception:
+        raise ValueError(f"Invalid md5sum {md5sum}")
+
+
+class UploadHistory:
+    """
+    Record the finished uploads (keyed by the md5sum of the zipfile/BlackVue) in a SQLite database
+    in the history directory.
+
+    The history written by earlier versions (one {md5sum[:2]}/{md5sum[2:]}.json file per upload)
+    is imported into the database when the database is opened. The files are kept as they are
+    for the earlier versions sharing the history directory. Only the subfolders modified since
+    they were imported (i.e. the ones the earlier versions wrote to since) are scanned again.
+
+    With write_legacy enabled, each upload is also written to its legacy history file,
+    so that the earlier versions sharing the history directory do not upload it again.
+
+    Use it as a context manager, or call close() when done.
+    """
+
+    def __init__(
+        self, history_dir: str, compress_descs: bool = True, write_legacy: bool = False
+    ):
+        self.history_dir = history_dir
+        self.db_path = os.path.join(history_dir, HISTORY_DB_FILENAME)
+        self.compress_descs = compress_descs
+        self.write_legacy = write_legacy
+        self._lock = threading.Lock()
+        self._conn: T.Optional[sqlite3.Connection] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(self.history_dir, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            try:
+                self._migrate(conn)
+                self._import_legacy_history(conn)
+            except BaseException:
+                conn.close()
+                raise
+            self._conn = conn
+        return self._conn
+
+    def _migrate(self, conn: sqlite3.Connection) -> None:
+        # Take the write lock first, so that concurrent processes do not migrate twice
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for new_version in range(version + 1, len(_MIGRATIONS) + 1):
+                LOG.debug(f"Migrating upload history to version {new_version}")
+                for statement in _MIGRATIONS[new_version - 1]:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {new_version}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    def _legacy_history_paths(
+        self, subfolder: str
+    ) -> T.Generator[T.Tuple[str, str], None, None]:
+        for entry in os.scandir(os.path.join(self.history_dir, subfolder)):
+            basename, ext = os.path.splitext(entry.name)
+            if ext != ".json":
+                continue
+            md5sum = subfolder + basename
+            try:
+                _validate_hexdigits(md5sum)
+            except ValueError:
+                continue
+            yield md5sum, entry.path
+
+    def _import_legacy_history(self, conn: sqlite3.Connection) -> None:
+        imported_mtimes = dict(
+            conn.execute("SELECT name, mtime_ns FROM legacy_history_dirs").fetchall()
+        )
+
+        count = 0
+        for subfolder in os.scandir(self.history_dir):
+            if not subfolder.is_dir() or len(subfolder.name) != 2:
+                continue
+            # Taken before scanning, so that the files written during the scan are imported next time
+            mtime_ns = subfolder.stat().st_mtime_ns
+            if imported_mtimes.get(subfolder.name) == mtime_ns:
+                continue
+            legacy_paths = dict(self._legacy_history_paths(subfolder.name))
+            # Only read the files not imported yet
+            imported = self._uploaded(conn, list(legacy_paths.keys()))
+            for md5sum, path in legacy_paths.items():
+                if md5sum in imported:
+                    continue
+                try:
+                    with open(path) as fp:
+                        history = json.load(fp)
+                except (OSError, json.JSONDecodeError):
+                    LOG.warning(
+                        f"Skipping invalid upload history {path}", exc_info=True
+                    )
+                    continue
+                self._insert(
+                    conn,
+                    md5sum,
+                    history.get("params", {}),
+                    history.get("summary", {}),
+                    history.get("descs"),
+                    finished_at=os.path.getmtime(path),
+                )
+                count += 1
+            conn.execute(
+                "INSERT OR REPLACE INTO legacy_history_dirs (name, mtime_ns) VALUES (?, ?)",
+                (subfolder.name, mtime_ns),
+            )
+            conn.commit()
+
+        if count:
+            LOG.info(f"Imported {count} upload history files into {self.db_path}")
+
+    def _insert(
+        self,
+        conn: sqlite3.Connection,
+        md5sum: str,
+        params: T.Dict,
+        summary: T.Dict,
+        descs: T.Optional[T.List[types.ImageDescriptionFile]] = None,
+        finished_at: T.Optional[float] = None,
+    ) -> None:
+        _validate_hexdigits(md5sum)
+        descs_blob: T.Optional[bytes]
+        if descs is None:
+            descs_blob = None
+        else:
+            descs_blob = json.dumps(descs).encode("utf-8")
+            if self.compress_descs:
+                descs_blob = zlib.compress(descs_blob)
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO uploads
+            (md5sum, sequence_uuid, finished_at, params, summary, descs, descs_compressed)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                md5sum,
+                summary.get("sequence_uuid"),
+                time.time() if finished_at is None else finished_at,
+                json.dumps(params),
+                json.dumps(summary),
+                descs_blob,
+                int(descs_blob is not None and self.compress_descs),
+            ),
+        )
+
+    def _legacy_history_path(self, md5sum: str) -> str:
+        _validate_hexdigits(md5sum)
+        return os.path.join(self.history_dir, md5sum[:2], f"{md5sum[2:]}.json")
+
+    def _write_legacy(
+        self,
+        md5sum: str,
+        params: T.Dict,
+        summary: T.Dict,
+        descs: T.Optional[T.List[types.ImageDescriptionFile]] = None,
+    ) -> None:
+        path = self._legacy_history_path(md5sum)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        history: T.Dict[str, T.Any] = {
+            "params": params,
+            "summary": summary,
+        }
+        if descs is not None:
+            history["descs"] = descs
+        with open(path, "w") as fp:
+            fp.write(json.dumps(history))
+
+    def write(
+        self,
+        md5sum: str,
+        params: T.Dict,
+        summary: T.Dict,
+        descs: T.Optional[T.List[types.ImageDescriptionFile]] = None,
+    ) -> None:
+        with self._lock:
+            conn = self._connect()
+            self._insert(conn, md5sum, params, summary, descs)
+            conn.commit()
+        if self.write_legacy:
+            self._write_legacy(md5sum, params, summary, descs)
+
+    def read(self, md5sum: str) -> T.Optional[T.Dict[str, T.Any]]:
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT params, summary, descs, descs_compressed FROM uploads WHERE md5sum = ?",
+                    (md5sum,),
+                )
+                .fetchone()
+            )
+        if row is None:
+            return None
+        params, summary, descs_blob, descs_compressed = row
+        history: T.Dict[str, T.Any] = {
+            "params": json.loads(params),
+            "summary": json.loads(summary),
+        }
+        if descs_blob is not None:
+            if descs_compressed:
+                descs_blob = zlib.decompress(descs_blob)
+            history["descs"] = json.loads(descs_blob)
+        return history
+
+    def uploaded(self, md5sums: T.Iterable[str]) -> T.Set[str]:
+        """
+        Return the md5sums (of the given ones) that have been uploaded.
+        """
+        with self._lock:
+            return self._uploaded(self._connect(), list(md5sums))
+
+    def _uploaded(self, conn: sqlite3.Connection, md5sums: T.List[str]) -> T.Set[str]:
+        found: T.Set[str] = set()
+        for idx in range(0, len(md5sums), _BATCH_SIZE):
+            batch = md5sums[idx : idx + _BATCH_SIZE]
+            placeholders = ",".join("?" for _ in batch)
+            rows = conn.execute(
+                f"SELECT md5sum FROM uploads WHERE md5sum IN ({placeholders})",
+                batch,
+            )
+            found.update(row[0] for row in rows)
+        return found
+
+    def is_uploaded(self, md5sum: str) -> bool:
+        return md5sum in self.uploaded([md5sum])
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def __enter__(self) -> "UploadHistory":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
@@ -1,21 +1,24 @@
+import atexit
 import json
 import logging
 import os
 import struct
+import threading
+import typing as T
 
 
 LOG = logging.getLogger(__name__)
 NODE_CHANNEL_FD = int(os.getenv("NODE_CHANNEL_FD", -1))
+# Messages sent with batch=True are buffered for at most this many seconds,
+# and then written together in one frame
+BATCH_INTERVAL = 0.1
 
+# The messages waiting to be sent, and whether each was sent with batch=True
+_BUFFER: T.List[T.Tuple[str, bool]] = []
+_BUFFER_LOCK = threading.Lock()
 
-def _write(obj):
-    # put here to make sure obj is JSON-serializable, and if not, fail early
-    data = json.dumps(obj, separators=(",", ":")) + os.linesep
-
-    if NODE_CHANNEL_FD == -1:
-        # do nothing
-        return
 
+def _write(data: str):
     if os.name == "nt":
         buf = data.encode("utf-8")
         # On windows, using node v8.11.4, this assertion fails
@@ -29,12 +32,65 @@ def _write(obj):
         os.write(NODE_CHANNEL_FD, data.encode("utf-8"))
 
 
-def send(type, payload):
+def _flush_locked():
+    if not _BUFFER:
+        return
+    messages = list(_BUFFER)
+    _BUFFER.clear()
+    # One message per line, so the receiver splits the frame as usual
+    data = "".join(message for message, _batch in messages)
+    try:
+        _write(data)
+    except Exception:
+        LOG.warning(f"IPC error sending: {data}", exc_info=True)
+    else:
+        return
+
+    # The batched messages (i.e. progress) are superseded by the later ones, but the others
+    # (e.g. upload_end) are not, so retry them on their own
+    for message, batch in messages:
+        if batch:
+            continue
+        try:
+            _write(message)
+        except Exception:
+            LOG.warning(f"IPC error sending: {message}", exc_info=True)
+
+
+def flush():
+    with _BUFFER_LOCK:
+        _flush_locked()
+
+
+atexit.register(flush)
+
+
+def send(type, payload, batch: bool = False):
+    """
+    Send the message, along with the buffered ones. With batch=True, the message
+    is buffered for up to BATCH_INTERVAL seconds to be sent with the later ones.
+    """
     obj = {
         "type": type,
         "payload": payload,
     }
     try:
-        _write(obj)
+        # put here to make sure obj is JSON-serializable, and if not, fail early
+        data = json.dumps(obj, separators=(",", ":")) + os.linesep
     except Exception:
         LOG.warning(f"IPC error sending: {obj}", exc_info=True)
+        return
+
+    if NODE_CHANNEL_FD == -1:
+        # do nothing
+        return
+
+    with _BUFFER_LOCK:
+        _BUFFER.append((data, batch))
+        if not batch:
+            _flush_locked()
+        elif len(_BUFFER) == 1:
+            # Flush the batch in time even if no more messages come
+            timer = threading.Timer(BATCH_INTERVAL, flush)
+            timer.daemon = True
+            timer.start()
@@ -1,16 +1,20 @@
 import collections
+import concurrent.futures
+import copy
 import datetime
+import functools
 import json
 import logging
 import os
+import time
 import typing as T
 
 import jsonschema
 import piexif
 from tqdm import tqdm
 
-from . import constants, exceptions, types, uploader, utils
-from .exif_write import ExifEdit
+from . import constants, exceptions, file_hash_cache, types, uploader, utils, VERSION
+from .exif_write import ExifEdit, read_image_header
 from .geo import normalize_bearing
 from .geotag import (
     geotag_from_blackvue,
@@ -40,6 +44,168 @@ def validate_and_fail_desc(
         return desc
 
 
+def _is_valid_state_entry(image: str, entry: T.Any) -> bool:
+    if not isinstance(entry, dict):
+        return False
+    signature = entry.get("signature")
+    desc = entry.get("desc")
+    return (
+        isinstance(signature, list)
+        and len(signature) == 4
+        and all(isinstance(field, int) for field in signature)
+        and isinstance(desc, dict)
+        and desc.get("filename") == image
+    )
+
+
+class GeotagState:
+    """
+    The geotagged descriptions of the images in the last run, along with their file signatures,
+    so that the next run only geotags the images added or modified since then.
+
+    It is saved in the import directory, and discarded if the geotag options
+    or the mapillary_tools version change, or if it is invalid (e.g. edited or truncated).
+    """
+
+    def __init__(self, path: str, options: T.Dict[str, T.Any]):
+        self.path = path
+        self.options = options
+        # Image filename -> {"signature": ..., "desc": ...}
+        self.images: T.Dict[str, T.Dict[str, T.Any]] = {}
+        self._signatures: T.Dict[str, T.Optional[file_hash_cache.FileSignature]] = {}
+        self._changed: T.Set[str] = set()
+
+    @classmethod
+    def load(cls, path: str, options: T.Dict[str, T.Any]) -> "GeotagState":
+        state = cls(path, options)
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            return state
+        except (OSError, ValueError):
+            LOG.warning("Ignored the invalid geotag state %s", path, exc_info=True)
+            return state
+        if not isinstance(data, dict):
+            LOG.warning("Ignored the invalid geotag state %s", path)
+            return state
+        if data.get("version") != VERSION or data.get("options") != options:
+            LOG.info("Geotag all images because the geotag options changed")
+            return state
+        images = data.get("images")
+        if not isinstance(images, dict) or not all(
+            _is_valid_state_entry(image, entry) for image, entry in images.items()
+        ):
+            LOG.warning("Ignored the invalid geotag state %s", path)
+            return state
+        state.images = images
+        return state
+
+    def _signature(
+        self, import_path: str, image: str
+    ) -> T.Optional[file_hash_cache.FileSignature]:
+        try:
+            signature = file_hash_cache.file_signature(os.path.join(import_path, image))
+        except OSError:
+            return None
+        _size, mtime_ns, _inode, _device = signature
+        # Could be modified again without changing the mtime
+        if time.time() - mtime_ns / 1e9 < file_hash_cache.RACY_INTERVAL:
+            return None
+        return signature
+
+    def changed_images(self, import_path: str, images: T.List[str]) -> T.List[str]:
+        """
+        Return the images that are new or modified since the last run.
+        """
+        changed = []
+        for image in images:
+            # Taken before geotagging so that the modifications during processing are not missed
+            signature = self._signature(import_path, image)
+            self._signatures[image] = signature
+            entry = self.images.get(image)
+            if (
+                signature is None
+                or entry is None
+                or tuple(entry["signature"]) != signature
+            ):
+                changed.append(image)
+        self._changed = set(changed)
+        LOG.info(
+            "Geotagging %d new or modified images out of %d images",
+            len(changed),
+            len(images),
+        )
+        return changed
+
+    def merge(
+        self,
+        images: T.List[str],
+        descs: T.List[types.ImageDescriptionFileOrError],
+    ) -> T.List[types.ImageDescriptionFileOrError]:
+        """
+        Merge the descriptions of the changed images with the ones kept from the last run (in the order of images),
+        and keep the successful ones for the next run.
+
+        A changed image without a description from the geotagger is left out as in a full run,
+        and geotagged again in the next run.
+        """
+        new_descs = {desc["filename"]: desc for desc in descs}
+        merged: T.List[types.ImageDescriptionFileOrError] = []
+        images_to_keep: T.Dict[str, T.Dict[str, T.Any]] = {}
+        for image in images:
+            desc = new_descs.get(image)
+            if desc is None:
+                entry = self.images.get(image)
+                if image in self._changed or entry is None:
+                    continue
+                # Copy since the descriptions are modified in the later steps
+                desc = copy.deepcopy(entry["desc"])
+            merged.append(desc)
+            signature = self._signatures.get(image)
+            # Errors are retried in the next run
+            if signature is not None and not types.is_error(desc):
+                images_to_keep[image] = {
+                    "signature": list(signature),
+                    "desc": copy.deepcopy(desc),
+                }
+        self.images = images_to_keep
+        return merged
+
+    def save(self) -> None:
+        data = {"version": VERSION, "options": self.options, "images": self.images}
+        try:
+            with open(f"{self.path}.tmp", "w") as fp:
+                json.dump(data, fp)
+            os.replace(f"{self.path}.tmp", self.path)
+        except OSError:
+            LOG.warning("Failed to save the geotag state %s", self.path, exc_info=True)
+
+
+def _geotag_state_options(
+    geotag_source: str,
+    video_import_path: T.Optional[str],
+    geotag_source_path: T.Optional[str],
+    interpolation_offset_time: float,
+) -> T.Dict[str, T.Any]:
+    options: T.Dict[str, T.Any] = {"geotag_source": geotag_source}
+    if geotag_source != "exif":
+        assert geotag_source_path is not None
+        options.update(
+            {
+                "geotag_source_path": os.path.realpath(geotag_source_path),
+                "geotag_source_signature": list(
+                    file_hash_cache.file_signature(geotag_source_path)
+                ),
+                "video_import_path": None
+                if video_import_path is None
+                else os.path.realpath(video_import_path),
+                "interpolation_offset_time": interpolation_offset_time,
+            }
+        )
+    return options
+
+
 def process_geotag_properties(
     import_path: str,
     geotag_source: str,
@@ -48,17 +214,47 @@ def process_geotag_properties(
     geotag_source_path: T.Optional[str] = None,
     interpolation_use_gpx_start_time: bool = False,
     interpolation_offset_time: float = 0.0,
+    workers: int = 1,
+    incremental: bool = False,
 ) -> T.List[types.ImageDescriptionFileOrError]:
     if not os.path.isdir(import_path):
         raise exceptions.MapillaryFileNotFoundError(
             f"Import directory not found: {import_path}"
         )
 
+    # Only the images geotagged independently of the others can be geotagged incrementally
+    geotag_state: T.Optional[GeotagState] = None
+    if incremental:
+        if geotag_source == "exif" or (
+            geotag_source in ["gpx", "nmea"]
+            and geotag_source_path is not None
+            and os.path.isfile(geotag_source_path)
+            and not interpolation_use_gpx_start_time
+        ):
+            geotag_state = GeotagState.load(
+                os.path.join(import_path, constants.GEOTAG_STATE_FILENAME),
+                _geotag_state_options(
+                    geotag_source,
+                    video_import_path,
+                    geotag_source_path,
+                    interpolation_offset_time,
+                ),
+            )
+        else:
+            LOG.warning(
+                "Geotag all images because incremental processing only works for geotagging from exif, gpx or nmea (without --interpolation_use_gpx_start_time)"
+            )
+
+    def _images_to_geotag(images: T.List[str]) -> T.List[str]:
+        if geotag_state is None:
+            return images
+        return geotag_state.changed_images(import_path, images)
+
     if geotag_source == "exif":
         images = utils.get_image_file_list(import_path, skip_subfolders=skip_subfolders)
         LOG.debug(f"Found {len(images)} images in {import_path}")
         geotag: geotag_from_generic.GeotagFromGeneric = geotag_from_exif.GeotagFromEXIF(
-            import_path, images
+            import_path, _images_to_geotag(images), workers=workers
         )
 
     elif geotag_source == "gpx":
@@ -85,7 +281,7 @@ def process_geotag_properties(
         LOG.debug(f"Found {len(images)} images in {import_path}")
         geotag = geotag_from_gpx_file.GeotagFromGPXFile(
             import_path,
-            images,
+            _images_to_geotag(images),
             geotag_source_path,
             use_gpx_start_time=interpolation_use_gpx_start_time,
             offset_time=interpolation_offset_time,
@@ -114,7 +310,7 @@ def process_geotag_properties(
         LOG.debug(f"Found {len(images)} images in {import_path}")
         geotag = geotag_from_nmea_file.GeotagFromNMEAFile(
             import_path,
-            images,
+            _images_to_geotag(images),
             geotag_source_path,
             use_gpx_start_time=interpolation_use_gpx_start_time,
             offset_time=interpolation_offset_time,
@@ -171,7 +367,13 @@ def process_geotag_properties(
     else:
         raise RuntimeError(f"Invalid geotag source {geotag_source}")
 
-    return list(types.map_descs(validate_and_fail_desc, geotag.to_description()))
+    descs = list(types.map_descs(validate_and_fail_desc, geotag.to_description()))
+
+    if geotag_state is not None:
+        descs = geotag_state.merge(images, descs)
+        geotag_state.save()
+
+    return descs
 
 
 def overwrite_exif_tags(
@@ -214,13 +416,13 @@ def verify_exif_write(
     desc: types.ImageDescriptionFile,
 ) -> types.ImageDescriptionFileOrError:
     image_path = os.path.join(import_path, desc["filename"])
-    with open(image_path, "rb") as fp:
-        edit = ExifEdit(fp.read())
+    # Only the metadata matters for dumping EXIF
+    edit = ExifEdit(read_image_header(image_path))
     # The cast is to fix the type error in Python3.6:
     # Argument 1 to "add_image_description" of "ExifEdit" has incompatible type "ImageDescriptionEXIF"; expected "Dict[str, Any]"
     edit.add_image_description(T.cast(T.Dict, uploader.desc_file_to_exif(desc)))
     try:
-        edit.dump_image_bytes()
+        edit.verify_dump()
     except piexif.InvalidImageDataError as exc:
         return {
             "error": types.describe_error(exc),
@@ -236,6 +438,48 @@ def verify_exif_write(
         return desc
 
 
+def verify_exif_writes(
+    import_path: str,
+    descs: T.List[types.ImageDescriptionFileOrError],
+    workers: int = 1,
+) -> T.List[types.ImageDescriptionFileOrError]:
+    """
+    Run verify_exif_write() on the successful descriptions in order, in parallel if workers > 1
+    """
+    images = types.filter_out_errors(descs)
+    with tqdm(
+        total=len(images),
+        desc="Test EXIF writing",
+        unit="images",
+        disable=LOG.getEffectiveLevel() <= logging.DEBUG,
+    ) as pbar:
+        if workers <= 1 or len(images) <= 1:
+            verified = []
+            for desc in images:
+                verified.append(verify_exif_write(import_path, desc))
+                pbar.update(1)
+        else:
+            # Dumping EXIF is CPU bound in pure Python, so use processes instead of threads
+            chunksize = max(
+                1,
+                min(constants.PROCESS_MAX_CHUNK_SIZE, len(images) // (workers * 4)),
+            )
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers
+            ) as executor:
+                verified = []
+                for new_desc in executor.map(
+                    functools.partial(verify_exif_write, import_path),
+                    images,
+                    chunksize=chunksize,
+                ):
+                    verified.append(new_desc)
+                    pbar.update(1)
+
+    verified_iter = iter(verified)
+    return [desc if types.is_error(desc) else next(verified_iter) for desc in descs]
+
+
 def process_finalize(
     import_path: str,
     descs: T.List[types.ImageDescriptionFileOrError],
@@ -248,6 +492,7 @@ def process_finalize(
     offset_time: float = 0.0,
     offset_angle: float = 0.0,
     desc_path: str = None,
+    workers: int = 1,
 ) -> None:
     if desc_path is None:
         desc_path = os.path.join(import_path, constants.IMAGE_DESCRIPTION_FILENAME)
@@ -307,19 +552,7 @@ def process_finalize(
                     f"Failed to overwrite EXIF for image {image}", exc_info=True
                 )
 
-    with tqdm(
-        total=len(types.filter_out_errors(descs)),
-        desc="Test EXIF writing",
-        unit="images",
-        disable=LOG.getEffectiveLevel() <= logging.DEBUG,
-    ) as pbar:
-
-        def _update(desc):
-            new_desc = verify_exif_write(import_path, desc)
-            pbar.update(1)
-            return new_desc
-
-        descs = list(types.map_descs(_update, descs))
+    descs = verify_exif_writes(import_path, descs, workers=workers)
 
     if desc_path == "-":
         print(json.dumps(descs, indent=4))
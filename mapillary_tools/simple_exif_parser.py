@@ -0,0 +1,218 @@
+import io
+import struct
+import typing as T
+
+from exifread.utils import Ratio
+
+
+class UnsupportedExifError(Exception):
+    """
+    Raised for anything this parser does not handle. Callers should fall back to exifread.
+    """
+
+
+class Tag(T.NamedTuple):
+    # The field type defined in TIFF (e.g. 2 for ASCII, 5 for RATIONAL)
+    field_type: int
+    # Same as the values of exifread's IfdTag: a string for ASCII,
+    # otherwise a list of integers, Ratio objects or tuples of floats
+    values: T.Any
+
+
+# The tags decoded from IFD0 (prefixed with "Image") and the EXIF sub-IFD (prefixed with "EXIF"),
+# named as in exifread
+_IMAGE_TAGS = {
+    0x010F: "Make",
+    0x0110: "Model",
+    0x0112: "Orientation",
+    0x0132: "DateTime",
+    0x9003: "DateTimeOriginal",
+    0x9004: "DateTimeDigitized",
+    0x9290: "SubSecTime",
+    0x9291: "SubSecTimeOriginal",
+    0x9292: "SubSecTimeDigitized",
+    0xA433: "LensMake",
+    0xA434: "LensModel",
+}
+# The tags decoded from the GPS sub-IFD (prefixed with "GPS")
+_GPS_TAGS = {
+    0x0001: "GPSLatitudeRef",
+    0x0002: "GPSLatitude",
+    0x0003: "GPSLongitudeRef",
+    0x0004: "GPSLongitude",
+    0x0005: "GPSAltitudeRef",
+    0x0006: "GPSAltitude",
+    0x0007: "GPSTimeStamp",
+    0x000F: "GPSTrack",
+    0x0011: "GPSImgDirection",
+    0x001D: "GPSDate",
+}
+_EXIF_OFFSET = 0x8769
+_GPS_INFO = 0x8825
+
+# The byte size of each field type (0 is invalid)
+_TYPE_LENGTHS = (0, 1, 1, 2, 4, 8, 1, 1, 2, 4, 8, 4, 8, 4)
+_SIGNED_TYPES = (6, 8, 9, 10)
+_INT_FORMATS = {1: "B", 2: "H", 4: "I"}
+
+# exifread skips the non-ASCII fields with this many values or more
+_MAX_COUNT = 1000
+# Give up if the EXIF APP1 segment is not found within this many segments
+_MAX_SEGMENTS = 32
+# Give up on IFD chains longer than this (also guards against loops)
+_MAX_IFDS = 8
+
+
+class _TiffReader:
+    def __init__(self, data: bytes):
+        self.data = data
+        # exifread checks the first byte only
+        byte_order = data[:1]
+        if byte_order == b"I":
+            self.order = "<"
+        elif byte_order == b"M":
+            self.order = ">"
+        else:
+            raise UnsupportedExifError(f"Unknown byte order {data[:2]!r}")
+        self.tags: T.Dict[str, Tag] = {}
+
+    def _unpack(self, fmt: str, offset: int) -> T.Tuple:
+        fmt = self.order + fmt
+        if offset < 0 or len(self.data) < offset + struct.calcsize(fmt):
+            # exifread reads the rest of the file in this case
+            raise UnsupportedExifError(f"Offset {offset} out of the EXIF segment")
+        return struct.unpack_from(fmt, self.data, offset)
+
+    def _read_values(self, entry: int, field_type: int) -> T.Any:
+        type_length = _TYPE_LENGTHS[field_type]
+        (count,) = self._unpack("I", entry + 4)
+        # Inlined if the values fit in 4 bytes
+        offset = entry + 8
+        if 4 < count * type_length:
+            (offset,) = self._unpack("I", offset)
+
+        if field_type == 2:
+            if count == 0:
+                return ""
+            if len(self.data) < offset + count:
+                raise UnsupportedExifError(f"Offset {offset} out of the EXIF segment")
+            # Drop any garbage after a null
+            raw = self.data[offset : offset + count].split(b"\x00", 1)[0]
+            try:
+                return raw.decode("utf-8")
+            except UnicodeDecodeError:
+                # exifread keeps the bytes
+                raise UnsupportedExifError("Invalid UTF-8 string")
+
+        if _MAX_COUNT <= count:
+            return []
+
+        signed = field_type in _SIGNED_TYPES
+        values: T.List[T.Any] = []
+        for idx in range(count):
+            value_offset = offset + idx * type_length
+            if field_type in (5, 10):
+                num, den = self._unpack("ii" if signed else "II", value_offset)
+                values.append(Ratio(num, den))
+            elif field_type in (11, 12):
+                # A tuple as exifread returns
+                values.append(
+                    self._unpack("f" if field_type == 11 else "d", value_offset)
+                )
+            else:
+                fmt = _INT_FORMATS[type_length]
+                (value,) = self._unpack(fmt.lower() if signed else fmt, value_offset)
+                values.append(value)
+        return values
+
+    def dump_ifd(
+        self, ifd: int, prefix: T.Optional[str], names: T.Dict[int, str]
+    ) -> T.Optional[int]:
+        """
+        Decode the named tags of the IFD in the order of entries, and follow the GPS sub-IFD pointer
+        as exifread does. Return the EXIF sub-IFD offset if found.
+        """
+        exif_offset = None
+        (entries,) = self._unpack("H", ifd)
+        for idx in range(entries):
+            entry = ifd + 2 + 12 * idx
+            tag, field_type = self._unpack("HH", entry)
+            if not 0 < field_type < len(_TYPE_LENGTHS):
+                # exifread skips the tags of unknown types
+                continue
+
+            is_exif_offset = tag == _EXIF_OFFSET and prefix == "Image"
+            if is_exif_offset or (tag == _GPS_INFO and names is not _GPS_TAGS):
+                values = self._read_values(entry, field_type)
+                if values and not isinstance(values[0], int):
+                    raise UnsupportedExifError(f"Invalid IFD offset {values[0]!r}")
+                if is_exif_offset:
+                    if not values:
+                        # exifread fails with IndexError
+                        raise UnsupportedExifError("Empty EXIF offset")
+                    exif_offset = values[0]
+                elif values:
+                    self.dump_ifd(values[0], "GPS", _GPS_TAGS)
+            elif prefix is not None and tag in names:
+                self.tags[f"{prefix} {names[tag]}"] = Tag(
+                    field_type, self._read_values(entry, field_type)
+                )
+        return exif_offset
+
+    def parse(self) -> T.Dict[str, Tag]:
+        (ifd,) = self._unpack("I", 4)
+        ifds: T.List[int] = []
+        while ifd:
+            if _MAX_IFDS <= len(ifds):
+                raise UnsupportedExifError("Too many IFDs")
+            ifds.append(ifd)
+            (entries,) = self._unpack("H", ifd)
+            (next_ifd,) = self._unpack("I", ifd + 2 + 12 * entries)
+            ifd = 0 if next_ifd == ifd else next_ifd
+
+        exif_offset = None
+        for idx, ifd in enumerate(ifds):
+            if idx == 0:
+                exif_offset = self.dump_ifd(ifd, "Image", _IMAGE_TAGS)
+            else:
+                # Only the GPS sub-IFDs matter in the other IFDs (e.g. the thumbnail)
+                self.dump_ifd(ifd, None, _IMAGE_TAGS)
+        if exif_offset is not None:
+            self.dump_ifd(exif_offset, "EXIF", _IMAGE_TAGS)
+        return self.tags
+
+
+def parse_jpeg_exif(fp: T.BinaryIO) -> T.Dict[str, Tag]:
+    """
+    Decode the tags used by ExifRead from the EXIF APP1 segment of the JPEG image.
+    The tags are named and valued as exifread.process_file() returns them.
+
+    It reads the segment headers up to the first APP1 segment and then only that segment, so
+    at most 64 KB for EXIF. UnsupportedExifError is raised if the image is not a JPEG,
+    the first APP1 segment is not EXIF, or anything else is unusual.
+    """
+    fp.seek(0)
+    if fp.read(2) != b"\xff\xd8":
+        raise UnsupportedExifError("Not a JPEG image")
+
+    for _ in range(_MAX_SEGMENTS):
+        header = fp.read(4)
+        if len(header) < 4 or header[0] != 0xFF:
+            raise UnsupportedExifError("Invalid JPEG segment")
+        marker = header[1]
+        (length,) = struct.unpack(">H", header[2:])
+        if length < 2:
+            raise UnsupportedExifError("Invalid JPEG segment length")
+
+        if marker == 0xE1:
+            payload = fp.read(length - 2)
+            if len(payload) < length - 2 or payload[:6] != b"Exif\x00\x00":
+                raise UnsupportedExifError("The first APP1 segment is not EXIF")
+            return _TiffReader(payload[6:]).parse()
+        elif 0xE0 <= marker <= 0xEF:
+            fp.seek(length - 2, io.SEEK_CUR)
+        else:
+            # e.g. the image data without EXIF
+            raise UnsupportedExifError("EXIF not found in the application segments")
+
+    raise UnsupportedExifError("EXIF not found in the application segments")
@@ -0,0 +1,172 @@
+import json
+import math
+import os
+import typing as T
+
+
+class Histogram:
+    """
+    A Prometheus-style histogram: the count of observations in each bucket (by upper bound),
+    plus the sum and the total count.
+    """
+
+    def __init__(self, name: str, help: str, buckets: T.Sequence[float]):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        # The last count is for +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative_counts(self) -> T.List[T.Tuple[float, int]]:
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + [math.inf], self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+    def to_json(self) -> T.Dict:
+        return {
+            "help": self.help,
+            "buckets": [
+                {"le": "+Inf" if math.isinf(bound) else bound, "count": count}
+                for bound, count in self.cumulative_counts()
+            ],
+            "sum": self.sum,
+            "count": self.count,
+        }
+
+    def to_prometheus(self, prefix: str) -> T.List[str]:
+        name = f"{prefix}_{self.name}"
+        lines = [f"# HELP {name} {self.help}", f"# TYPE {name} histogram"]
+        for bound, count in self.cumulative_counts():
+            le = "+Inf" if math.isinf(bound) else repr(float(bound))
+            lines.append(f'{name}_bucket{{le="{le}"}} {count}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+_SECONDS_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+_THROUGHPUT_BUCKETS = [
+    64 * 1024,
+    256 * 1024,
+    1024 * 1024,
+    4 * 1024 * 1024,
+    16 * 1024 * 1024,
+    64 * 1024 * 1024,
+    256 * 1024 * 1024,
+]
+_SIZE_BUCKETS = [
+    256 * 1024,
+    1024 * 1024,
+    4 * 1024 * 1024,
+    16 * 1024 * 1024,
+    64 * 1024 * 1024,
+]
+
+
+class UploadTelemetry:
+    """
+    Aggregate the per-chunk upload metrics into histograms, and export them to a JSON file
+    or a Prometheus text file (e.g. for the textfile collector of node_exporter).
+    """
+
+    PREFIX = "mapillary_tools_upload"
+
+    def __init__(self):
+        self.chunk_seconds = Histogram(
+            "chunk_seconds",
+            "Seconds to upload a chunk (request round trip)",
+            _SECONDS_BUCKETS,
+        )
+        self.chunk_bytes = Histogram(
+            "chunk_bytes", "Size of the uploaded chunks in bytes", _SIZE_BUCKETS
+        )
+        self.chunk_throughput = Histogram(
+            "chunk_throughput_bytes_per_second",
+            "Throughput of uploading a chunk in bytes per second",
+            _THROUGHPUT_BUCKETS,
+        )
+        self.fetch_offset_seconds = Histogram(
+            "fetch_offset_seconds",
+            "Seconds to fetch the upload offset (request round trip)",
+            _SECONDS_BUCKETS,
+        )
+        self.retry_wait_seconds = Histogram(
+            "retry_wait_seconds",
+            "Seconds waited before retrying an interrupted upload",
+            _SECONDS_BUCKETS,
+        )
+        # Counters
+        self.retries = 0
+        self.uploaded_bytes = 0
+        self.sessions = 0
+
+    @property
+    def histograms(self) -> T.List[Histogram]:
+        return [
+            self.chunk_seconds,
+            self.chunk_bytes,
+            self.chunk_throughput,
+            self.fetch_offset_seconds,
+            self.retry_wait_seconds,
+        ]
+
+    def observe_chunk(self, size: int, seconds: float) -> None:
+        self.chunk_seconds.observe(seconds)
+        self.chunk_bytes.observe(size)
+        if 0 < seconds:
+            self.chunk_throughput.observe(size / seconds)
+        self.uploaded_bytes += size
+
+    def to_json(self) -> T.Dict:
+        return {
+            "histograms": {
+                histogram.name: histogram.to_json() for histogram in self.histograms
+            },
+            "counters": {
+                "retries_total": self.retries,
+                "uploaded_bytes_total": self.uploaded_bytes,
+                "sessions_total": self.sessions,
+            },
+        }
+
+    def to_prometheus(self) -> str:
+        lines = []
+        for histogram in self.histograms:
+            lines.extend(histogram.to_prometheus(self.PREFIX))
+        for name, help, value in [
+            ("retries_total", "Number of interrupted uploads retried", self.retries),
+            ("uploaded_bytes_total", "Bytes uploaded", self.uploaded_bytes),
+            ("sessions_total", "Number of finished upload sessions", self.sessions),
+        ]:
+            lines.append(f"# HELP {self.PREFIX}_{name} {help}")
+            lines.append(f"# TYPE {self.PREFIX}_{name} counter")
+            lines.append(f"{self.PREFIX}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        Write the Prometheus text format if the path ends with .prom, otherwise JSON.
+        """
+        if path.endswith(".prom"):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_json(), indent=2)
+        # Replace atomically so that collectors never read a partial file
+        with open(f"{path}.tmp", "w") as fp:
+            fp.write(content)
+        os.replace(f"{path}.tmp", path)
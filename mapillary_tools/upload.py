@@ -1,7 +1,9 @@
+import contextlib
+import functools
 import json
 import logging
 import os
-import string
+import sqlite3
 import sys
 import time
 import typing as T
@@ -17,12 +19,17 @@ from tqdm import tqdm
 
 from . import (
     api_v4,
+    async_http,
     authenticate,
     config,
     constants,
     exceptions,
+    hashing,
+    history,
     ipc,
+    telemetry,
     types,
+    upload_api_v4,
     uploader,
     utils,
 )
@@ -45,6 +52,13 @@ MAPILLARY_UPLOAD_HISTORY_PATH = os.getenv(
         "upload_history",
     ),
 )
+# Set it to "YES" to also write the upload history files of the earlier versions (one JSON file per upload),
+# so that the earlier versions sharing the history directory do not upload the same files again
+MAPILLARY_WRITE_LEGACY_UPLOAD_HISTORY = os.getenv(
+    "MAPILLARY_WRITE_LEGACY_UPLOAD_HISTORY"
+)
+# Send the upload progress of each session to the app at most this many times per second
+IPC_MAX_PROGRESS_RATE = 10
 
 
 def read_image_descriptions(desc_path: str) -> T.List[types.ImageDescriptionFile]:
@@ -78,6 +92,8 @@ def zip_images(
     import_path: str,
     zip_dir: str,
     desc_path: T.Optional[str] = None,
+    zip_compression: uploader.ZipCompression = "auto",
+    zip_workers: int = 1,
 ):
     if not os.path.isdir(import_path):
         raise exceptions.MapillaryFileNotFoundError(
@@ -93,7 +109,12 @@ def zip_images(
         LOG.warning(f"No images found in {desc_path}")
         return
 
-    uploader.zip_images(_join_desc_path(import_path, descs), zip_dir)
+    uploader.zip_images(
+        _join_desc_path(import_path, descs),
+        zip_dir,
+        compression=zip_compression,
+        workers=zip_workers,
+    )
 
 
 def fetch_user_items(
@@ -129,75 +150,70 @@ def fetch_user_items(
     return user_items
 
 
-def _validate_hexdigits(md5sum: str):
+def is_uploaded(upload_history: history.UploadHistory, md5sum: str) -> bool:
     try:
-        assert set(md5sum).issubset(string.hexdigits)
-        assert 4 <= len(md5sum)
-        _ = int(md5sum, 16)
-    except Exception:
-        raise ValueError(f"Invalid md5sum {md5sum}")
-
-
-def _history_desc_path(md5sum: str) -> str:
-    assert MAPILLARY_UPLOAD_HISTORY_PATH is not None
-    _validate_hexdigits(md5sum)
-    subfolder = md5sum[:2]
-    assert subfolder, f"Invalid md5sum {md5sum}"
-    basename = md5sum[2:]
-    assert basename, f"Invalid md5sum {md5sum}"
-    return os.path.join(MAPILLARY_UPLOAD_HISTORY_PATH, subfolder, f"{basename}.json")
+        return upload_history.is_uploaded(md5sum)
+    except (OSError, sqlite3.Error):
+        LOG.warning(f"Error reading upload history {md5sum}", exc_info=True)
+        return False
 
 
-def is_uploaded(md5sum: str) -> bool:
-    if not MAPILLARY_UPLOAD_HISTORY_PATH:
-        return False
-    return os.path.isfile(_history_desc_path(md5sum))
+def uploaded_md5sums(
+    upload_history: history.UploadHistory, md5sums: T.List[str]
+) -> T.Set[str]:
+    try:
+        return upload_history.uploaded(md5sums)
+    except (OSError, sqlite3.Error):
+        LOG.warning("Error reading upload history", exc_info=True)
+        return set()
 
 
 def write_history(
+    upload_history: history.UploadHistory,
     md5sum: str,
     params: T.Dict,
     summary: T.Dict,
     descs: T.Optional[T.List[types.ImageDescriptionFile]] = None,
 ) -> None:
-    if not MAPILLARY_UPLOAD_HISTORY_PATH:
-        return
-    path = _history_desc_path(md5sum)
-    LOG.debug(f"Writing upload history: {path}")
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    history: T.Dict[str, T.Any] = {
-        "params": params,
-        "summary": summary,
-    }
-    if descs is not None:
-        history["descs"] = descs
-    with open(path, "w") as fp:
-        fp.write(json.dumps(history))
+    LOG.debug(f"Writing upload history {md5sum} to {upload_history.db_path}")
+    upload_history.write(md5sum, params, summary, descs)
 
 
-def _setup_cancel_due_to_duplication(emitter: uploader.EventEmitter) -> None:
+def _setup_cancel_due_to_duplication(
+    emitter: uploader.EventEmitter, upload_history: history.UploadHistory
+) -> None:
     @emitter.on("upload_start")
     def upload_start(payload: uploader.Progress):
         md5sum = payload["md5sum"]
-        if is_uploaded(md5sum):
+        if is_uploaded(upload_history, md5sum):
             sequence_uuid = payload.get("sequence_uuid")
             if sequence_uuid is None:
                 basename = os.path.basename(payload.get("import_path", ""))
                 LOG.info(
-                    f"File {basename} has been uploaded already. Check the upload history at {_history_desc_path(md5sum)}"
+                    f"File {basename} has been uploaded already. Check the upload history {md5sum} in {upload_history.history_dir}"
                 )
             else:
                 LOG.info(
-                    f"Sequence {sequence_uuid} has been uploaded already. Check the upload history at {_history_desc_path(md5sum)}"
+                    f"Sequence {sequence_uuid} has been uploaded already. Check the upload history {md5sum} in {upload_history.history_dir}"
                 )
             raise uploader.UploadCancelled()
 
 
 def _setup_write_upload_history(
     emitter: uploader.EventEmitter,
+    upload_history: history.UploadHistory,
     params: T.Dict,
     descs: T.Optional[T.List[types.ImageDescriptionFile]] = None,
 ) -> None:
+    # Index the descs by sequence once instead of scanning all of them for every sequence
+    sequences: T.Dict[str, T.List[types.ImageDescriptionFile]] = {}
+    for desc in descs or []:
+        sequences.setdefault(desc.get("MAPSequenceUUID", ""), []).append(desc)
+    for sequence in sequences.values():
+        sequence.sort(
+            key=lambda d: types.map_capture_time_to_datetime(d["MAPCaptureTime"])
+        )
+
     @emitter.on("upload_finished")
     def upload_finished(payload: uploader.Progress):
         sequence_uuid = payload.get("sequence_uuid")
@@ -205,33 +221,44 @@ def _setup_write_upload_history(
         if sequence_uuid is None or descs is None:
             sequence = None
         else:
-            sequence = [
-                desc for desc in descs if desc.get("MAPSequenceUUID") == sequence_uuid
-            ]
-            sequence.sort(
-                key=lambda d: types.map_capture_time_to_datetime(d["MAPCaptureTime"])
-            )
+            sequence = sequences.get(sequence_uuid, [])
 
         try:
             write_history(
+                upload_history,
                 md5sum,
                 params,
                 T.cast(T.Dict, payload),
                 sequence,
             )
-        except OSError:
+        except (OSError, sqlite3.Error):
             LOG.warning(f"Error writing upload history {md5sum}", exc_info=True)
 
 
 def _setup_tdqm(emitter: uploader.EventEmitter) -> None:
-    upload_pbar: T.Optional[tqdm] = None
+    # One progress bar per upload session (keyed by md5sum) because
+    # sessions could be uploaded concurrently
+    upload_pbars: T.Dict[str, tqdm] = {}
+    positions: T.Dict[str, int] = {}
+
+    def _close_pbar(md5sum: str) -> None:
+        upload_pbar = upload_pbars.pop(md5sum, None)
+        if upload_pbar is not None:
+            upload_pbar.close()
+        positions.pop(md5sum, None)
 
     @emitter.on("upload_fetch_offset")
     def upload_fetch_offset(payload: uploader.Progress) -> None:
-        nonlocal upload_pbar
+        md5sum = payload["md5sum"]
 
-        if upload_pbar is not None:
-            upload_pbar.close()
+        _close_pbar(md5sum)
+
+        # Take the lowest free line on the terminal
+        used_positions = set(positions.values())
+        position = next(
+            idx for idx in range(len(used_positions) + 1) if idx not in used_positions
+        )
+        positions[md5sum] = position
 
         nth = payload["sequence_idx"] + 1
         total = payload["total_sequence_count"]
@@ -240,52 +267,52 @@ def _setup_tdqm(emitter: uploader.EventEmitter) -> None:
             _desc = f"Uploading ({nth}/{total})"
         else:
             _desc = f"Uploading {os.path.basename(import_path)} ({nth}/{total})"
-        upload_pbar = tqdm(
+        upload_pbars[md5sum] = tqdm(
             total=payload["entity_size"],
             desc=_desc,
             unit="B",
             unit_scale=True,
             unit_divisor=1024,
             initial=payload["offset"],
+            position=position,
             disable=LOG.getEffectiveLevel() <= logging.DEBUG,
         )
 
     @emitter.on("upload_progress")
     def upload_progress(payload: uploader.Progress) -> None:
+        upload_pbar = upload_pbars.get(payload["md5sum"])
         assert upload_pbar is not None, "progress_bar must be initialized"
         upload_pbar.update(payload["chunk_size"])
 
     @emitter.on("upload_end")
-    def upload_end(_: uploader.Progress) -> None:
-        nonlocal upload_pbar
-        if upload_pbar:
-            upload_pbar.close()
-        upload_pbar = None
+    def upload_end(payload: uploader.Progress) -> None:
+        _close_pbar(payload["md5sum"])
 
 
 def _setup_ipc(emitter: uploader.EventEmitter):
     @emitter.on("upload_start")
     def upload_start(payload: uploader.Progress):
         type: uploader.EventName = "upload_start"
-        LOG.debug(f"Sending {type} via IPC: {payload}")
+        LOG.debug("Sending %s via IPC: %s", type, payload)
         ipc.send(type, payload)
 
     @emitter.on("upload_fetch_offset")
     def upload_fetch_offset(payload: uploader.Progress) -> None:
         type: uploader.EventName = "upload_fetch_offset"
-        LOG.debug(f"Sending {type} via IPC: {payload}")
+        LOG.debug("Sending %s via IPC: %s", type, payload)
         ipc.send(type, payload)
 
-    @emitter.on("upload_progress")
+    # Chunks can be uploaded much faster than the app renders the progress
+    @emitter.on("upload_progress", max_rate=IPC_MAX_PROGRESS_RATE)
     def upload_progress(payload: uploader.Progress):
         type: uploader.EventName = "upload_progress"
-        LOG.debug(f"Sending {type} via IPC: {payload}")
-        ipc.send(type, payload)
+        LOG.debug("Sending %s via IPC: %s", type, payload)
+        ipc.send(type, payload, batch=True)
 
     @emitter.on("upload_end")
     def upload_end(payload: uploader.Progress) -> None:
         type: uploader.EventName = "upload_end"
-        LOG.debug(f"Sending {type} via IPC: {payload}")
+        LOG.debug("Sending %s via IPC: %s", type, payload)
         ipc.send(type, payload)
 
 
@@ -340,6 +367,31 @@ def _setup_api_stats(emitter: uploader.EventEmitter):
     return all_stats
 
 
+def _setup_telemetry(
+    emitter: uploader.EventEmitter, upload_telemetry: telemetry.UploadTelemetry
+) -> None:
+    @emitter.on("upload_fetch_offset")
+    def collect_fetch_offset(payload: uploader.Progress) -> None:
+        upload_telemetry.fetch_offset_seconds.observe(payload["fetch_offset_time"])
+
+    @emitter.on("upload_progress")
+    def collect_chunk(payload: uploader.Progress) -> None:
+        # Skip the empty chunk that requests the file handle
+        if payload["chunk_size"]:
+            upload_telemetry.observe_chunk(
+                payload["chunk_size"], payload["chunk_upload_time"]
+            )
+
+    @emitter.on("upload_interrupted")
+    def collect_retry(payload: uploader.Progress) -> None:
+        upload_telemetry.retries += 1
+        upload_telemetry.retry_wait_seconds.observe(payload["retry_wait_time"])
+
+    @emitter.on("upload_finished")
+    def collect_finished(payload: uploader.Progress) -> None:
+        upload_telemetry.sessions += 1
+
+
 def _summarize(stats: T.List[_APIStats]) -> T.Dict:
     total_image_count = sum(s.get("sequence_image_count", 0) for s in stats)
     total_uploaded_sequence_count = len(stats)
@@ -351,9 +403,13 @@ def _summarize(stats: T.List[_APIStats]) -> T.Dict:
     total_uploaded_size_mb = total_uploaded_size / (1024 * 1024)
 
     total_upload_time = sum(s["upload_total_time"] for s in stats)
-    try:
-        speed = total_uploaded_size_mb / total_upload_time
-    except ZeroDivisionError:
+    # The time waiting for the bandwidth limiter is not counted in the speed
+    total_throttled_time = sum(s.get("throttled_time", 0) for s in stats)
+    # Measured separately, so the difference might be zero or even negative
+    unthrottled_upload_time = total_upload_time - total_throttled_time
+    if 0 < unthrottled_upload_time:
+        speed = total_uploaded_size_mb / unthrottled_upload_time
+    else:
         speed = 0
 
     total_entity_size = sum(s["entity_size"] for s in stats)
@@ -366,6 +422,7 @@ def _summarize(stats: T.List[_APIStats]) -> T.Dict:
         "uploaded_size": round(total_uploaded_size_mb, 4),
         "speed": round(speed, 4),
         "time": round(total_upload_time, 4),
+        "throttled_time": round(total_throttled_time, 4),
     }
 
     return upload_summary
@@ -392,6 +449,8 @@ def _log_upload_summary(summary: T.Dict, file_type: FileType):
     LOG.info("%8.1fM data in total", summary["size"])
     LOG.info("%8.1fM data uploaded", summary["uploaded_size"])
     LOG.info("%8.1fs upload time", summary["time"])
+    if summary["throttled_time"]:
+        LOG.info("%8.1fs throttled by the upload rate limit", summary["throttled_time"])
 
 
 def _api_logging_finished(user_items: types.UserItem, summary: T.Dict):
@@ -452,6 +511,24 @@ def _join_desc_path(
     ]
 
 
+@contextlib.contextmanager
+def _open_upload_history(
+    dry_run: bool,
+) -> T.Generator[T.Optional[history.UploadHistory], None, None]:
+    enable_history = MAPILLARY_UPLOAD_HISTORY_PATH and (
+        not dry_run or MAPILLARY__ENABLE_UPLOAD_HISTORY_FOR_DRY_RUN == "YES"
+    )
+    if not enable_history:
+        yield None
+        return
+
+    with history.UploadHistory(
+        MAPILLARY_UPLOAD_HISTORY_PATH,
+        write_legacy=MAPILLARY_WRITE_LEGACY_UPLOAD_HISTORY == "YES",
+    ) as upload_history:
+        yield upload_history
+
+
 def upload_multiple(
     import_path: T.Union[T.List[str], str],
     file_type: FileType,
@@ -459,6 +536,20 @@ def upload_multiple(
     user_name: T.Optional[str] = None,
     organization_key: T.Optional[str] = None,
     dry_run=False,
+    upload_workers: int = 1,
+    zip_prefetch: int = 1,
+    zip_prefetch_max_size: T.Optional[float] = None,
+    zip_compression: uploader.ZipCompression = "auto",
+    zip_workers: int = 1,
+    zip_cache_dir: T.Optional[str] = None,
+    zip_cache_max_size: T.Optional[float] = None,
+    zip_cache_max_age: T.Optional[float] = constants.ZIP_CACHE_MAX_AGE_DAYS,
+    zip_stream: bool = True,
+    upload_rate_limit: T.Optional[float] = None,
+    upload_time_windows: T.Optional[str] = None,
+    upload_metrics_path: T.Optional[str] = None,
+    upload_engine: uploader.UploadEngine = "threads",
+    share_upload_rate_limit: bool = False,
 ):
     if isinstance(import_path, str):
         import_paths = [import_path]
@@ -473,19 +564,89 @@ def upload_multiple(
                 f"Import file or directory not found: {path}"
             )
 
+    try:
+        time_windows = (
+            None
+            if upload_time_windows is None
+            else upload_api_v4.parse_time_windows(upload_time_windows)
+        )
+        rate = None if upload_rate_limit is None else upload_rate_limit * 1024 * 1024
+        # One limiter for all the upload sessions in the process
+        bandwidth_limiter: T.Optional[upload_api_v4.BandwidthLimiter]
+        if rate is None and time_windows is None:
+            bandwidth_limiter = None
+        elif rate is not None and share_upload_rate_limit:
+            # ...or in all the processes on the host
+            bandwidth_limiter = upload_api_v4.SharedBandwidthLimiter(
+                constants.UPLOAD_BANDWIDTH_BUDGET_PATH,
+                rate=rate,
+                time_windows=time_windows,
+            )
+        else:
+            bandwidth_limiter = upload_api_v4.BandwidthLimiter(
+                rate=rate, time_windows=time_windows
+            )
+    except ValueError as ex:
+        raise exceptions.MapillaryBadParameterError(str(ex))
+
     user_items = fetch_user_items(user_name, organization_key)
 
+    upload_telemetry = (
+        None if upload_metrics_path is None else telemetry.UploadTelemetry()
+    )
+
     all_stats = []
-    for path in import_paths:
-        LOG.info("Uploading import path: %s", path)
-        stats = upload(
-            path,
-            file_type,
-            user_items,
-            desc_path=desc_path,
-            dry_run=dry_run,
-        )
-        all_stats.extend(stats)
+    # Shared by the import paths
+    with _open_upload_history(dry_run) as upload_history:
+        for path in import_paths:
+            LOG.info("Uploading import path: %s", path)
+            try:
+                stats = upload(
+                    path,
+                    file_type,
+                    user_items,
+                    desc_path=desc_path,
+                    dry_run=dry_run,
+                    upload_workers=upload_workers,
+                    zip_prefetch=zip_prefetch,
+                    zip_prefetch_max_size=(
+                        None
+                        if zip_prefetch_max_size is None
+                        else int(zip_prefetch_max_size * 1024 * 1024)
+                    ),
+                    zip_compression=zip_compression,
+                    zip_workers=zip_workers,
+                    zip_cache_dir=zip_cache_dir,
+                    zip_cache_max_size=(
+                        None
+                        if zip_cache_max_size is None
+                        else int(zip_cache_max_size * 1024 * 1024)
+                    ),
+                    zip_cache_max_age=(
+                        None
+                        if zip_cache_max_age is None
+                        else zip_cache_max_age * 24 * 3600
+                    ),
+                    zip_stream=zip_stream,
+                    bandwidth_limiter=bandwidth_limiter,
+                    upload_telemetry=upload_telemetry,
+                    upload_engine=upload_engine,
+                    upload_history=upload_history,
+                )
+            finally:
+                # Export what is collected so far even if it fails
+                if upload_telemetry is not None:
+                    assert upload_metrics_path is not None
+                    try:
+                        upload_telemetry.write(upload_metrics_path)
+                    except OSError:
+                        # Not to replace the upload error or fail the upload
+                        LOG.warning(
+                            "Failed to write the upload metrics to %s",
+                            upload_metrics_path,
+                            exc_info=True,
+                        )
+            all_stats.extend(stats)
 
     upload_summary = _summarize(all_stats)
     if all_stats:
@@ -517,44 +678,93 @@ def _check_blackvue(video_path: str) -> None:
 def _upload_blackvues(
     mly_uploader: uploader.Uploader, video_paths: T.List[str], stats: T.List[_APIStats]
 ):
-    for idx, video_path in enumerate(video_paths):
-        event_payload: uploader.Progress = {
+    def _event_payload(idx: int) -> uploader.Progress:
+        return {
             "total_sequence_count": len(video_paths),
             "sequence_idx": idx,
         }
+
+    # Check first so that only the videos to upload are hashed
+    items: T.List[T.Tuple[int, str]] = []
+    for idx, video_path in enumerate(video_paths):
         try:
             _check_blackvue(video_path)
         except Exception as ex:
             LOG.warning(f"Skipping due to: {ex}")
             continue
-        try:
-            cluster_id = mly_uploader.upload_blackvue(
-                video_path, event_payload=event_payload
+        items.append((idx, video_path))
+
+    def _upload_blackvue(item: T.Tuple[int, str]) -> T.Optional[str]:
+        idx, video_path = item
+        return mly_uploader.upload_blackvue(
+            video_path,
+            event_payload=_event_payload(idx),
+            upload_md5sum=upload_md5sums[video_path],
+        )
+
+    async def _upload_blackvue_async(
+        item: T.Tuple[int, str], client: async_http.AsyncHTTPClient
+    ) -> T.Optional[str]:
+        idx, video_path = item
+        return await mly_uploader.upload_blackvue_async(
+            video_path,
+            client,
+            event_payload=_event_payload(idx),
+            upload_md5sum=upload_md5sums[video_path],
+        )
+
+    try:
+        # Hash the videos in one batch to use all the hashing workers,
+        # and fail the upload if a video can not be read
+        upload_paths = [video_path for _, video_path in items]
+        upload_md5sums = dict(
+            zip(
+                upload_paths,
+                hashing.file_md5sums(
+                    upload_paths, max_workers=mly_uploader.zip_workers
+                ),
             )
-        except Exception as exc:
-            if not mly_uploader.dry_run:
-                _api_logging_failed(mly_uploader.user_items, _summarize(stats), exc)
-            raise
-        LOG.debug(f"Uploaded to cluster: {cluster_id}")
+        )
+        cluster_ids = mly_uploader.execute_sessions(
+            _upload_blackvue, _upload_blackvue_async, items
+        )
+    except Exception as exc:
+        if not mly_uploader.dry_run:
+            _api_logging_failed(mly_uploader.user_items, _summarize(stats), exc)
+        raise
+    LOG.debug(f"Uploaded to clusters: {cluster_ids}")
 
 
 def _upload_zipfiles(
     mly_uploader: uploader.Uploader, zip_paths: T.List[str], stats: T.List[_APIStats]
 ):
-    for idx, zip_path in enumerate(zip_paths):
-        event_payload: uploader.Progress = {
+    def _event_payload(idx: int) -> uploader.Progress:
+        return {
             "total_sequence_count": len(zip_paths),
             "sequence_idx": idx,
         }
-        try:
-            cluster_id = mly_uploader.upload_zipfile(
-                zip_path, event_payload=event_payload
-            )
-        except Exception as exc:
-            if not mly_uploader.dry_run:
-                _api_logging_failed(mly_uploader.user_items, _summarize(stats), exc)
-            raise
-        LOG.debug(f"Uploaded to cluster: {cluster_id}")
+
+    def _upload_zipfile(item: T.Tuple[int, str]) -> T.Optional[str]:
+        idx, zip_path = item
+        return mly_uploader.upload_zipfile(zip_path, event_payload=_event_payload(idx))
+
+    async def _upload_zipfile_async(
+        item: T.Tuple[int, str], client: async_http.AsyncHTTPClient
+    ) -> T.Optional[str]:
+        idx, zip_path = item
+        return await mly_uploader.upload_zipfile_async(
+            zip_path, client, event_payload=_event_payload(idx)
+        )
+
+    try:
+        cluster_ids = mly_uploader.execute_sessions(
+            _upload_zipfile, _upload_zipfile_async, enumerate(zip_paths)
+        )
+    except Exception as exc:
+        if not mly_uploader.dry_run:
+            _api_logging_failed(mly_uploader.user_items, _summarize(stats), exc)
+        raise
+    LOG.debug(f"Uploaded to clusters: {cluster_ids}")
 
 
 def _upload_images(
@@ -578,18 +788,27 @@ def upload(
     user_items: types.UserItem,
     desc_path: T.Optional[str] = None,
     dry_run=False,
+    upload_workers: int = 1,
+    zip_prefetch: int = 1,
+    zip_prefetch_max_size: T.Optional[int] = None,
+    zip_compression: uploader.ZipCompression = "auto",
+    zip_workers: int = 1,
+    zip_cache_dir: T.Optional[str] = None,
+    zip_cache_max_size: T.Optional[int] = None,
+    zip_cache_max_age: T.Optional[float] = constants.ZIP_CACHE_MAX_AGE_DAYS * 24 * 3600,
+    zip_stream: bool = True,
+    bandwidth_limiter: T.Optional[upload_api_v4.BandwidthLimiter] = None,
+    upload_telemetry: T.Optional[telemetry.UploadTelemetry] = None,
+    upload_engine: uploader.UploadEngine = "threads",
+    upload_history: T.Optional[history.UploadHistory] = None,
 ) -> T.List[_APIStats]:
     emitter = uploader.EventEmitter()
 
     # Setup the emitter -- the order matters here
 
-    enable_history = MAPILLARY_UPLOAD_HISTORY_PATH and (
-        not dry_run or MAPILLARY__ENABLE_UPLOAD_HISTORY_FOR_DRY_RUN == "YES"
-    )
-
     # Put it first one to cancel early
-    if enable_history:
-        _setup_cancel_due_to_duplication(emitter)
+    if upload_history is not None:
+        _setup_cancel_due_to_duplication(emitter, upload_history)
 
     # This one set up tdqm
     _setup_tdqm(emitter)
@@ -600,6 +819,9 @@ def upload(
     # Send the progress as well as the log stats collected above
     _setup_ipc(emitter)
 
+    if upload_telemetry is not None:
+        _setup_telemetry(emitter, upload_telemetry)
+
     params = {
         "import_path": import_path,
         "desc_path": desc_path,
@@ -623,10 +845,34 @@ def upload(
     else:
         descs = []
 
-    if enable_history:
-        _setup_write_upload_history(emitter, params, descs)
-
-    mly_uploader = uploader.Uploader(user_items, emitter=emitter, dry_run=dry_run)
+    if upload_history is not None:
+        _setup_write_upload_history(emitter, upload_history, params, descs)
+
+    mly_uploader = uploader.Uploader(
+        user_items,
+        emitter=emitter,
+        dry_run=dry_run,
+        upload_workers=upload_workers,
+        zip_prefetch=zip_prefetch,
+        zip_prefetch_max_size=zip_prefetch_max_size,
+        zip_compression=zip_compression,
+        zip_workers=zip_workers,
+        zip_cache=(
+            None
+            if zip_cache_dir is None
+            else uploader.SequenceZipCache(
+                zip_cache_dir, max_size=zip_cache_max_size, max_age=zip_cache_max_age
+            )
+        ),
+        uploaded_md5sums=(
+            None
+            if upload_history is None
+            else functools.partial(uploaded_md5sums, upload_history)
+        ),
+        zip_stream=zip_stream,
+        bandwidth_limiter=bandwidth_limiter,
+        upload_engine=upload_engine,
+    )
 
     if os.path.isfile(import_path):
         _, ext = os.path.splitext(import_path)
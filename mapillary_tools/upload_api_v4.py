@@ -1,6 +1,12 @@
+import asyncio
+import datetime
 import io
+import json
+import logging
 import os
 import sys
+import threading
+import time
 import typing as T
 
 import requests
@@ -10,8 +16,10 @@ if sys.version_info >= (3, 8):
 else:
     from typing_extensions import Literal
 
+from . import api_v4, async_http, file_lock
 from .api_v4 import MAPILLARY_GRAPH_API_ENDPOINT
 
+LOG = logging.getLogger(__name__)
 MAPILLARY_UPLOAD_ENDPOINT = os.getenv(
     "MAPILLARY_UPLOAD_ENDPOINT", "https://rupload.facebook.com/mapillary_public_uploads"
 )
@@ -25,9 +33,13 @@ REQUESTS_TIMEOUT = 60  # 1 minutes
 # ConnectionError: ('Connection aborted.', timeout('The write operation timed out'))
 # so make sure the largest possible chunks can be uploaded before this timeout
 UPLOAD_REQUESTS_TIMEOUT = 10 * 60  # 10 minutes
+# The adaptive chunk size aims at uploading a chunk in this time,
+# which keeps the chunks far below UPLOAD_REQUESTS_TIMEOUT
+TARGET_CHUNK_UPLOAD_TIME = 10  # 10 seconds
 
 
 FileType = Literal["zip", "mly_blackvue_video"]
+_R = T.TypeVar("_R")
 
 
 class UploadHTTPError(Exception):
@@ -44,13 +56,358 @@ def wrap_http_exception(ex: requests.HTTPError):
     return UploadHTTPError("\n".join(lines))
 
 
+class ChunkSizeController:
+    """
+    Adapt the chunk size to the network: grow it towards the size that can be uploaded
+    in TARGET_CHUNK_UPLOAD_TIME at the measured throughput, and halve it on every failure
+    so that less data is retransmitted on flaky networks.
+
+    The throughput excludes the waits for the bandwidth limiter, so with max_rate (the rate of the limiter)
+    the chunk size is also capped to what can be sent in the target time at that rate
+    """
+
+    chunk_size: int
+
+    def __init__(
+        self,
+        chunk_size: int,
+        min_chunk_size: int,
+        max_chunk_size: int,
+        target_time: float = TARGET_CHUNK_UPLOAD_TIME,
+        max_rate: T.Optional[float] = None,
+    ):
+        if not (0 < min_chunk_size <= max_chunk_size):
+            raise ValueError(
+                f"Invalid chunk size range [{min_chunk_size}, {max_chunk_size}]"
+            )
+        if max_rate is not None:
+            max_chunk_size = max(
+                min_chunk_size, min(max_chunk_size, int(max_rate * target_time))
+            )
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.target_time = target_time
+        self.chunk_size = self._clamp(chunk_size)
+        # Exponential moving average of the throughput in bytes per second
+        self.throughput: T.Optional[float] = None
+
+    def _clamp(self, chunk_size: int) -> int:
+        return min(max(chunk_size, self.min_chunk_size), self.max_chunk_size)
+
+    def record_success(self, size: int, elapsed: float) -> None:
+        # Small chunks (e.g. the last one) are dominated by the latency
+        # and would underestimate the throughput
+        if elapsed <= 0 or size < self.chunk_size // 2:
+            return
+        throughput = size / elapsed
+        if self.throughput is None:
+            self.throughput = throughput
+        else:
+            self.throughput = 0.5 * self.throughput + 0.5 * throughput
+        target_size = int(self.throughput * self.target_time)
+        # Grow at most 2x at a time in case of a noisy measurement
+        self.chunk_size = self._clamp(min(target_size, self.chunk_size * 2))
+
+    def record_failure(self) -> None:
+        self.chunk_size = self._clamp(self.chunk_size // 2)
+
+
+# (start, end) of the time of day. It wraps around midnight if end <= start
+TimeWindow = T.Tuple[datetime.time, datetime.time]
+
+
+def parse_time_windows(windows: str) -> T.List[TimeWindow]:
+    """
+    Parse time windows like "22:00-06:00,12:00-13:30"
+
+    >>> parse_time_windows("22:00-06:00, 12:00-13:30")
+    [(datetime.time(22, 0), datetime.time(6, 0)), (datetime.time(12, 0), datetime.time(13, 30))]
+    """
+    parsed = []
+    for window in windows.split(","):
+        try:
+            start, end = window.strip().split("-")
+            parsed.append(
+                (
+                    datetime.datetime.strptime(start.strip(), "%H:%M").time(),
+                    datetime.datetime.strptime(end.strip(), "%H:%M").time(),
+                )
+            )
+        except ValueError:
+            raise ValueError(f'Invalid time window "{window}". Expect "HH:MM-HH:MM"')
+    return parsed
+
+
+class BandwidthLimiter:
+    """
+    Limit the total upload rate of all the sessions sharing the limiter with a token bucket,
+    and pause uploading outside the time windows (in local time) if specified
+    """
+
+    def __init__(
+        self,
+        rate: T.Optional[float] = None,
+        time_windows: T.Optional[T.List[TimeWindow]] = None,
+    ):
+        if rate is not None and rate <= 0:
+            raise ValueError(f"Expect positive upload rate but got {rate}")
+        # Bytes per second
+        self.rate = rate
+        self.time_windows = time_windows or []
+        # Allow bursts of up to one second worth of bytes
+        self._tokens = 0.0 if rate is None else rate
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def seconds_until_window(self, now: datetime.datetime) -> float:
+        if not self.time_windows:
+            return 0
+
+        time_of_day = now.time()
+        for start, end in self.time_windows:
+            if start < end:
+                if start <= time_of_day < end:
+                    return 0
+            else:
+                if start <= time_of_day or time_of_day < end:
+                    return 0
+
+        waits = []
+        for start, _ in self.time_windows:
+            start_at = datetime.datetime.combine(now.date(), start)
+            if start_at <= now:
+                start_at += datetime.timedelta(days=1)
+            waits.append((start_at - now).total_seconds())
+        return min(waits)
+
+    def wait_for_window(self) -> float:
+        """
+        Wait until the current time is in any time window, and return the seconds waited.
+        """
+        waited = 0.0
+        while True:
+            wait = self.seconds_until_window(datetime.datetime.now())
+            if wait <= 0:
+                return waited
+            # Sleep in steps to follow the clock changes, e.g. daylight saving time
+            wait = min(wait, 60)
+            time.sleep(wait)
+            waited += wait
+
+    async def wait_for_window_async(self) -> float:
+        """
+        Same as wait_for_window() but without blocking the event loop.
+        """
+        waited = 0.0
+        while True:
+            wait = self.seconds_until_window(datetime.datetime.now())
+            if wait <= 0:
+                return waited
+            wait = min(wait, 60)
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def reserve(self, size: int) -> float:
+        """
+        Take the size of bytes from the bucket, and return the seconds to wait before sending them.
+        """
+        if self.rate is None or size <= 0:
+            return 0
+
+        with self._lock:
+            return self._take_tokens(size)
+
+    def _take_tokens(self, size: float) -> float:
+        # Called with the lock held
+        assert self.rate is not None
+        now = time.monotonic()
+        self._tokens = min(
+            self.rate, self._tokens + (now - self._last_refill) * self.rate
+        )
+        self._last_refill = now
+        # Go into debt so that the concurrent callers queue up behind this one
+        self._tokens -= size
+        return -self._tokens / self.rate if self._tokens < 0 else 0
+
+    def acquire(self, size: int) -> float:
+        """
+        Wait until the size of bytes can be sent at the rate, and return the seconds waited.
+        """
+        wait = self.reserve(size)
+        if 0 < wait:
+            time.sleep(wait)
+        return wait
+
+
+class SharedBandwidthLimiter(BandwidthLimiter):
+    """
+    Share the token bucket with the limiters of the other processes on the host through a JSON file,
+    so that the total upload rate of the processes is limited. The processes should use the same rate.
+
+    To update the file less often, tokens are taken from the shared bucket in leases
+    of at least LEASE_SECONDS worth of bytes, and the unused ones are kept locally.
+    If the file is not accessible, it falls back to limiting this process only.
+    """
+
+    LEASE_SECONDS = 0.1
+
+    def __init__(
+        self,
+        budget_path: str,
+        rate: T.Optional[float] = None,
+        time_windows: T.Optional[T.List[TimeWindow]] = None,
+    ):
+        super().__init__(rate=rate, time_windows=time_windows)
+        self.budget_path = budget_path
+        self._leased = 0.0
+        self._shared = True
+
+    def _reserve_shared(self, size: float) -> float:
+        assert self.rate is not None
+        with file_lock.FileLock(self.budget_path) as lock:
+            with os.fdopen(os.dup(lock.fd), "r+") as fp:
+                content = fp.read()
+                now = time.time()
+                try:
+                    budget = json.loads(content)
+                except ValueError:
+                    # Empty or torn by a crash while writing
+                    budget = {}
+                tokens = budget.get("tokens", self.rate)
+                updated_at = budget.get("updated_at", now)
+                # Wall clock time since the bucket is shared by processes
+                tokens = min(self.rate, tokens + max(now - updated_at, 0) * self.rate)
+                tokens -= size
+                fp.seek(0)
+                fp.truncate()
+                json.dump({"tokens": tokens, "updated_at": now}, fp)
+        return -tokens / self.rate if tokens < 0 else 0
+
+    def reserve(self, size: int) -> float:
+        if self.rate is None or size <= 0:
+            return 0
+
+        with self._lock:
+            if not self._shared:
+                return self._take_tokens(size)
+            if size <= self._leased:
+                self._leased -= size
+                return 0
+            lease = max(size - self._leased, self.rate * self.LEASE_SECONDS)
+            try:
+                wait = self._reserve_shared(lease)
+            except OSError:
+                LOG.warning(
+                    "Limiting the upload rate of this process only because the bandwidth budget %s is not accessible",
+                    self.budget_path,
+                    exc_info=True,
+                )
+                self._shared = False
+                return self._take_tokens(size)
+            self._leased += lease - size
+            return wait
+
+
+class _ThrottledChunk:
+    """
+    A file-like chunk that requests sends block by block, and each block waits for the limiter
+    """
+
+    def __init__(self, chunk: T.Union[bytes, memoryview], limiter: BandwidthLimiter):
+        self._view = memoryview(chunk)
+        self._offset = 0
+        self._limiter = limiter
+        self.throttled_time = 0.0
+
+    def __len__(self) -> int:
+        return len(self._view)
+
+    def read(self, size: int = -1) -> memoryview:
+        if size < 0:
+            size = len(self._view) - self._offset
+        block = self._view[self._offset : self._offset + size]
+        self._offset += len(block)
+        self.throttled_time += self._limiter.acquire(len(block))
+        return block
+
+
+class ChunkReader:
+    """
+    Read chunks into a reusable buffer with readinto() instead of allocating
+    a new bytes object for every chunk. A chunk returned is a view of the buffer,
+    so it is valid only until the next read
+    """
+
+    def __init__(self, data: T.IO[bytes]):
+        self._data = data
+        self._buf = bytearray()
+
+    def read(self, size: int) -> T.Union[bytes, memoryview]:
+        readinto = getattr(self._data, "readinto", None)
+        if readinto is None:
+            return self._data.read(size)
+
+        # Replace (instead of resizing) the buffer because views of the old one could be alive
+        if len(self._buf) < size:
+            self._buf = bytearray(size)
+
+        view = memoryview(self._buf)[:size]
+        total = 0
+        while total < size:
+            n = readinto(view[total:])
+            if not n:
+                break
+            total += n
+
+        # requests sends an empty memoryview with chunked transfer encoding,
+        # so send empty bytes instead
+        if not total:
+            return b""
+
+        return view[:total]
+
+
+# The operations yielded by UploadService.upload_steps() for the engines to run
+
+
+class FetchOffset(T.NamedTuple):
+    pass
+
+
+class UploadChunk(T.NamedTuple):
+    chunk: T.Union[bytes, memoryview]
+    offset: int
+
+
+class Finish(T.NamedTuple):
+    file_handle: str
+
+
+class WaitForWindow(T.NamedTuple):
+    pass
+
+
+class Sleep(T.NamedTuple):
+    seconds: float
+
+
+Operation = T.Union[FetchOffset, UploadChunk, Finish, WaitForWindow, Sleep]
+
+
 class UploadService:
     user_access_token: str
     entity_size: int
     session_key: str
-    callbacks: T.List[T.Callable[[bytes, T.Optional[requests.Response]], None]]
+    # The chunk is a bytes-like object that is valid only during the callback
+    callbacks: T.List[
+        T.Callable[[T.Union[bytes, memoryview], T.Optional[requests.Response]], None]
+    ]
     file_type: FileType
     organization_id: T.Optional[T.Union[str, int]]
+    session: requests.Session
+    bandwidth_limiter: T.Optional[BandwidthLimiter]
+    throttled_time: float
+    last_chunk_upload_time: float
 
     def __init__(
         self,
@@ -59,6 +416,8 @@ class UploadService:
         entity_size: int,
         organization_id: T.Optional[T.Union[str, int]] = None,
         file_type: FileType = "zip",
+        session: T.Optional[requests.Session] = None,
+        bandwidth_limiter: T.Optional[BandwidthLimiter] = None,
     ):
         if entity_size <= 0:
             raise ValueError(f"Expect positive entity size but got {entity_size}")
@@ -72,12 +431,19 @@ class UploadService:
         self.organization_id = organization_id
         self.file_type = T.cast(FileType, file_type.lower())
         self.callbacks = []
+        # Reuse the connections across chunks and upload sessions
+        self.session = api_v4.SESSION if session is None else session
+        self.bandwidth_limiter = bandwidth_limiter
+        # Seconds spent waiting for the bandwidth limiter
+        self.throttled_time = 0.0
+        # Seconds taken to upload the last chunk, i.e. the request round trip
+        self.last_chunk_upload_time = 0.0
 
     def fetch_offset(self) -> int:
         headers = {
             "Authorization": f"OAuth {self.user_access_token}",
         }
-        resp = requests.get(
+        resp = self.session.get(
             f"{MAPILLARY_UPLOAD_ENDPOINT}/{self.session_key}",
             headers=headers,
             timeout=REQUESTS_TIMEOUT,
@@ -86,45 +452,100 @@ class UploadService:
         data = resp.json()
         return data["offset"]
 
-    def upload(
+    def upload_chunk_headers(self, offset: int) -> T.Dict[str, str]:
+        entity_type_map: T.Dict[FileType, str] = {
+            "zip": "application/zip",
+            "mly_blackvue_video": "video/mp4",
+        }
+
+        return {
+            "Authorization": f"OAuth {self.user_access_token}",
+            "Offset": f"{offset}",
+            "X-Entity-Length": str(self.entity_size),
+            "X-Entity-Name": self.session_key,
+            "X-Entity-Type": entity_type_map[self.file_type],
+        }
+
+    def upload_chunk(
+        self, chunk: T.Union[bytes, memoryview], offset: int, throttle: bool = True
+    ) -> T.Optional[requests.Response]:
+        """
+        Upload the chunk at the offset and return the response. The chunk is sent at the rate
+        of the bandwidth limiter if throttle is enabled.
+        """
+        headers = self.upload_chunk_headers(offset)
+        body: T.Union[bytes, memoryview, _ThrottledChunk]
+        if throttle and self.bandwidth_limiter is not None and chunk:
+            body = _ThrottledChunk(chunk, self.bandwidth_limiter)
+        else:
+            body = chunk
+        start_time = time.monotonic()
+        chunk_throttled_time = 0.0
+        try:
+            resp = self.session.post(
+                f"{MAPILLARY_UPLOAD_ENDPOINT}/{self.session_key}",
+                headers=headers,
+                # requests sends bytes-like objects (memoryview) as they are without copying
+                data=T.cast(bytes, body),
+                timeout=UPLOAD_REQUESTS_TIMEOUT,
+            )
+        finally:
+            if isinstance(body, _ThrottledChunk):
+                chunk_throttled_time = body.throttled_time
+                self.throttled_time += chunk_throttled_time
+        resp.raise_for_status()
+        # Exclude the waits for the limiter, so that the chunk size adapts to the network only
+        self.last_chunk_upload_time = max(
+            0.0, time.monotonic() - start_time - chunk_throttled_time
+        )
+        return resp
+
+    def file_handle(self, resp: T.Optional[requests.Response]) -> str:
+        """
+        Return the file handle from the response of the last (empty) chunk.
+        """
+        assert resp is not None
+        payload = resp.json()
+        try:
+            return payload["h"]
+        except KeyError:
+            raise RuntimeError(
+                f"Upload server error: File handle not found in the upload response {resp.text}"
+            )
+
+    def upload_steps(
         self,
         data: T.IO[bytes],
         offset: T.Optional[int] = None,
         chunk_size: int = DEFAULT_CHUNK_SIZE,
-    ) -> str:
+        chunk_size_controller: T.Optional[ChunkSizeController] = None,
+    ) -> T.Generator[Operation, T.Any, str]:
+        """
+        Upload the data in steps: yield the operations for the engine to run, and receive their results.
+        It is shared by the engines (see run() and AsyncUploadService.run()), and returns the file handle.
+        """
         if chunk_size <= 0:
             raise ValueError("Expect positive chunk size")
 
         if offset is None:
-            offset = self.fetch_offset()
-
-        entity_type_map: T.Dict[FileType, str] = {
-            "zip": "application/zip",
-            "mly_blackvue_video": "video/mp4",
-        }
-
-        entity_type = entity_type_map[self.file_type]
+            offset = yield FetchOffset()
 
         data.seek(offset, io.SEEK_CUR)
+        reader = ChunkReader(data)
 
         while True:
-            chunk = data.read(chunk_size)
+            if self.bandwidth_limiter is not None:
+                yield WaitForWindow()
+            if chunk_size_controller is not None:
+                chunk_size = chunk_size_controller.chunk_size
+            chunk = reader.read(chunk_size)
             # it is possible to upload an empty chunk here
             # in order to return the handle
-            headers = {
-                "Authorization": f"OAuth {self.user_access_token}",
-                "Offset": f"{offset}",
-                "X-Entity-Length": str(self.entity_size),
-                "X-Entity-Name": self.session_key,
-                "X-Entity-Type": entity_type,
-            }
-            resp = requests.post(
-                f"{MAPILLARY_UPLOAD_ENDPOINT}/{self.session_key}",
-                headers=headers,
-                data=chunk,
-                timeout=UPLOAD_REQUESTS_TIMEOUT,
-            )
-            resp.raise_for_status()
+            resp = yield UploadChunk(chunk, offset)
+            if chunk_size_controller is not None and chunk:
+                chunk_size_controller.record_success(
+                    len(chunk), self.last_chunk_upload_time
+                )
             offset += len(chunk)
             for callback in self.callbacks:
                 callback(chunk, resp)
@@ -138,34 +559,90 @@ class UploadService:
             offset == self.entity_size
         ), f"Offset ends at {offset} but the entity size is {self.entity_size}"
 
-        payload = resp.json()
-        try:
-            return payload["h"]
-        except KeyError:
-            raise RuntimeError(
-                f"Upload server error: File handle not found in the upload response {resp.text}"
+        return self.file_handle(resp)
+
+    def upload(
+        self,
+        data: T.IO[bytes],
+        offset: T.Optional[int] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        chunk_size_controller: T.Optional[ChunkSizeController] = None,
+    ) -> str:
+        return self.run(
+            self.upload_steps(
+                data,
+                offset=offset,
+                chunk_size=chunk_size,
+                chunk_size_controller=chunk_size_controller,
             )
+        )
 
-    def finish(self, file_handle: str) -> str:
-        headers = {
-            "Authorization": f"OAuth {self.user_access_token}",
-        }
+    def run_operation(self, operation: Operation) -> T.Any:
+        if isinstance(operation, FetchOffset):
+            return self.fetch_offset()
+        elif isinstance(operation, UploadChunk):
+            return self.upload_chunk(operation.chunk, operation.offset)
+        elif isinstance(operation, Finish):
+            return self.finish(operation.file_handle)
+        elif isinstance(operation, WaitForWindow):
+            assert self.bandwidth_limiter is not None
+            self.throttled_time += self.bandwidth_limiter.wait_for_window()
+            return None
+        elif isinstance(operation, Sleep):
+            time.sleep(operation.seconds)
+            return None
+        else:
+            raise ValueError(f"Invalid operation {operation}")
+
+    def run(self, steps: T.Generator[Operation, T.Any, _R]) -> _R:
+        """
+        Run the operations of the steps in this thread, and return the result of the steps.
+        The errors of the operations are raised into the steps.
+        """
+        result: T.Any = None
+        error: T.Optional[Exception] = None
+        while True:
+            try:
+                if error is None:
+                    operation = steps.send(result)
+                else:
+                    operation = steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = self.run_operation(operation), None
+            except Exception as ex:
+                result, error = None, ex
+
+    def finish_data(self, file_handle: str) -> T.Dict[str, T.Union[str, int]]:
         data: T.Dict[str, T.Union[str, int]] = {
             "file_handle": file_handle,
             "file_type": self.file_type,
         }
         if self.organization_id is not None:
             data["organization_id"] = self.organization_id
+        return data
+
+    def finish(self, file_handle: str) -> str:
+        headers = {
+            "Authorization": f"OAuth {self.user_access_token}",
+        }
 
-        resp = requests.post(
+        resp = self.session.post(
             f"{MAPILLARY_GRAPH_API_ENDPOINT}/finish_upload",
             headers=headers,
-            json=data,
+            json=self.finish_data(file_handle),
             timeout=REQUESTS_TIMEOUT,
         )
 
         resp.raise_for_status()
 
+        return self.cluster_id(resp)
+
+    def cluster_id(self, resp: requests.Response) -> str:
+        """
+        Return the cluster ID from the response of finish_upload.
+        """
         data = resp.json()
 
         cluster_id = data.get("cluster_id")
@@ -189,35 +666,32 @@ class FakeUploadService(UploadService):
         )
         self._error_ratio = 0.2
 
-    def upload(
-        self,
-        data: T.IO[bytes],
-        offset: T.Optional[int] = None,
-        chunk_size: int = DEFAULT_CHUNK_SIZE,
-    ) -> str:
-        if offset is None:
-            offset = self.fetch_offset()
+    def upload_chunk(
+        self, chunk: T.Union[bytes, memoryview], offset: int, throttle: bool = True
+    ) -> T.Optional[requests.Response]:
+        if not chunk:
+            return None
+        if throttle and self.bandwidth_limiter is not None:
+            self.throttled_time += self.bandwidth_limiter.acquire(len(chunk))
+        # fail here means nothing uploaded
+        if random.random() <= self._error_ratio:
+            raise requests.ConnectionError(
+                f"TEST ONLY: Failed to upload with error ratio {self._error_ratio}"
+            )
         os.makedirs(self._upload_path, exist_ok=True)
         filename = os.path.join(self._upload_path, self.session_key)
+        start_time = time.monotonic()
         with open(filename, "ab") as fp:
-            data.seek(offset, io.SEEK_CUR)
-            while True:
-                chunk = data.read(chunk_size)
-                if not chunk:
-                    break
-                # fail here means nothing uploaded
-                if random.random() <= self._error_ratio:
-                    raise requests.ConnectionError(
-                        f"TEST ONLY: Failed to upload with error ratio {self._error_ratio}"
-                    )
-                fp.write(chunk)
-                # fail here means patially uploaded
-                if random.random() <= self._error_ratio:
-                    raise requests.ConnectionError(
-                        f"TEST ONLY: Partially uploaded with error ratio {self._error_ratio}"
-                    )
-                for callback in self.callbacks:
-                    callback(chunk, None)
+            fp.write(chunk)
+        self.last_chunk_upload_time = time.monotonic() - start_time
+        # fail here means patially uploaded
+        if random.random() <= self._error_ratio:
+            raise requests.ConnectionError(
+                f"TEST ONLY: Partially uploaded with error ratio {self._error_ratio}"
+            )
+        return None
+
+    def file_handle(self, resp: T.Optional[requests.Response]) -> str:
         return self.session_key
 
     def finish(self, _: str) -> str:
@@ -236,6 +710,164 @@ class FakeUploadService(UploadService):
             return fp.tell()
 
 
+class AsyncUploadService:
+    """
+    Run the upload steps of an UploadService on an asyncio event loop, so that many sessions are
+    multiplexed on one loop. The requests are sent with the non-blocking AsyncHTTPClient,
+    so waiting for the network, the time windows and the bandwidth limiter holds no thread.
+    The chunks are read and the callbacks are called on the loop.
+    """
+
+    def __init__(self, service: UploadService, client: async_http.AsyncHTTPClient):
+        self.service = service
+        self.client = client
+        # Seconds waited for the limiter while sending the current chunk
+        self._chunk_throttled_time = 0.0
+
+    async def fetch_offset(self) -> int:
+        service = self.service
+        resp = await self.client.request(
+            "GET",
+            f"{MAPILLARY_UPLOAD_ENDPOINT}/{service.session_key}",
+            headers={"Authorization": f"OAuth {service.user_access_token}"},
+            timeout=REQUESTS_TIMEOUT,
+        )
+        resp.raise_for_status()
+        return resp.json()["offset"]
+
+    async def _throttle(self, size: int) -> None:
+        assert self.service.bandwidth_limiter is not None
+        wait = self.service.bandwidth_limiter.reserve(size)
+        if 0 < wait:
+            await asyncio.sleep(wait)
+            self._chunk_throttled_time += wait
+
+    async def upload_chunk(
+        self, chunk: T.Union[bytes, memoryview], offset: int
+    ) -> T.Optional[requests.Response]:
+        service = self.service
+        self._chunk_throttled_time = 0.0
+        start_time = time.monotonic()
+        try:
+            resp = await self.client.request(
+                "POST",
+                f"{MAPILLARY_UPLOAD_ENDPOINT}/{service.session_key}",
+                headers=service.upload_chunk_headers(offset),
+                data=chunk,
+                timeout=UPLOAD_REQUESTS_TIMEOUT,
+                throttle=None if service.bandwidth_limiter is None else self._throttle,
+            )
+        finally:
+            service.throttled_time += self._chunk_throttled_time
+        resp.raise_for_status()
+        service.last_chunk_upload_time = max(
+            0.0, time.monotonic() - start_time - self._chunk_throttled_time
+        )
+        return resp
+
+    async def finish(self, file_handle: str) -> str:
+        service = self.service
+        resp = await self.client.request(
+            "POST",
+            f"{MAPILLARY_GRAPH_API_ENDPOINT}/finish_upload",
+            headers={"Authorization": f"OAuth {service.user_access_token}"},
+            json_data=service.finish_data(file_handle),
+            timeout=REQUESTS_TIMEOUT,
+        )
+        resp.raise_for_status()
+        return service.cluster_id(resp)
+
+    async def run_operation(self, operation: Operation) -> T.Any:
+        if isinstance(operation, FetchOffset):
+            return await self.fetch_offset()
+        elif isinstance(operation, UploadChunk):
+            return await self.upload_chunk(operation.chunk, operation.offset)
+        elif isinstance(operation, Finish):
+            return await self.finish(operation.file_handle)
+        elif isinstance(operation, WaitForWindow):
+            assert self.service.bandwidth_limiter is not None
+            waited = await self.service.bandwidth_limiter.wait_for_window_async()
+            self.service.throttled_time += waited
+            return None
+        elif isinstance(operation, Sleep):
+            await asyncio.sleep(operation.seconds)
+            return None
+        else:
+            raise ValueError(f"Invalid operation {operation}")
+
+    async def run(self, steps: T.Generator[Operation, T.Any, _R]) -> _R:
+        """
+        Same as UploadService.run() but await the operations on the event loop.
+        """
+        result: T.Any = None
+        error: T.Optional[Exception] = None
+        while True:
+            try:
+                if error is None:
+                    operation = steps.send(result)
+                else:
+                    operation = steps.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                result, error = await self.run_operation(operation), None
+            except asyncio.CancelledError:
+                # Cancel the session instead of handling it as a failed operation
+                steps.close()
+                raise
+            except Exception as ex:
+                result, error = None, ex
+
+    async def upload(
+        self,
+        data: T.IO[bytes],
+        offset: T.Optional[int] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        chunk_size_controller: T.Optional[ChunkSizeController] = None,
+    ) -> str:
+        return await self.run(
+            self.service.upload_steps(
+                data,
+                offset=offset,
+                chunk_size=chunk_size,
+                chunk_size_controller=chunk_size_controller,
+            )
+        )
+
+
+class AsyncFakeUploadService(AsyncUploadService):
+    """
+    Run the steps of a FakeUploadService on the event loop. Its operations write local files only,
+    so they run on the loop directly, except the waits for the limiter.
+    """
+
+    async def fetch_offset(self) -> int:
+        return self.service.fetch_offset()
+
+    async def upload_chunk(
+        self, chunk: T.Union[bytes, memoryview], offset: int
+    ) -> T.Optional[requests.Response]:
+        limiter = self.service.bandwidth_limiter
+        if limiter is not None and chunk:
+            wait = limiter.reserve(len(chunk))
+            if 0 < wait:
+                await asyncio.sleep(wait)
+                self.service.throttled_time += wait
+        return self.service.upload_chunk(chunk, offset, throttle=False)
+
+    async def finish(self, file_handle: str) -> str:
+        return self.service.finish(file_handle)
+
+
+def create_async_upload_service(
+    service: UploadService, client: async_http.AsyncHTTPClient
+) -> AsyncUploadService:
+    if isinstance(service, FakeUploadService):
+        return AsyncFakeUploadService(service, client)
+    else:
+        return AsyncUploadService(service, client)
+
+
 def _file_stats(fp: T.IO[bytes]):
     md5 = hashlib.md5()
     while True:
@@ -1,13 +1,20 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import functools
 import io
 import json
 import logging
+import math
 import os
 import sys
 import tempfile
+import threading
 
 import time
 import typing as T
 import uuid
+import weakref
 import zipfile
 
 import jsonschema
@@ -19,13 +26,43 @@ if sys.version_info >= (3, 8):
 else:
     from typing_extensions import Literal
 
-from . import exif_write, types, upload_api_v4, utils
+from . import (
+    async_http,
+    constants,
+    exceptions,
+    exif_write,
+    file_hash_cache,
+    file_lock,
+    hashing,
+    types,
+    upload_api_v4,
+    utils,
+    zip_stream,
+)
 
 
 MIN_CHUNK_SIZE = 1024 * 1024  # 1MB
 MAX_CHUNK_SIZE = 1024 * 1024 * 16  # 16MB
+MAX_RETRIES = 200
 LOG = logging.getLogger(__name__)
 
+# How zip entries are compressed:
+# "auto": store the entries that are compressed already (e.g. JPEG) and deflate the others (e.g. TIFF)
+# "stored": store all entries
+# "deflated": deflate all entries
+ZipCompression = Literal["auto", "stored", "deflated"]
+# How the upload sessions run:
+# "threads": each session runs in a thread
+# "asyncio": all sessions are multiplexed on one event loop, and their requests are non-blocking
+UploadEngine = Literal["threads", "asyncio"]
+# Magic numbers of the entropy-coded formats that deflate can hardly compress
+_COMPRESSED_IMAGE_SIGNATURES = [
+    # JPEG
+    b"\xff\xd8\xff",
+    # PNG
+    b"\x89PNG\r\n\x1a\n",
+]
+
 
 def _group_sequences_by_uuid(
     descs: T.List[types.ImageDescriptionFile],
@@ -73,6 +110,18 @@ class Progress(types.TypedDict, total=False):
     # Cluster ID after finishing the upload
     cluster_id: str
 
+    # Seconds spent waiting for the bandwidth limiter since "upload_start"
+    throttled_time: float
+
+    # Seconds taken to upload the last chunk (the request round trip)
+    chunk_upload_time: float
+
+    # Seconds taken to fetch the offset on the last "upload_fetch_offset"
+    fetch_offset_time: float
+
+    # Seconds to wait before retrying on the last "upload_interrupted"
+    retry_wait_time: float
+
 
 class UploadCancelled(Exception):
     pass
@@ -88,35 +137,292 @@ EventName = Literal[
 ]
 
 
+class _Coalescer:
+    """
+    Limit the rate of calling the listener per upload session: an event within 1/max_rate seconds
+    since the last call is held, and superseded by the later ones. The held event is delivered
+    once its deadline (1/max_rate seconds after the last call) passes on any later event of any
+    session, and before any other event of the same session or when the session fails,
+    so the listener never misses the last progress before "upload_end" or a failure.
+    """
+
+    def __init__(
+        self,
+        callback: T.Callable,
+        max_rate: float,
+        clock: T.Callable[[], float] = time.monotonic,
+    ):
+        self.callback = callback
+        self.interval = 1 / max_rate
+        self._clock = clock
+        self._last_called: T.Dict[T.Optional[str], float] = {}
+        self._pending: T.Dict[T.Optional[str], T.Tuple[T.Tuple, T.Dict]] = {}
+
+    def __call__(self, key: T.Optional[str], *args, **kwargs) -> None:
+        now = self._clock()
+        for due_key in self._due_keys(now):
+            # Not the one of this session, which is superseded by this event
+            if due_key != key:
+                self.flush(due_key)
+        if now - self._last_called.get(key, -math.inf) < self.interval:
+            # The payload is mutated after emitting so keep a copy
+            self._pending[key] = (
+                tuple(dict(arg) if isinstance(arg, dict) else arg for arg in args),
+                kwargs,
+            )
+            return
+        self._pending.pop(key, None)
+        self._last_called[key] = now
+        self.callback(*args, **kwargs)
+
+    def flush(self, key: T.Optional[str]) -> None:
+        pending = self._pending.pop(key, None)
+        if pending is not None:
+            args, kwargs = pending
+            self._last_called[key] = self._clock()
+            self.callback(*args, **kwargs)
+
+    def _due_keys(self, now: float) -> T.List[T.Optional[str]]:
+        return [
+            key
+            for key in self._pending
+            if self.interval <= now - self._last_called[key]
+        ]
+
+    def flush_due(self) -> None:
+        """
+        Deliver the held events whose deadline has passed.
+        """
+        for key in self._due_keys(self._clock()):
+            self.flush(key)
+
+
+def _session_key_of(args: T.Tuple) -> T.Optional[str]:
+    if args and isinstance(args[0], dict):
+        return args[0].get("md5sum")
+    return None
+
+
 class EventEmitter:
     events: T.Dict[EventName, T.List]
 
     def __init__(self):
         self.events = {}
+        self._coalescers: T.List[_Coalescer] = []
+        # Serialize callbacks so that listeners (progress bars, IPC, stats)
+        # see a consistent state when multiple sessions upload concurrently
+        self._lock = threading.RLock()
+
+    def on(self, event: EventName, max_rate: T.Optional[float] = None):
+        """
+        Register the listener of the event. With max_rate, the listener is called
+        at most max_rate times per second per upload session (see _Coalescer).
+        """
 
-    def on(self, event: EventName):
         def _wrap(callback):
-            self.events.setdefault(event, []).append(callback)
+            if max_rate is None:
+                self.events.setdefault(event, []).append(callback)
+            else:
+                coalescer = _Coalescer(callback, max_rate)
+                self._coalescers.append(coalescer)
+                self.events.setdefault(event, []).append(coalescer)
 
         return _wrap
 
+    def flush(self, payload: Progress) -> None:
+        """
+        Deliver the events held for the upload session of the payload.
+        """
+        key = _session_key_of((payload,))
+        with self._lock:
+            for coalescer in self._coalescers:
+                coalescer.flush(key)
+
     def emit(self, event: EventName, *args, **kwargs):
-        for callback in self.events.get(event, []):
-            callback(*args, **kwargs)
+        key = _session_key_of(args)
+        with self._lock:
+            listeners = self.events.get(event, [])
+            for coalescer in self._coalescers:
+                if coalescer not in listeners:
+                    coalescer.flush(key)
+                    coalescer.flush_due()
+            for callback in listeners:
+                if isinstance(callback, _Coalescer):
+                    callback(key, *args, **kwargs)
+                else:
+                    callback(*args, **kwargs)
+
+
+_X = T.TypeVar("_X")
+_R = T.TypeVar("_R")
+
+
+def execute_concurrently(
+    func: T.Callable[[_X], _R], items: T.Iterable[_X], max_workers: int = 1
+) -> T.List[_R]:
+    """
+    Apply func to each item with at most max_workers threads, and return the results in order.
+    The first exception cancels the pending items and is re-raised once the running ones finish.
+    """
+    items = list(items)
+
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(func, item) for item in items]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        return [future.result() for future in futures]
+
+
+async def execute_concurrently_async(
+    func: T.Callable[[_X], T.Awaitable[_R]],
+    items: T.Iterable[_X],
+    max_workers: int = 1,
+) -> T.List[_R]:
+    """
+    Same as execute_concurrently() but run at most max_workers coroutines at the same time on the event loop.
+    """
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def _run(item: _X) -> _R:
+        async with semaphore:
+            return await func(item)
+
+    tasks = [asyncio.ensure_future(_run(item)) for item in items]
+    if not tasks:
+        return []
+
+    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    if pending:
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(pending)
+    for task in tasks:
+        if task in done and task.exception() is not None:
+            raise T.cast(BaseException, task.exception())
+    return [task.result() for task in tasks]
+
+
+def _run_async(
+    main: T.Callable[[async_http.AsyncHTTPClient], T.Awaitable[_R]],
+    max_workers: int = 1,
+) -> _R:
+    """
+    Run the coroutine on a new event loop with an HTTP client for its requests, which hold no thread.
+    The default executor of max_workers threads (created on demand) is left for the blocking waits,
+    i.e. the zips being built, the hashing and the contended session locks. A session waits for one
+    of them at a time, so one thread per concurrent session is enough to never wait for a thread.
+    """
+    loop = asyncio.new_event_loop()
+    # Shut down by loop.close()
+    loop.set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    )
+    client = async_http.AsyncHTTPClient()
+    try:
+        return loop.run_until_complete(main(client))
+    finally:
+        client.close()
+        loop.close()
 
 
 class Uploader:
     def __init__(
-        self, user_items: types.UserItem, emitter: EventEmitter = None, dry_run=False
+        self,
+        user_items: types.UserItem,
+        emitter: EventEmitter = None,
+        dry_run=False,
+        upload_workers: int = 1,
+        zip_prefetch: int = 1,
+        zip_prefetch_max_size: T.Optional[int] = None,
+        zip_compression: ZipCompression = "auto",
+        zip_workers: int = 1,
+        zip_cache: T.Optional["SequenceZipCache"] = None,
+        uploaded_md5sums: T.Optional[T.Callable[[T.List[str]], T.Set[str]]] = None,
+        zip_stream: bool = True,
+        bandwidth_limiter: T.Optional[upload_api_v4.BandwidthLimiter] = None,
+        upload_engine: UploadEngine = "threads",
     ):
         jsonschema.validate(instance=user_items, schema=types.UserItemSchema)
+        if upload_engine not in ["threads", "asyncio"]:
+            raise ValueError(f"Invalid upload engine {upload_engine}")
+        if upload_engine == "asyncio" and not dry_run:
+            for endpoint in [
+                upload_api_v4.MAPILLARY_UPLOAD_ENDPOINT,
+                upload_api_v4.MAPILLARY_GRAPH_API_ENDPOINT,
+            ]:
+                proxy = async_http.environment_proxy(endpoint)
+                if proxy is not None:
+                    raise exceptions.MapillaryBadParameterError(
+                        f"The asyncio upload engine does not support the proxy {proxy}. Use the threads engine instead"
+                    )
+        if upload_workers <= 0:
+            raise ValueError(
+                f"Expect positive number of upload workers but got {upload_workers}"
+            )
+        if zip_prefetch < 0:
+            raise ValueError(
+                f"Expect non-negative number of prefetched zips but got {zip_prefetch}"
+            )
         self.user_items = user_items
         self.dry_run = dry_run
         self.emitter = emitter
-
-    def upload_zipfile(
-        self, zip_path: str, event_payload: T.Optional[Progress] = None
-    ) -> T.Optional[str]:
+        # Max number of upload sessions running at the same time
+        self.upload_workers = upload_workers
+        # Max number of sequence zips built in the background ahead of uploading
+        self.zip_prefetch = zip_prefetch
+        # Max total size in bytes of the built sequence zips in the temp directory
+        self.zip_prefetch_max_size = zip_prefetch_max_size
+        self.zip_compression = zip_compression
+        # Number of threads preparing the images for each sequence zip
+        self.zip_workers = zip_workers
+        # Keep the sequence zips across runs until they are uploaded
+        self.zip_cache = zip_cache
+        # Return the md5sums (of the given ones) that have been uploaded,
+        # so that the uploaded sequences are skipped before building their zips
+        self.uploaded_md5sums = uploaded_md5sums
+        # Stream the sequence zips from the images instead of writing them to temporary files
+        self.zip_stream = zip_stream
+        # Shared by all the upload sessions
+        self.bandwidth_limiter = bandwidth_limiter
+        self.upload_engine = upload_engine
+
+    def execute_sessions(
+        self,
+        func: T.Callable[[_X], _R],
+        func_async: T.Callable[[_X, async_http.AsyncHTTPClient], T.Awaitable[_R]],
+        items: T.Iterable[_X],
+    ) -> T.List[_R]:
+        """
+        Run the upload session of each item with at most upload_workers sessions at the same time, and
+        return the results in order. With the asyncio engine, all sessions are multiplexed on one event loop
+        by awaiting func_async(item, client), and their requests are sent with the non-blocking client.
+        """
+        if self.upload_engine == "asyncio":
+            return _run_async(
+                lambda client: execute_concurrently_async(
+                    lambda item: func_async(item, client),
+                    items,
+                    max_workers=self.upload_workers,
+                ),
+                max_workers=self.upload_workers,
+            )
+        else:
+            return execute_concurrently(func, items, max_workers=self.upload_workers)
+
+    def _prepare_zipfile(
+        self, zip_path: str, event_payload: T.Optional[Progress]
+    ) -> T.Optional[T.Tuple[str, int, Progress]]:
+        """
+        Return the upload md5sum, the image count and the event payload of the zip file.
+        """
         with zipfile.ZipFile(zip_path) as ziph:
             namelist = ziph.namelist()
             if not namelist:
@@ -131,26 +437,89 @@ class Uploader:
             "import_path": zip_path,
             "sequence_image_count": len(namelist),
         }
+        return (
+            upload_md5sum,
+            len(namelist),
+            T.cast(Progress, {**event_payload, **new_event_payload}),
+        )
+
+    def upload_zipfile(
+        self, zip_path: str, event_payload: T.Optional[Progress] = None
+    ) -> T.Optional[str]:
+        if self.upload_engine == "asyncio":
+            return _run_async(
+                lambda client: self.upload_zipfile_async(
+                    zip_path, client, event_payload=event_payload
+                )
+            )
+
+        prepared = self._prepare_zipfile(zip_path, event_payload)
+        if prepared is None:
+            return None
+        upload_md5sum, image_count, event_payload = prepared
 
         with open(zip_path, "rb") as fp:
             try:
                 return _upload_zipfile_fp(
                     fp,
                     upload_md5sum,
-                    len(namelist),
+                    image_count,
+                    self.user_items,
+                    event_payload=event_payload,
+                    emitter=self.emitter,
+                    dry_run=self.dry_run,
+                    bandwidth_limiter=self.bandwidth_limiter,
+                )
+            except UploadCancelled:
+                return None
+
+    async def upload_zipfile_async(
+        self,
+        zip_path: str,
+        client: async_http.AsyncHTTPClient,
+        event_payload: T.Optional[Progress] = None,
+    ) -> T.Optional[str]:
+        loop = asyncio.get_event_loop()
+        # Hash the zip in the default executor as the zips are prepared in upload_images
+        prepared = await loop.run_in_executor(
+            None, self._prepare_zipfile, zip_path, event_payload
+        )
+        if prepared is None:
+            return None
+        upload_md5sum, image_count, event_payload = prepared
+
+        with open(zip_path, "rb") as fp:
+            try:
+                return await _upload_zipfile_fp_async(
+                    fp,
+                    upload_md5sum,
+                    image_count,
                     self.user_items,
-                    event_payload=T.cast(
-                        Progress, {**event_payload, **new_event_payload}
-                    ),
+                    event_payload=event_payload,
                     emitter=self.emitter,
                     dry_run=self.dry_run,
+                    bandwidth_limiter=self.bandwidth_limiter,
+                    client=client,
                 )
             except UploadCancelled:
                 return None
 
     def upload_blackvue(
-        self, blackvue_path: str, event_payload: T.Optional[Progress] = None
+        self,
+        blackvue_path: str,
+        event_payload: T.Optional[Progress] = None,
+        upload_md5sum: T.Optional[str] = None,
     ) -> T.Optional[str]:
+        if self.upload_engine == "asyncio":
+            return _run_async(
+                lambda client: self.upload_blackvue_async(
+                    blackvue_path,
+                    client,
+                    event_payload=event_payload,
+                    upload_md5sum=upload_md5sum,
+                )
+            )
+
         try:
             return upload_blackvue(
                 blackvue_path,
@@ -158,6 +527,29 @@ class Uploader:
                 event_payload=event_payload,
                 emitter=self.emitter,
                 dry_run=self.dry_run,
+                bandwidth_limiter=self.bandwidth_limiter,
+                upload_md5sum=upload_md5sum,
+            )
+        except UploadCancelled:
+            return None
+
+    async def upload_blackvue_async(
+        self,
+        blackvue_path: str,
+        client: async_http.AsyncHTTPClient,
+        event_payload: T.Optional[Progress] = None,
+        upload_md5sum: T.Optional[str] = None,
+    ) -> T.Optional[str]:
+        try:
+            return await upload_blackvue_async(
+                blackvue_path,
+                self.user_items,
+                event_payload=event_payload,
+                emitter=self.emitter,
+                dry_run=self.dry_run,
+                bandwidth_limiter=self.bandwidth_limiter,
+                client=client,
+                upload_md5sum=upload_md5sum,
             )
         except UploadCancelled:
             return None
@@ -167,28 +559,122 @@ class Uploader:
     ) -> T.Dict[str, str]:
         _validate_descs(descs)
         sequences = _group_sequences_by_uuid(descs)
-        ret: T.Dict[str, str] = {}
-        for sequence_idx, (sequence_uuid, images) in enumerate(sequences.items()):
-            event_payload: Progress = {
+
+        def _event_payload(
+            sequence_idx: int,
+            sequence_uuid: str,
+            images: T.Dict[str, types.ImageDescriptionFile],
+        ) -> Progress:
+            return {
                 "sequence_idx": sequence_idx,
                 "total_sequence_count": len(sequences),
                 "sequence_image_count": len(images),
                 "sequence_uuid": sequence_uuid,
             }
-            with tempfile.NamedTemporaryFile() as fp:
-                upload_md5sum = _zip_sequence_fp(images, fp)
-                try:
-                    cluster_id: T.Optional[str] = _upload_zipfile_fp(
-                        fp,
-                        upload_md5sum,
-                        len(images),
-                        self.user_items,
-                        emitter=self.emitter,
-                        event_payload=event_payload,
-                        dry_run=self.dry_run,
+
+        def _upload_sequence(
+            item: T.Tuple[int, T.Tuple[str, T.Dict[str, types.ImageDescriptionFile]]]
+        ) -> T.Optional[str]:
+            sequence_idx, (sequence_uuid, images) = item
+            rebuild = False
+            while True:
+                with prefetcher.open(sequence_uuid, rebuild=rebuild) as opened:
+                    if opened is None:
+                        return None
+                    fp, upload_md5sum = opened
+                    try:
+                        cluster_id: T.Optional[str] = _upload_zipfile_fp(
+                            fp,
+                            upload_md5sum,
+                            len(images),
+                            self.user_items,
+                            emitter=self.emitter,
+                            event_payload=_event_payload(
+                                sequence_idx, sequence_uuid, images
+                            ),
+                            dry_run=self.dry_run,
+                            bandwidth_limiter=self.bandwidth_limiter,
+                        )
+                    except UploadCancelled:
+                        cluster_id = None
+                    except zip_stream.FileChangedError as ex:
+                        # The rebuilt zip is not streamed, so it can not fail on the images again
+                        if rebuild:
+                            raise
+                        LOG.warning(f"{ex}. Building the zip of {sequence_uuid} again")
+                        rebuild = True
+                        continue
+                break
+            # No need to keep it once uploaded. A cancelled session keeps it, since the session
+            # that cancelled it (e.g. in another process sharing the cache) might still be reading it
+            if self.zip_cache is not None and cluster_id is not None:
+                self.zip_cache.remove(images, compression=self.zip_compression)
+            return cluster_id
+
+        async def _upload_sequence_async(
+            item: T.Tuple[int, T.Tuple[str, T.Dict[str, types.ImageDescriptionFile]]],
+            client: async_http.AsyncHTTPClient,
+        ) -> T.Optional[str]:
+            sequence_idx, (sequence_uuid, images) = item
+            loop = asyncio.get_event_loop()
+            rebuild = False
+            while True:
+                with contextlib.ExitStack() as stack:
+                    # Wait for the zip in the default executor without blocking the loop
+                    opened = await loop.run_in_executor(
+                        None,
+                        stack.enter_context,
+                        prefetcher.open(sequence_uuid, rebuild=rebuild),
                     )
-                except UploadCancelled:
-                    cluster_id = None
+                    if opened is None:
+                        return None
+                    fp, upload_md5sum = opened
+                    try:
+                        cluster_id: T.Optional[str] = await _upload_zipfile_fp_async(
+                            fp,
+                            upload_md5sum,
+                            len(images),
+                            self.user_items,
+                            emitter=self.emitter,
+                            event_payload=_event_payload(
+                                sequence_idx, sequence_uuid, images
+                            ),
+                            dry_run=self.dry_run,
+                            bandwidth_limiter=self.bandwidth_limiter,
+                            client=client,
+                        )
+                    except UploadCancelled:
+                        cluster_id = None
+                    except zip_stream.FileChangedError as ex:
+                        # The rebuilt zip is not streamed, so it can not fail on the images again
+                        if rebuild:
+                            raise
+                        LOG.warning(f"{ex}. Building the zip of {sequence_uuid} again")
+                        rebuild = True
+                        continue
+                break
+            if self.zip_cache is not None and cluster_id is not None:
+                self.zip_cache.remove(images, compression=self.zip_compression)
+            return cluster_id
+
+        items = list(enumerate(sequences.items()))
+
+        with _SequenceZipPrefetcher(
+            sequences,
+            prefetch=self.zip_prefetch,
+            max_size=self.zip_prefetch_max_size,
+            compression=self.zip_compression,
+            workers=self.zip_workers,
+            cache=self.zip_cache,
+            stream=self.zip_stream,
+            uploaded_md5sums=self.uploaded_md5sums,
+        ) as prefetcher:
+            cluster_ids = self.execute_sessions(
+                _upload_sequence, _upload_sequence_async, items
+            )
+
+        ret: T.Dict[str, str] = {}
+        for sequence_uuid, cluster_id in zip(sequences.keys(), cluster_ids):
             if cluster_id is not None:
                 ret[sequence_uuid] = cluster_id
         return ret
@@ -216,6 +702,8 @@ def _validate_descs(descs: T.List[types.ImageDescriptionFile]):
 def zip_images(
     descs: T.List[types.ImageDescriptionFile],
     zip_dir: str,
+    compression: ZipCompression = "auto",
+    workers: int = 1,
 ):
     _validate_descs(descs)
     sequences = _group_sequences_by_uuid(descs)
@@ -225,7 +713,9 @@ def zip_images(
             zip_dir, f"mly_tools_{sequence_uuid}.{os.getpid()}.wip"
         )
         with open(zip_filename_wip, "wb") as fp:
-            upload_md5sum = _zip_sequence_fp(sequence, fp)
+            upload_md5sum = _zip_sequence_fp(
+                sequence, fp, compression=compression, workers=workers
+            )
         zip_filename = os.path.join(zip_dir, f"mly_tools_{upload_md5sum}.zip")
         os.rename(zip_filename_wip, zip_filename)
 
@@ -240,10 +730,58 @@ def _hash_zipfile(ziph: zipfile.ZipFile) -> str:
     return utils.md5sum_bytes(concat.encode("utf-8"))
 
 
-def _zip_sequence_fp(
-    sequence: T.Dict[str, types.ImageDescriptionFile],
-    fp: T.IO[bytes],
-) -> str:
+def _zip_compress_type(image_bytes: bytes, compression: ZipCompression) -> int:
+    if compression == "stored":
+        return zipfile.ZIP_STORED
+    elif compression == "deflated":
+        return zipfile.ZIP_DEFLATED
+    elif compression == "auto":
+        # It only depends on the content so the zip remains deterministic
+        if any(image_bytes.startswith(sig) for sig in _COMPRESSED_IMAGE_SIGNATURES):
+            return zipfile.ZIP_STORED
+        else:
+            return zipfile.ZIP_DEFLATED
+    else:
+        raise ValueError(f"Invalid zip compression {compression}")
+
+
+def _prepare_zip_entry(
+    desc: types.ImageDescriptionFile, compression: ZipCompression
+) -> T.Tuple[zipfile.ZipInfo, T.List[T.Union[bytes, memoryview]]]:
+    # Read the image once for hashing, parsing and writing
+    image_bytes, md5sum = file_hash_cache.read_file(desc["filename"])
+    edit = exif_write.ExifEdit(image_bytes)
+    # The cast is to fix the type checker error
+    exif_desc = T.cast(T.Dict, desc_file_to_exif(desc))
+    edit.add_image_description(exif_desc)
+    # The new EXIF segment followed by the rest of the original image (not copied)
+    image_chunks = edit.dump_image_chunks()
+    # To make sure the zip file deterministic, i.e. zip same files result in same content (same hashes),
+    # we use md5 as the name, and an constant as the modification time
+    _, ext = os.path.splitext(desc["filename"])
+    arcname = f"{md5sum}{ext.lower()}"
+    zipinfo = zipfile.ZipInfo(arcname, date_time=(1980, 1, 1, 0, 0, 0))
+    zipinfo.compress_type = _zip_compress_type(image_bytes, compression)
+    zipinfo.file_size = sum(len(chunk) for chunk in image_chunks)
+    return zipinfo, image_chunks
+
+
+def _prepare_zip_entries(
+    descs: T.List[types.ImageDescriptionFile],
+    compression: ZipCompression,
+    workers: int = 1,
+) -> T.Generator[
+    T.Tuple[zipfile.ZipInfo, T.List[T.Union[bytes, memoryview]]], None, None
+]:
+    # Limit the prepared entries in memory in case writing them falls behind
+    yield from hashing.imap_ordered(
+        lambda desc: _prepare_zip_entry(desc, compression), descs, max_workers=workers
+    )
+
+
+def _sort_sequence_descs(
+    sequence: T.Dict[str, types.ImageDescriptionFile]
+) -> T.List[types.ImageDescriptionFile]:
     descs = list(sequence.values())
     descs.sort(
         key=lambda desc: (
@@ -251,34 +789,488 @@ def _zip_sequence_fp(
             desc["filename"],
         )
     )
-    with zipfile.ZipFile(fp, "w", zipfile.ZIP_DEFLATED) as ziph:
-        for desc in descs:
-            edit = exif_write.ExifEdit(desc["filename"])
-            with open(desc["filename"], "rb") as fp:
-                md5sum = utils.md5sum_fp(fp)
-            # The cast is to fix the type checker error
-            exif_desc = T.cast(T.Dict, desc_file_to_exif(desc))
-            edit.add_image_description(exif_desc)
-            image_bytes = edit.dump_image_bytes()
-            # To make sure the zip file deterministic, i.e. zip same files result in same content (same hashes),
-            # we use md5 as the name, and an constant as the modification time
-            _, ext = os.path.splitext(desc["filename"])
-            arcname = f"{md5sum}{ext.lower()}"
-            zipinfo = zipfile.ZipInfo(arcname, date_time=(1980, 1, 1, 0, 0, 0))
-            ziph.writestr(zipinfo, image_bytes)
+    return descs
+
+
+def sequence_upload_md5sum(
+    sequence: T.Dict[str, types.ImageDescriptionFile], workers: int = 1
+) -> str:
+    """
+    Compute the md5sum of the sequence zip without building it.
+    It is the same as _hash_zipfile() on the zip built by _zip_sequence_fp().
+    """
+    descs = _sort_sequence_descs(sequence)
+    image_md5sums = hashing.file_md5sums(
+        [desc["filename"] for desc in descs], max_workers=workers
+    )
+    return utils.md5sum_bytes("".join(image_md5sums).encode("utf-8"))
+
+
+def _zip_sequence_fp(
+    sequence: T.Dict[str, types.ImageDescriptionFile],
+    fp: T.IO[bytes],
+    compression: ZipCompression = "auto",
+    workers: int = 1,
+) -> str:
+    descs = _sort_sequence_descs(sequence)
+    with zipfile.ZipFile(fp, "w") as ziph:
+        # Entries are prepared concurrently but written in the order of descs
+        for zipinfo, image_chunks in _prepare_zip_entries(
+            descs, compression, workers=workers
+        ):
+            # Same as writestr() but write the chunks into the entry one by one
+            with ziph.open(zipinfo, "w") as entry:
+                for chunk in image_chunks:
+                    entry.write(chunk)
 
         return _hash_zipfile(ziph)
 
 
-def _upload_zipfile_fp(
+def _is_streamable(filename: str, compression: ZipCompression) -> bool:
+    """
+    Whether the zip entry of the image would be stored with the image data after the EXIF segment
+    referenced (see _prepare_zip_entry), decided from the JPEG header without reading the image data.
+    """
+    with open(filename, "rb") as fp:
+        signature = fp.read(max(len(sig) for sig in _COMPRESSED_IMAGE_SIGNATURES))
+        if _zip_compress_type(signature, compression) != zipfile.ZIP_STORED:
+            return False
+        return exif_write.jpeg_header_size(fp) is not None
+
+
+def _stream_sequence_zip(
+    sequence: T.Dict[str, types.ImageDescriptionFile],
+    compression: ZipCompression = "auto",
+    workers: int = 1,
+) -> T.Optional[T.Tuple[zip_stream.VirtualFile, str]]:
+    """
+    Lay out the sequence zip (the same bytes as _zip_sequence_fp) as a stream that reads
+    the images on the fly. Return None if any entry can not be streamed, i.e. deflated or not JPEG.
+    """
+    if compression == "deflated":
+        return None
+
+    descs = _sort_sequence_descs(sequence)
+    # Taken before reading the images, so that the changes during the reads are detected
+    signatures = {
+        desc["filename"]: file_hash_cache.file_signature(desc["filename"])
+        for desc in descs
+    }
+    # Check before preparing the entries so that the fallback does not prepare them twice
+    if not all(_is_streamable(desc["filename"], compression) for desc in descs):
+        return None
+
+    recorder = zip_stream.LayoutRecorder()
+    with zipfile.ZipFile(recorder, "w") as ziph:
+        for desc, (zipinfo, image_chunks) in zip(
+            descs, _prepare_zip_entries(descs, compression, workers=workers)
+        ):
+            signature = signatures[desc["filename"]]
+            # Only if the image changed after the signature was taken
+            if (
+                zipinfo.compress_type != zipfile.ZIP_STORED
+                or not isinstance(image_chunks[-1], memoryview)
+                or file_hash_cache.file_signature(desc["filename"]) != signature
+            ):
+                return None
+            with ziph.open(zipinfo, "w") as entry:
+                for chunk in image_chunks[:-1]:
+                    entry.write(chunk)
+                with recorder.file_tail(desc["filename"], signature):
+                    entry.write(image_chunks[-1])
+        upload_md5sum = _hash_zipfile(ziph)
+
+    return recorder.to_stream(), upload_md5sum
+
+
+class SequenceZipCache:
+    """
+    Keep the built sequence zips in a directory so that the next attempt (after crashes or aborts)
+    uploads the same zip without re-reading and re-zipping the images.
+
+    A zip is keyed by the md5 of the sequence, i.e. the image descriptions, the size and the
+    modification time of each image, and the compression policy. Changing any of them results in
+    a new zip. When the total size of the zips exceeds `max_size` bytes, the least recently used
+    ones are removed. The zips not used for `max_age` seconds (e.g. the ones of cancelled sessions
+    that are never resumed) are removed on the next open.
+    """
+
+    # Bump it if the zip content changes for the same inputs
+    VERSION = 1
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_size: T.Optional[int] = None,
+        max_age: T.Optional[float] = constants.ZIP_CACHE_MAX_AGE_DAYS * 24 * 3600,
+    ):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+
+    def sequence_md5sum(
+        self,
+        sequence: T.Dict[str, types.ImageDescriptionFile],
+        compression: ZipCompression = "auto",
+    ) -> str:
+        images = []
+        for filename in sorted(sequence.keys()):
+            stat = os.stat(filename)
+            # Only the fields written into the zip, i.e. not the random sequence UUIDs
+            exif_desc = desc_file_to_exif(sequence[filename])
+            images.append([filename, exif_desc, stat.st_size, stat.st_mtime_ns])
+        key = json.dumps(
+            {"version": self.VERSION, "compression": compression, "images": images},
+            sort_keys=True,
+        )
+        return utils.md5sum_bytes(key.encode("utf-8"))
+
+    def _zip_path(self, sequence_md5sum: str) -> str:
+        return os.path.join(self.cache_dir, f"mly_tools_{sequence_md5sum}.zip")
+
+    def open(
+        self,
+        sequence: T.Dict[str, types.ImageDescriptionFile],
+        compression: ZipCompression = "auto",
+        workers: int = 1,
+    ) -> T.Tuple[T.IO[bytes], str]:
+        """
+        Open the cached zip of the sequence (build it if not found), and return it with its upload md5sum.
+        """
+        zip_path = self._zip_path(self.sequence_md5sum(sequence, compression))
+
+        if os.path.isfile(zip_path):
+            fp = open(zip_path, "rb")
+            try:
+                with zipfile.ZipFile(fp) as ziph:
+                    upload_md5sum = _hash_zipfile(ziph)
+            except (OSError, zipfile.BadZipFile):
+                fp.close()
+                LOG.warning("Rebuilding invalid cached zip %s", zip_path, exc_info=True)
+            else:
+                LOG.debug("Found cached zip %s", zip_path)
+                # Mark it as recently used
+                os.utime(zip_path)
+                self._evict(keep=zip_path)
+                return fp, upload_md5sum
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        zip_path_wip = f"{zip_path}.{os.getpid()}.{threading.get_ident()}.wip"
+        try:
+            with open(zip_path_wip, "wb") as wip_fp:
+                upload_md5sum = _zip_sequence_fp(
+                    sequence, wip_fp, compression=compression, workers=workers
+                )
+            os.replace(zip_path_wip, zip_path)
+        finally:
+            if os.path.isfile(zip_path_wip):
+                os.remove(zip_path_wip)
+
+        fp = open(zip_path, "rb")
+        self._evict(keep=zip_path)
+        return fp, upload_md5sum
+
+    def remove(
+        self,
+        sequence: T.Dict[str, types.ImageDescriptionFile],
+        compression: ZipCompression = "auto",
+    ) -> None:
+        zip_path = self._zip_path(self.sequence_md5sum(sequence, compression))
+        try:
+            os.remove(zip_path)
+        except OSError:
+            # Not found, or still opened on Windows
+            pass
+
+    def _evict(self, keep: str) -> None:
+        if self.max_size is None and self.max_age is None:
+            return
+
+        with self._lock:
+            now = time.time()
+            entries = []
+            for entry in os.scandir(self.cache_dir):
+                if not entry.name.startswith("mly_tools_"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.endswith(".zip"):
+                    entries.append((stat.st_mtime, entry.path, stat.st_size))
+                elif (
+                    entry.name.endswith(".wip")
+                    and self.max_age is not None
+                    and self.max_age < now - stat.st_mtime
+                ):
+                    # Left by the processes killed while building
+                    self._remove(entry.path)
+
+            total_size = sum(size for _, _, size in entries)
+            # Least recently used first
+            entries.sort()
+            for mtime, path, size in entries:
+                expired = self.max_age is not None and self.max_age < now - mtime
+                oversized = self.max_size is not None and self.max_size < total_size
+                if not expired and not oversized:
+                    break
+                if path == keep:
+                    continue
+                if self._remove(path):
+                    total_size -= size
+
+    def _remove(self, path: str) -> bool:
+        try:
+            os.remove(path)
+        except OSError:
+            # Opened on Windows, or removed by other processes
+            return False
+        LOG.debug("Evicted cached zip %s", path)
+        return True
+
+
+class _SequenceZipPrefetcher:
+    """
+    Build sequence zips into temporary files in a background thread, in the order of the sequences,
+    so that the next zips are ready while the current ones are uploading.
+
+    At most `prefetch` built zips wait to be opened, and the total size of the zips
+    on disk (including the ones being uploaded) is kept under `max_size` bytes if specified.
+    With prefetch=0, the zip is built on open() in the calling thread.
+    If a cache is specified, the zips are built into (or found in) the cache instead of temporary files.
+    If stream is enabled, the zips (of stored entries only) are streamed from the images without being
+    written to disk, and only their layouts are built ahead.
+    If uploaded_md5sums is specified, the sequences uploaded already are skipped before building their zips
+    (opened as None), so that hashing the sequences overlaps uploading the previous ones.
+    """
+
+    def __init__(
+        self,
+        sequences: T.Dict[str, T.Dict[str, types.ImageDescriptionFile]],
+        prefetch: int = 0,
+        max_size: T.Optional[int] = None,
+        compression: ZipCompression = "auto",
+        workers: int = 1,
+        cache: T.Optional[SequenceZipCache] = None,
+        stream: bool = False,
+        uploaded_md5sums: T.Optional[T.Callable[[T.List[str]], T.Set[str]]] = None,
+    ):
+        self._sequences = sequences
+        self._uploaded_md5sums = uploaded_md5sums
+        self._compression = compression
+        self._workers = workers
+        self._cache = cache
+        self._stream = stream
+        self._prefetch = prefetch
+        self._max_size = max_size
+        self._cond = threading.Condition()
+        # Built zips that are not opened yet (None if skipped)
+        self._ready: T.Dict[str, T.Optional[T.Tuple[T.IO[bytes], str, int]]] = {}
+        # Built zips that are opened (i.e. in uploading)
+        self._opened: T.Dict[str, T.Tuple[T.IO[bytes], int]] = {}
+        self._disk_size = 0
+        self._error: T.Optional[BaseException] = None
+        self._closed = False
+        self._thread: T.Optional[threading.Thread] = None
+
+    def __enter__(self) -> "_SequenceZipPrefetcher":
+        if 0 < self._prefetch:
+            self._thread = threading.Thread(target=self._build_all, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *_) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        for built in self._ready.values():
+            if built is not None:
+                built[0].close()
+        self._ready.clear()
+
+    def _has_room(self, estimated_size: int) -> bool:
+        if self._prefetch <= len(self._ready):
+            return False
+        if self._max_size is None:
+            return True
+        # Always allow one zip on disk, otherwise a sequence larger than the limit would block forever
+        if not self._ready and not self._opened:
+            return True
+        return self._disk_size + estimated_size <= self._max_size
+
+    def _is_uploaded(self, sequence_uuid: str) -> bool:
+        if self._uploaded_md5sums is None:
+            return False
+        upload_md5sum = sequence_upload_md5sum(
+            self._sequences[sequence_uuid], workers=self._workers
+        )
+        if not self._uploaded_md5sums([upload_md5sum]):
+            return False
+        LOG.info(
+            f"Sequence {sequence_uuid} has been uploaded already (md5sum {upload_md5sum})"
+        )
+        return True
+
+    def _build(
+        self, sequence_uuid: str, stream: T.Optional[bool] = None
+    ) -> T.Optional[T.Tuple[T.IO[bytes], str, int]]:
+        """
+        Build the zip and return it with its upload md5sum and its size on disk,
+        or None if the sequence has been uploaded already.
+        """
+        if stream is None:
+            stream = self._stream
+        if self._is_uploaded(sequence_uuid):
+            return None
+
+        sequence = self._sequences[sequence_uuid]
+        fp: T.IO[bytes]
+
+        if self._cache is None and stream:
+            streamed = _stream_sequence_zip(
+                sequence, compression=self._compression, workers=self._workers
+            )
+            if streamed is not None:
+                stream, upload_md5sum = streamed
+                # Nothing on disk
+                return T.cast(T.IO[bytes], stream), upload_md5sum, 0
+
+        if self._cache is None:
+            fp = tempfile.NamedTemporaryFile()
+            try:
+                upload_md5sum = _zip_sequence_fp(
+                    sequence, fp, compression=self._compression, workers=self._workers
+                )
+            except BaseException:
+                fp.close()
+                raise
+        else:
+            fp, upload_md5sum = self._cache.open(
+                sequence, compression=self._compression, workers=self._workers
+            )
+        fp.seek(0, io.SEEK_END)
+        return fp, upload_md5sum, fp.tell()
+
+    def _build_all(self) -> None:
+        for sequence_uuid, sequence in self._sequences.items():
+            # The zip size is close to the total size of the images
+            estimated_size = sum(
+                os.path.getsize(desc["filename"]) for desc in sequence.values()
+            )
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self._closed or self._has_room(estimated_size)
+                )
+                if self._closed:
+                    return
+
+            try:
+                built = self._build(sequence_uuid)
+            except BaseException as ex:
+                with self._cond:
+                    self._error = ex
+                    self._cond.notify_all()
+                return
+
+            with self._cond:
+                if self._closed:
+                    if built is not None:
+                        built[0].close()
+                    return
+                self._ready[sequence_uuid] = built
+                if built is not None:
+                    self._disk_size += built[2]
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def open(
+        self, sequence_uuid: str, rebuild: bool = False
+    ) -> T.Generator[T.Optional[T.Tuple[T.IO[bytes], str]], None, None]:
+        """
+        Yield the zip and its upload md5sum, or None if the sequence has been uploaded already.
+        With rebuild, the zip is built again in the calling thread and without streaming,
+        i.e. after the images of its stream changed (zip_stream.FileChangedError).
+        """
+        if self._prefetch <= 0 or rebuild:
+            built = self._build(sequence_uuid, stream=False if rebuild else None)
+            if built is None:
+                yield None
+                return
+            fp, upload_md5sum, _size = built
+            with fp:
+                yield fp, upload_md5sum
+            return
+
+        with self._cond:
+            self._cond.wait_for(
+                lambda: sequence_uuid in self._ready or self._error is not None
+            )
+            if sequence_uuid not in self._ready:
+                assert self._error is not None
+                raise self._error
+            built = self._ready.pop(sequence_uuid)
+            self._cond.notify_all()
+            if built is not None:
+                fp, upload_md5sum, size = built
+                self._opened[sequence_uuid] = (fp, size)
+
+        if built is None:
+            yield None
+            return
+
+        try:
+            yield fp, upload_md5sum
+        finally:
+            with self._cond:
+                del self._opened[sequence_uuid]
+                self._disk_size -= size
+                self._cond.notify_all()
+            fp.close()
+
+
+def _create_upload_service(
+    user_items: types.UserItem,
+    session_key: str,
+    entity_size: int,
+    file_type: upload_api_v4.FileType = "zip",
+    dry_run=False,
+    bandwidth_limiter: T.Optional[upload_api_v4.BandwidthLimiter] = None,
+) -> upload_api_v4.UploadService:
+    if dry_run:
+        return upload_api_v4.FakeUploadService(
+            user_access_token=user_items["user_upload_token"],
+            session_key=session_key,
+            entity_size=entity_size,
+            organization_id=user_items.get("MAPOrganizationKey"),
+            file_type=file_type,
+            bandwidth_limiter=bandwidth_limiter,
+        )
+    else:
+        return upload_api_v4.UploadService(
+            user_access_token=user_items["user_upload_token"],
+            session_key=session_key,
+            entity_size=entity_size,
+            organization_id=user_items.get("MAPOrganizationKey"),
+            file_type=file_type,
+            bandwidth_limiter=bandwidth_limiter,
+        )
+
+
+def _prepare_zipfile_fp(
     fp: T.IO[bytes],
     upload_md5sum: str,
     image_count: int,
     user_items: types.UserItem,
     event_payload: T.Optional[Progress] = None,
-    emitter: T.Optional[EventEmitter] = None,
     dry_run=False,
-) -> str:
+    bandwidth_limiter: T.Optional[upload_api_v4.BandwidthLimiter] = None,
+) -> T.Tuple[upload_api_v4.UploadService, int, Progress]:
+    """
+    Return the upload service, the chunk size and the event payload to upload the zip.
+    """
     if event_payload is None:
         event_payload = {
             "sequence_idx": 0,
@@ -292,87 +1284,186 @@ def _upload_zipfile_fp(
     avg_image_size = int(entity_size / image_count)
     chunk_size = min(max(avg_image_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
 
-    if dry_run:
-        upload_service: upload_api_v4.UploadService = upload_api_v4.FakeUploadService(
-            user_access_token=user_items["user_upload_token"],
-            session_key=f"mly_tools_{upload_md5sum}.zip",
-            entity_size=entity_size,
-            organization_id=user_items.get("MAPOrganizationKey"),
-        )
-    else:
-        upload_service = upload_api_v4.UploadService(
-            user_access_token=user_items["user_upload_token"],
-            session_key=f"mly_tools_{upload_md5sum}.zip",
-            entity_size=entity_size,
-            organization_id=user_items.get("MAPOrganizationKey"),
-        )
+    upload_service = _create_upload_service(
+        user_items,
+        f"mly_tools_{upload_md5sum}.zip",
+        entity_size,
+        dry_run=dry_run,
+        bandwidth_limiter=bandwidth_limiter,
+    )
 
     new_event_payload: Progress = {
         "entity_size": entity_size,
         "md5sum": upload_md5sum,
     }
 
+    return (
+        upload_service,
+        chunk_size,
+        T.cast(Progress, {**event_payload, **new_event_payload}),
+    )
+
+
+def _upload_zipfile_fp(
+    fp: T.IO[bytes],
+    upload_md5sum: str,
+    image_count: int,
+    user_items: types.UserItem,
+    event_payload: T.Optional[Progress] = None,
+    emitter: T.Optional[EventEmitter] = None,
+    dry_run=False,
+    bandwidth_limiter: T.Optional[upload_api_v4.BandwidthLimiter] = None,
+) -> str:
+    upload_service, chunk_size, event_payload = _prepare_zipfile_fp(
+        fp,
+        upload_md5sum,
+        image_count,
+        user_items,
+        event_payload=event_payload,
+        dry_run=dry_run,
+        bandwidth_limiter=bandwidth_limiter,
+    )
     return _upload_fp(
         upload_service,
         fp,
         chunk_size,
-        event_payload=T.cast(Progress, {**event_payload, **new_event_payload}),
+        event_payload=event_payload,
         emitter=emitter,
     )
 
 
-def upload_blackvue(
-    blackvue_path: str,
+async def _upload_zipfile_fp_async(
+    fp: T.IO[bytes],
+    upload_md5sum: str,
+    image_count: int,
     user_items: types.UserItem,
+    client: async_http.AsyncHTTPClient,
     event_payload: T.Optional[Progress] = None,
-    emitter: EventEmitter = None,
+    emitter: T.Optional[EventEmitter] = None,
     dry_run=False,
+    bandwidth_limiter: T.Optional[upload_api_v4.BandwidthLimiter] = None,
 ) -> str:
+    upload_service, chunk_size, event_payload = _prepare_zipfile_fp(
+        fp,
+        upload_md5sum,
+        image_count,
+        user_items,
+        event_payload=event_payload,
+        dry_run=dry_run,
+        bandwidth_limiter=bandwidth_limiter,
+    )
+    return await _upload_fp_async(
+        upload_api_v4.create_async_upload_service(upload_service, client),
+        fp,
+        chunk_size,
+        event_payload=event_payload,
+        emitter=emitter,
+    )
+
+
+def _prepare_blackvue(
+    blackvue_path: str,
+    user_items: types.UserItem,
+    event_payload: T.Optional[Progress] = None,
+    dry_run=False,
+    bandwidth_limiter: T.Optional[upload_api_v4.BandwidthLimiter] = None,
+    upload_md5sum: T.Optional[str] = None,
+) -> T.Tuple[upload_api_v4.UploadService, int, Progress]:
+    """
+    Return the upload service, the chunk size and the event payload to upload the video.
+    """
     jsonschema.validate(instance=user_items, schema=types.UserItemSchema)
 
-    with open(blackvue_path, "rb") as fp:
-        upload_md5sum = utils.md5sum_fp(fp)
+    if upload_md5sum is None:
+        upload_md5sum = file_hash_cache.file_md5sum(blackvue_path)
+    entity_size = os.path.getsize(blackvue_path)
 
-        fp.seek(0, io.SEEK_END)
-        entity_size = fp.tell()
-
-        # chunk size
-        avg_image_size = entity_size
-        chunk_size = min(max(avg_image_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
-
-        if dry_run:
-            upload_service: upload_api_v4.UploadService = (
-                upload_api_v4.FakeUploadService(
-                    user_access_token=user_items["user_upload_token"],
-                    session_key=f"mly_tools_{upload_md5sum}.mp4",
-                    entity_size=entity_size,
-                    organization_id=user_items.get("MAPOrganizationKey"),
-                    file_type="mly_blackvue_video",
-                )
-            )
-        else:
-            upload_service = upload_api_v4.UploadService(
-                user_access_token=user_items["user_upload_token"],
-                session_key=f"mly_tools_{upload_md5sum}.mp4",
-                entity_size=entity_size,
-                organization_id=user_items.get("MAPOrganizationKey"),
-                file_type="mly_blackvue_video",
-            )
+    # chunk size
+    avg_image_size = entity_size
+    chunk_size = min(max(avg_image_size, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
 
-        if event_payload is None:
-            event_payload = {}
+    upload_service = _create_upload_service(
+        user_items,
+        f"mly_tools_{upload_md5sum}.mp4",
+        entity_size,
+        file_type="mly_blackvue_video",
+        dry_run=dry_run,
+        bandwidth_limiter=bandwidth_limiter,
+    )
 
-        new_event_payload: Progress = {
-            "entity_size": entity_size,
-            "import_path": blackvue_path,
-            "md5sum": upload_md5sum,
-        }
+    if event_payload is None:
+        event_payload = {}
+
+    new_event_payload: Progress = {
+        "entity_size": entity_size,
+        "import_path": blackvue_path,
+        "md5sum": upload_md5sum,
+    }
 
+    return (
+        upload_service,
+        chunk_size,
+        T.cast(Progress, {**event_payload, **new_event_payload}),
+    )
+
+
+def upload_blackvue(
+    blackvue_path: str,
+    user_items: types.UserItem,
+    event_payload: T.Optional[Progress] = None,
+    emitter: EventEmitter = None,
+    dry_run=False,
+    bandwidth_limiter: T.Optional[upload_api_v4.BandwidthLimiter] = None,
+    upload_md5sum: T.Optional[str] = None,
+) -> str:
+    upload_service, chunk_size, event_payload = _prepare_blackvue(
+        blackvue_path,
+        user_items,
+        event_payload=event_payload,
+        dry_run=dry_run,
+        bandwidth_limiter=bandwidth_limiter,
+        upload_md5sum=upload_md5sum,
+    )
+    with open(blackvue_path, "rb") as fp:
         return _upload_fp(
             upload_service,
             fp,
             chunk_size,
-            event_payload=T.cast(Progress, {**event_payload, **new_event_payload}),
+            event_payload=event_payload,
+            emitter=emitter,
+        )
+
+
+async def upload_blackvue_async(
+    blackvue_path: str,
+    user_items: types.UserItem,
+    client: async_http.AsyncHTTPClient,
+    event_payload: T.Optional[Progress] = None,
+    emitter: T.Optional[EventEmitter] = None,
+    dry_run=False,
+    bandwidth_limiter: T.Optional[upload_api_v4.BandwidthLimiter] = None,
+    upload_md5sum: T.Optional[str] = None,
+) -> str:
+    loop = asyncio.get_event_loop()
+    # Hash the video (if not hashed yet) in the default executor
+    upload_service, chunk_size, event_payload = await loop.run_in_executor(
+        None,
+        functools.partial(
+            _prepare_blackvue,
+            blackvue_path,
+            user_items,
+            event_payload=event_payload,
+            dry_run=dry_run,
+            bandwidth_limiter=bandwidth_limiter,
+            upload_md5sum=upload_md5sum,
+        ),
+    )
+    with open(blackvue_path, "rb") as fp:
+        return await _upload_fp_async(
+            upload_api_v4.create_async_upload_service(upload_service, client),
+            fp,
+            chunk_size,
+            event_payload=event_payload,
             emitter=emitter,
         )
 
@@ -394,16 +1485,112 @@ def is_retriable_exception(ex: Exception):
     return False
 
 
-def _setup_callback(emitter: EventEmitter, mutable_payload: Progress):
-    def _callback(chunk: bytes, _):
+def _setup_callback(
+    emitter: EventEmitter,
+    mutable_payload: Progress,
+    upload_service: upload_api_v4.UploadService,
+):
+    def _callback(chunk: T.Union[bytes, memoryview], _):
         assert isinstance(emitter, EventEmitter)
         mutable_payload["offset"] += len(chunk)
         mutable_payload["chunk_size"] = len(chunk)
+        mutable_payload["chunk_upload_time"] = upload_service.last_chunk_upload_time
         emitter.emit("upload_progress", mutable_payload)
 
     return _callback
 
 
+class _SessionLock:
+    """
+    Exclude the sessions of the same session key in this process, and in the other processes
+    on the host with a lock file in constants.UPLOAD_LOCK_DIR (if enabled).
+    """
+
+    def __init__(self, session_key: str):
+        self.session_key = session_key
+        self._thread_lock = threading.Lock()
+        self._file_lock = (
+            file_lock.FileLock(
+                os.path.join(constants.UPLOAD_LOCK_DIR, f"{session_key}.lock"),
+                remove=True,
+            )
+            if constants.UPLOAD_LOCK_DIR
+            else None
+        )
+
+    def acquire(self, blocking: bool = True) -> bool:
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if self._file_lock is None:
+            return True
+        try:
+            acquired = self._file_lock.acquire(blocking=False)
+            if not acquired and blocking:
+                LOG.info("Waiting for another process uploading %s", self.session_key)
+                acquired = self._file_lock.acquire()
+        except OSError:
+            LOG.warning("Failed to lock %s", self._file_lock.path, exc_info=True)
+            # Best effort
+            acquired = True
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        if not acquired:
+            self._thread_lock.release()
+        return acquired
+
+    def release(self) -> None:
+        try:
+            if self._file_lock is not None and self._file_lock.locked:
+                self._file_lock.release()
+        finally:
+            self._thread_lock.release()
+
+    def __enter__(self) -> "_SessionLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.release()
+
+
+# The locks are dropped once no session holds or waits for them
+_SESSION_LOCKS: "weakref.WeakValueDictionary[str, _SessionLock]" = (
+    weakref.WeakValueDictionary()
+)
+_SESSION_LOCKS_GUARD = threading.Lock()
+
+
+def _session_lock(session_key: str) -> _SessionLock:
+    with _SESSION_LOCKS_GUARD:
+        lock = _SESSION_LOCKS.get(session_key)
+        if lock is None:
+            lock = _SessionLock(session_key)
+            _SESSION_LOCKS[session_key] = lock
+        return lock
+
+
+async def _acquire_session_lock_async(lock: _SessionLock) -> None:
+    """
+    Acquire the lock without blocking the loop, so that it also excludes the sessions in threads.
+    A contended lock is waited for in the default executor.
+    """
+    if lock.acquire(blocking=False):
+        return
+    loop = asyncio.get_event_loop()
+    future = loop.run_in_executor(None, lock.acquire)
+    try:
+        await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # Release it once the acquiring thread gets it
+        future.add_done_callback(
+            lambda f: lock.release()
+            if not f.cancelled() and f.exception() is None
+            else None
+        )
+        raise
+
+
 def _upload_fp(
     upload_service: upload_api_v4.UploadService,
     fp: T.IO[bytes],
@@ -411,6 +1598,75 @@ def _upload_fp(
     event_payload: Progress = None,
     emitter: EventEmitter = None,
 ) -> str:
+    # Sessions of the same content share the same session key on the server,
+    # so they must not be uploaded concurrently (by any process on the host). The later one
+    # waits here and then either resumes from the finished offset or gets cancelled by the upload history
+    with _session_lock(upload_service.session_key):
+        return upload_service.run(
+            _upload_steps(
+                upload_service,
+                fp,
+                chunk_size,
+                event_payload=event_payload,
+                emitter=emitter,
+            )
+        )
+
+
+def _prepare_retry(
+    ex: Exception,
+    retries: int,
+    offset: T.Optional[int],
+    uploading: bool,
+    upload_service: upload_api_v4.UploadService,
+    chunk_size_controller: upload_api_v4.ChunkSizeController,
+    mutable_payload: Progress,
+    emitter: T.Optional[EventEmitter] = None,
+) -> int:
+    """
+    Return the seconds to wait before retrying the interrupted upload, or raise the error
+    if it is not retriable.
+    """
+    if not (retries < MAX_RETRIES and is_retriable_exception(ex)):
+        # The session ends here, so deliver its last progress before the error is handled
+        if emitter:
+            emitter.flush(mutable_payload)
+        if isinstance(ex, requests.HTTPError):
+            raise upload_api_v4.wrap_http_exception(ex) from ex
+        else:
+            raise ex
+
+    sleep_for = min(2 ** (retries + 1), 16)
+    if emitter:
+        mutable_payload["throttled_time"] = upload_service.throttled_time
+        mutable_payload["retry_wait_time"] = sleep_for
+        emitter.emit("upload_interrupted", mutable_payload)
+    LOG.warning(
+        # use %s instead of %d because offset could be None
+        f"Error uploading chunk_size %d at offset %s: %s: %s",
+        chunk_size_controller.chunk_size,
+        offset,
+        ex.__class__.__name__,
+        str(ex),
+    )
+    # Smaller chunks waste less on the next interruption
+    if uploading:
+        chunk_size_controller.record_failure()
+    LOG.info("Retrying in %d seconds (%d/%d)", sleep_for, retries + 1, MAX_RETRIES)
+    return sleep_for
+
+
+def _upload_steps(
+    upload_service: upload_api_v4.UploadService,
+    fp: T.IO[bytes],
+    chunk_size: int,
+    event_payload: T.Optional[Progress] = None,
+    emitter: T.Optional[EventEmitter] = None,
+) -> T.Generator[upload_api_v4.Operation, T.Any, str]:
+    """
+    The upload session (retries and events included) in steps, which both engines run
+    with UploadService.run() and AsyncUploadService.run() respectively.
+    """
     retries = 0
 
     if event_payload is None:
@@ -426,57 +1682,67 @@ def _upload_fp(
     if emitter:
         emitter.emit("upload_start", mutable_payload)
 
-    MAX_RETRIES = 200
-
     offset = None
 
+    # chunk_size is the initial chunk size which is adapted to the network during uploading
+    chunk_size_controller = upload_api_v4.ChunkSizeController(
+        chunk_size,
+        MIN_CHUNK_SIZE,
+        MAX_CHUNK_SIZE,
+        max_rate=(
+            None
+            if upload_service.bandwidth_limiter is None
+            else upload_service.bandwidth_limiter.rate
+        ),
+    )
+
     while True:
         fp.seek(0, io.SEEK_SET)
+        uploading = False
         try:
-            offset = upload_service.fetch_offset()
+            fetch_offset_start = time.monotonic()
+            offset = yield upload_api_v4.FetchOffset()
             upload_service.callbacks = [_reset_retries]
             if emitter:
                 mutable_payload["offset"] = offset
                 mutable_payload["retries"] = retries
+                mutable_payload["fetch_offset_time"] = (
+                    time.monotonic() - fetch_offset_start
+                )
                 emitter.emit("upload_fetch_offset", mutable_payload)
                 upload_service.callbacks.append(
-                    _setup_callback(emitter, mutable_payload)
+                    _setup_callback(emitter, mutable_payload, upload_service)
                 )
-            file_handle = upload_service.upload(
-                fp, chunk_size=chunk_size, offset=offset
+            uploading = True
+            file_handle = yield from upload_service.upload_steps(
+                fp,
+                chunk_size=chunk_size_controller.chunk_size,
+                offset=offset,
+                chunk_size_controller=chunk_size_controller,
             )
         except Exception as ex:
-            if retries < MAX_RETRIES and is_retriable_exception(ex):
-                if emitter:
-                    emitter.emit("upload_interrupted", mutable_payload)
-                retries += 1
-                sleep_for = min(2**retries, 16)
-                LOG.warning(
-                    # use %s instead of %d because offset could be None
-                    f"Error uploading chunk_size %d at offset %s: %s: %s",
-                    chunk_size,
-                    offset,
-                    ex.__class__.__name__,
-                    str(ex),
-                )
-                LOG.info(
-                    "Retrying in %d seconds (%d/%d)", sleep_for, retries, MAX_RETRIES
-                )
-                time.sleep(sleep_for)
-            else:
-                if isinstance(ex, requests.HTTPError):
-                    raise upload_api_v4.wrap_http_exception(ex) from ex
-                else:
-                    raise ex
+            sleep_for = _prepare_retry(
+                ex,
+                retries,
+                offset,
+                uploading,
+                upload_service,
+                chunk_size_controller,
+                mutable_payload,
+                emitter=emitter,
+            )
+            retries += 1
+            yield upload_api_v4.Sleep(sleep_for)
         else:
             break
 
     if emitter:
+        mutable_payload["throttled_time"] = upload_service.throttled_time
         emitter.emit("upload_end", mutable_payload)
 
     # TODO: retry here
     try:
-        cluster_id = upload_service.finish(file_handle)
+        cluster_id = yield upload_api_v4.Finish(file_handle)
     except requests.HTTPError as ex:
         raise upload_api_v4.wrap_http_exception(ex) from ex
 
@@ -485,3 +1751,30 @@ def _upload_fp(
         emitter.emit("upload_finished", mutable_payload)
 
     return cluster_id
+
+
+async def _upload_fp_async(
+    async_upload_service: upload_api_v4.AsyncUploadService,
+    fp: T.IO[bytes],
+    chunk_size: int,
+    event_payload: T.Optional[Progress] = None,
+    emitter: T.Optional[EventEmitter] = None,
+) -> str:
+    """
+    Same as _upload_fp() (including the events emitted) but on the event loop.
+    """
+    upload_service = async_upload_service.service
+    lock = _session_lock(upload_service.session_key)
+    await _acquire_session_lock_async(lock)
+    try:
+        return await async_upload_service.run(
+            _upload_steps(
+                upload_service,
+                fp,
+                chunk_size,
+                event_payload=event_payload,
+                emitter=emitter,
+            )
+        )
+    finally:
+        lock.release()
@@ -0,0 +1,209 @@
+import bisect
+import contextlib
+import io
+import typing as T
+
+from . import file_hash_cache
+
+
+class FileChangedError(RuntimeError):
+    """
+    A file of the stream changed after the layout was recorded, so the stream has to be laid out again.
+    """
+
+    pass
+
+
+class _FileTail(T.NamedTuple):
+    path: str
+    # Where the tail starts in the file
+    offset: int
+    length: int
+    # The file must be unchanged since the layout was recorded
+    signature: file_hash_cache.FileSignature
+
+
+# (offset in the stream, content)
+_Segment = T.Tuple[int, T.Union[bytes, _FileTail]]
+
+
+def _segment_length(content: T.Union[bytes, _FileTail]) -> int:
+    if isinstance(content, _FileTail):
+        return content.length
+    return len(content)
+
+
+class LayoutRecorder(io.RawIOBase):
+    """
+    A writable and seekable sink for ZipFile that records the layout of the stream instead of its bytes.
+
+    The bytes written in file_tail() are recorded as references to the tail of the file,
+    and the others (headers, EXIF, etc.) are kept in memory.
+    Use to_stream() to read the recorded stream.
+    """
+
+    def __init__(self):
+        self._segments: T.List[_Segment] = []
+        self._offsets: T.List[int] = []
+        self._size = 0
+        self._pos = 0
+        self._tail_path: T.Optional[str] = None
+        self._tail_signature: T.Optional[file_hash_cache.FileSignature] = None
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        return self._pos
+
+    @contextlib.contextmanager
+    def file_tail(
+        self, path: str, signature: file_hash_cache.FileSignature
+    ) -> T.Generator[None, None, None]:
+        """
+        Record the bytes written in the context as the tail of the file, i.e. the last bytes until EOF.
+        The signature must be taken before the bytes were read from the file.
+        """
+        self._tail_path = path
+        self._tail_signature = signature
+        try:
+            yield
+        finally:
+            self._tail_path = None
+            self._tail_signature = None
+
+    def write(self, data) -> int:
+        length = len(data)
+
+        if self._pos == self._size:
+            content: T.Union[bytes, _FileTail]
+            if self._tail_path is None:
+                content = bytes(data)
+            else:
+                assert self._tail_signature is not None
+                signature = self._tail_signature
+                file_size = signature[0]
+                assert length <= file_size, "Expect the tail of the file"
+                content = _FileTail(
+                    self._tail_path, file_size - length, length, signature
+                )
+            self._offsets.append(self._pos)
+            self._segments.append((self._pos, content))
+            self._size += length
+        else:
+            # ZipFile seeks back only to rewrite the local headers (with the same size)
+            assert self._tail_path is None
+            idx = bisect.bisect_right(self._offsets, self._pos) - 1
+            offset, content = self._segments[idx]
+            assert isinstance(content, bytes), "Expect to overwrite in-memory bytes"
+            start = self._pos - offset
+            assert start + length <= len(
+                content
+            ), "Expect to overwrite within a segment"
+            content = content[:start] + bytes(data) + content[start + length :]
+            self._segments[idx] = (offset, content)
+
+        self._pos += length
+        return length
+
+    def to_stream(self) -> "VirtualFile":
+        return VirtualFile(self._segments)
+
+
+class VirtualFile(io.RawIOBase):
+    """
+    A readable and seekable stream of the recorded segments, read from the files on the fly.
+    """
+
+    def __init__(self, segments: T.List[_Segment]):
+        self._segments = segments
+        self._offsets = [offset for offset, _ in segments]
+        if segments:
+            last_offset, last_content = segments[-1]
+            self._size = last_offset + _segment_length(last_content)
+        else:
+            self._size = 0
+        self._pos = 0
+        self._fp: T.Optional[io.BufferedReader] = None
+        self._fp_path: T.Optional[str] = None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        return self._pos
+
+    def _open(self, tail: _FileTail) -> io.BufferedReader:
+        if self._fp is None or self._fp_path != tail.path:
+            self._close_fp()
+            fp = open(tail.path, "rb")
+            if file_hash_cache.file_signature(tail.path) != tail.signature:
+                fp.close()
+                raise FileChangedError(f"File changed while uploading: {tail.path}")
+            self._fp = fp
+            self._fp_path = tail.path
+        return self._fp
+
+    def _close_fp(self) -> None:
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+            self._fp_path = None
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        total = 0
+        # Fill the buffer across segments, so that read(n) returns n bytes until EOF like regular files
+        while total < len(view) and self._pos < self._size:
+            idx = bisect.bisect_right(self._offsets, self._pos) - 1
+            offset, content = self._segments[idx]
+            start = self._pos - offset
+            length = min(len(view) - total, _segment_length(content) - start)
+            target = view[total : total + length]
+
+            if isinstance(content, _FileTail):
+                fp = self._open(content)
+                fp.seek(content.offset + start)
+                if fp.readinto(target) != length:
+                    raise FileChangedError(
+                        f"File truncated while uploading: {content.path}"
+                    )
+            else:
+                target[:] = content[start : start + length]
+
+            self._pos += length
+            total += length
+
+        return total
+
+    def close(self) -> None:
+        self._close_fp()
+        super().close()
@@ -1,4 +1,8 @@
+import multiprocessing
+
 from mapillary_tools.commands.__main__ import main
 
 if __name__ == '__main__':
+    # Required by the worker processes in the frozen executables
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,74 @@
+import argparse
+import math
+import statistics
+import time
+
+import requests
+
+from mapillary_tools import api_v4, upload_api_v4
+
+
+def _time_requests(get, url: str, count: int) -> list:
+    elapsed = []
+    for _ in range(count):
+        start = time.perf_counter()
+        resp = get(url, timeout=api_v4.REQUESTS_TIMEOUT)
+        # Read the body so the connection is returned to the pool
+        resp.content
+        elapsed.append(time.perf_counter() - start)
+    return elapsed
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Measure the handshake time saved per upload by reusing connections"
+    )
+    parser.add_argument(
+        "url",
+        nargs="?",
+        default=upload_api_v4.MAPILLARY_UPLOAD_ENDPOINT,
+        help="[default: %(default)s]",
+    )
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument(
+        "--entity_size",
+        type=float,
+        default=1024,
+        help="Size (in MB) of the upload to estimate for. [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=float,
+        default=upload_api_v4.DEFAULT_CHUNK_SIZE / (1024 * 1024),
+        help="Chunk size (in MB). [default: %(default)s]",
+    )
+    return parser.parse_args()
+
+
+def main():
+    parsed_args = _parse_args()
+
+    # A new connection (TCP + TLS handshakes) for every request
+    fresh = _time_requests(requests.get, parsed_args.url, parsed_args.requests)
+
+    session = api_v4.create_session()
+    # Warm up the pool, then every request reuses the kept-alive connection
+    _time_requests(session.get, parsed_args.url, 1)
+    reused = _time_requests(session.get, parsed_args.url, parsed_args.requests)
+
+    saved = statistics.median(fresh) - statistics.median(reused)
+    # fetch_offset + chunks + the empty chunk to get the handle + finish_upload
+    request_count = (
+        1 + math.ceil(parsed_args.entity_size / parsed_args.chunk_size) + 1 + 1
+    )
+
+    print(f"new connection:    median {statistics.median(fresh) * 1000:.1f} ms")
+    print(f"reused connection: median {statistics.median(reused) * 1000:.1f} ms")
+    print(f"saved per request: {saved * 1000:.1f} ms")
+    print(
+        f"saved per upload:  {saved * request_count:.2f} s ({request_count} requests for {parsed_args.entity_size} MB in {parsed_args.chunk_size} MB chunks)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import argparse
+import os
+import time
+import typing as T
+
+import exifread
+
+from mapillary_tools import exif_read, simple_exif_parser, utils
+
+
+def _collect_images(paths: T.List[str]) -> T.List[str]:
+    filenames: T.List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(utils.get_image_file_list(path, abs_path=True))
+        else:
+            filenames.append(path)
+    return filenames
+
+
+def _extract(exif: exif_read.ExifRead) -> T.Dict:
+    return {
+        "capture_time": exif.extract_capture_time(),
+        "direction": exif.extract_direction(),
+        "model": exif.extract_model(),
+        "make": exif.extract_make(),
+        "lon_lat": exif.extract_lon_lat(),
+        "altitude": exif.extract_altitude(),
+        "orientation": exif.extract_orientation(),
+    }
+
+
+def _read_exifread(filename: str) -> T.Dict:
+    with open(filename, "rb") as fp:
+        return exifread.process_file(fp, details=False, debug=True)
+
+
+def _read_simple(filename: str) -> T.Dict:
+    with open(filename, "rb") as fp:
+        return exif_read._process_file(fp, details=False)
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare the EXIF reading time of exifread and the simple EXIF parser, and check that they extract the same values"
+    )
+    parser.add_argument("path", nargs="+", help="Images or image directories")
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def main():
+    parsed_args = _parse_args()
+    filenames = _collect_images(parsed_args.path)
+    print(f"{len(filenames)} images")
+
+    # Which images the simple parser does not handle
+    fallbacks = 0
+    for filename in filenames:
+        with open(filename, "rb") as fp:
+            try:
+                simple_exif_parser.parse_jpeg_exif(fp)
+            except simple_exif_parser.UnsupportedExifError:
+                fallbacks += 1
+
+    # The values extracted must be the same
+    mismatches = []
+    for filename in filenames:
+        exif = exif_read.ExifRead(filename)
+        expected = _extract(exif)
+        exif.tags = _read_exifread(filename)
+        actual = _extract(exif)
+        if expected != actual:
+            mismatches.append((filename, expected, actual))
+
+    results = {}
+    for name, read in [("exifread", _read_exifread), ("simple", _read_simple)]:
+        seconds = []
+        for _ in range(parsed_args.repeat):
+            start = time.perf_counter()
+            for filename in filenames:
+                read(filename)
+            seconds.append(time.perf_counter() - start)
+        results[name] = min(seconds)
+
+    for name, elapsed in results.items():
+        print(f"{name:>10}: {elapsed:.3f}s, {len(filenames) / elapsed:.1f} images/s")
+    if results["simple"]:
+        print(f"   speedup: {results['exifread'] / results['simple']:.1f}x")
+    print(f" fallbacks: {fallbacks}")
+    print(f"mismatches: {len(mismatches)}")
+    for filename, expected, actual in mismatches:
+        print(f"  {filename}: {expected} != {actual}")
+
+
+if __name__ == "__main__":
+    main()
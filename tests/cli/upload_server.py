@@ -0,0 +1,279 @@
+import argparse
+import http.server
+import json
+import random
+import socketserver
+import threading
+import time
+import typing as T
+import urllib.parse
+
+# Read and pace the request bodies in pieces of this size
+_READ_SIZE = 64 * 1024
+
+
+class UploadServerConfig(T.NamedTuple):
+    # Seconds added before every response
+    latency: float = 0.0
+    # Bytes per second to receive the chunks at, None means unlimited
+    bandwidth: T.Optional[float] = None
+    # Probability of failing a request (a 500 response, or a connection dropped mid-chunk)
+    error_ratio: float = 0.0
+    # Seed the error injection so that the failures are reproducible
+    seed: T.Optional[int] = None
+    # Inject the errors into finish_upload too, which the client does not retry
+    finish_errors: bool = True
+
+
+class UploadServerStats(T.NamedTuple):
+    requests: int
+    fetch_offset_requests: int
+    chunk_requests: int
+    finish_requests: int
+    injected_errors: int
+    received_bytes: int
+    # Bytes received more than once (partial chunks and retransmissions)
+    wasted_bytes: int
+
+
+class UploadServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    A local stand-in for the upload endpoints used by UploadService:
+
+    - GET {MAPILLARY_UPLOAD_ENDPOINT}/{session_key}: fetch the offset
+    - POST {MAPILLARY_UPLOAD_ENDPOINT}/{session_key}: upload a chunk at the Offset header
+    - POST {MAPILLARY_GRAPH_API_ENDPOINT}/finish_upload: create the cluster
+
+    The uploaded entities are kept in memory.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address: T.Tuple[str, int] = ("127.0.0.1", 0),
+        config: UploadServerConfig = UploadServerConfig(),
+    ):
+        super().__init__(address, _UploadRequestHandler)
+        self.config = config
+        self.entities: T.Dict[str, bytearray] = {}
+        self.finished: T.Dict[str, T.Dict] = {}
+        self._random = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self._counters = {field: 0 for field in UploadServerStats._fields}
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def upload_endpoint(self) -> str:
+        return f"{self.url}/mapillary_public_uploads"
+
+    @property
+    def graph_api_endpoint(self) -> str:
+        return self.url
+
+    def stats(self) -> UploadServerStats:
+        with self._lock:
+            return UploadServerStats(**self._counters)
+
+    def count(self, field: str, value: int = 1) -> None:
+        with self._lock:
+            self._counters[field] += value
+
+    def inject_error(self) -> bool:
+        with self._lock:
+            injected = self._random.random() < self.config.error_ratio
+            if injected:
+                self._counters["injected_errors"] += 1
+        return injected
+
+    def partial_size(self, size: int) -> int:
+        with self._lock:
+            return self._random.randint(0, size)
+
+    def finish(self, data: T.Dict) -> str:
+        with self._lock:
+            cluster_id = str(len(self.finished) + 1)
+            self.finished[cluster_id] = data
+        return cluster_id
+
+
+class _UploadRequestHandler(http.server.BaseHTTPRequestHandler):
+    server: UploadServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        # Keep the benchmark output clean
+        pass
+
+    def _respond(self, status: int, payload: T.Dict) -> None:
+        if self.server.config.latency:
+            time.sleep(self.server.config.latency)
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _respond_error(self, status: int, message: str, retriable: bool) -> None:
+        self._respond(
+            status,
+            {"error": {"message": message}, "debug_info": {"retriable": retriable}},
+        )
+
+    def _read_body(self, size: int) -> bytes:
+        bandwidth = self.server.config.bandwidth
+        start_time = time.monotonic()
+        pieces = []
+        received = 0
+        while received < size:
+            piece = self.rfile.read(min(_READ_SIZE, size - received))
+            if not piece:
+                break
+            pieces.append(piece)
+            received += len(piece)
+            if bandwidth:
+                ahead = received / bandwidth - (time.monotonic() - start_time)
+                if 0 < ahead:
+                    time.sleep(ahead)
+        return b"".join(pieces)
+
+    def _session_key(self) -> str:
+        path = urllib.parse.urlparse(self.path).path
+        return path.rstrip("/").rsplit("/", 1)[-1]
+
+    def do_GET(self) -> None:
+        self.server.count("requests")
+        self.server.count("fetch_offset_requests")
+        if self.server.inject_error():
+            self._respond_error(500, "Injected error", retriable=True)
+            return
+        entity = self.server.entities.get(self._session_key(), bytearray())
+        self._respond(200, {"offset": len(entity)})
+
+    def do_POST(self) -> None:
+        self.server.count("requests")
+        if self._session_key() == "finish_upload":
+            self._finish()
+        else:
+            self._upload_chunk()
+
+    def _finish(self) -> None:
+        self.server.count("finish_requests")
+        data = json.loads(self._read_body(int(self.headers["Content-Length"])))
+        if self.server.config.finish_errors and self.server.inject_error():
+            self._respond_error(500, "Injected error", retriable=True)
+            return
+        self._respond(200, {"cluster_id": self.server.finish(data)})
+
+    def _upload_chunk(self) -> None:
+        self.server.count("chunk_requests")
+        session_key = self._session_key()
+        size = int(self.headers.get("Content-Length", 0))
+        offset = int(self.headers["Offset"])
+        entity_size = int(self.headers["X-Entity-Length"])
+        entity = self.server.entities.setdefault(session_key, bytearray())
+
+        if offset > len(entity):
+            self._discard_body(size)
+            self._respond_error(
+                400,
+                f"Offset {offset} is beyond the uploaded size {len(entity)}",
+                retriable=False,
+            )
+            return
+
+        if self.server.inject_error():
+            partial_size = self.server.partial_size(size)
+            if partial_size < size:
+                # Drop the connection in the middle of the chunk, and keep what is received
+                # so that the client resumes from the offset
+                self._receive(entity, offset, self._read_body(partial_size))
+                self.close_connection = True
+            else:
+                self._discard_body(size)
+                self._respond_error(500, "Injected error", retriable=True)
+            return
+
+        chunk = self._read_body(size)
+        self._receive(entity, offset, chunk)
+        if entity_size < len(entity):
+            self._respond_error(
+                400,
+                f"Uploaded {len(entity)} bytes but the entity size is {entity_size}",
+                retriable=False,
+            )
+            return
+        self._respond(200, {"h": f"handle_{session_key}"})
+
+    def _discard_body(self, size: int) -> None:
+        self.server.count("received_bytes", len(self._read_body(size)))
+        self.server.count("wasted_bytes", size)
+
+    def _receive(self, entity: bytearray, offset: int, chunk: bytes) -> None:
+        self.server.count("received_bytes", len(chunk))
+        # Bytes before the current size were received before
+        self.server.count("wasted_bytes", min(len(entity) - offset, len(chunk)))
+        entity[offset : offset + len(chunk)] = chunk
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Serve a local stand-in for the upload endpoints, for benchmarking uploads offline"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Seconds added before every response. [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        help="Receive the chunks at this rate (in MB/s). [default: unlimited]",
+    )
+    parser.add_argument(
+        "--error_ratio",
+        type=float,
+        default=0.0,
+        help="Probability of failing a request. [default: %(default)s]",
+    )
+    parser.add_argument("--seed", type=int, help="Seed the error injection")
+    return parser.parse_args()
+
+
+def main():
+    parsed_args = _parse_args()
+    server = UploadServer(
+        (parsed_args.host, parsed_args.port),
+        UploadServerConfig(
+            latency=parsed_args.latency,
+            bandwidth=(
+                None
+                if parsed_args.bandwidth is None
+                else parsed_args.bandwidth * 1024 * 1024
+            ),
+            error_ratio=parsed_args.error_ratio,
+            seed=parsed_args.seed,
+        ),
+    )
+    print("Upload with:")
+    print(f"  export MAPILLARY_UPLOAD_ENDPOINT={server.upload_endpoint}")
+    print(f"  export MAPILLARY_GRAPH_API_ENDPOINT={server.graph_api_endpoint}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats()._asdict(), indent=2))
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import argparse
+import os
+import tempfile
+import time
+import typing as T
+
+from mapillary_tools import types, uploader, utils
+
+
+def _collect_sequence(paths: T.List[str]) -> T.Dict[str, types.ImageDescriptionFile]:
+    filenames: T.List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(utils.get_image_file_list(path, abs_path=True))
+        else:
+            filenames.append(path)
+
+    sequence: T.Dict[str, types.ImageDescriptionFile] = {}
+    for idx, filename in enumerate(filenames):
+        sequence[filename] = T.cast(
+            types.ImageDescriptionFile,
+            {
+                "MAPLatitude": 58.5927694,
+                "MAPLongitude": 16.1840944,
+                "MAPCaptureTime": f"2021_02_13_13_24_{idx % 60:02d}_{idx // 60 % 1000:03d}",
+                "filename": filename,
+            },
+        )
+    return sequence
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare CPU time and ZIP size of the zip compression policies"
+    )
+    parser.add_argument("path", nargs="+", help="Images or image directories")
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+def main():
+    parsed_args = _parse_args()
+    sequence = _collect_sequence(parsed_args.path)
+    total_size = sum(os.path.getsize(filename) for filename in sequence)
+    print(f"{len(sequence)} images, {total_size / (1024 * 1024):.2f} MB in total")
+
+    results = {}
+    for compression in ["stored", "deflated", "auto"]:
+        cpu_times = []
+        for _ in range(parsed_args.repeat):
+            with tempfile.TemporaryFile() as fp:
+                start = time.process_time()
+                uploader._zip_sequence_fp(
+                    sequence,
+                    fp,
+                    compression=T.cast(uploader.ZipCompression, compression),
+                )
+                cpu_times.append(time.process_time() - start)
+                zip_size = fp.tell()
+        results[compression] = (min(cpu_times), zip_size)
+
+    stored_time, stored_size = results["stored"]
+    for compression, (cpu_time, zip_size) in results.items():
+        print(
+            f"{compression:>8}: CPU {cpu_time:8.3f} s ({cpu_time - stored_time:+.3f} s)  size {zip_size:12d} B ({zip_size - stored_size:+d} B, {100 * (zip_size - stored_size) / stored_size:+.2f}%)"
+        )
+
+
+if __name__ == "__main__":
+    main()
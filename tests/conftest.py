@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+from mapillary_tools import constants, exif_cache, file_hash_cache, upload
+
+# The paths in the user data directory, overridden by MAPILLARY_TOOLS_<NAME>
+_USER_DATA_PATHS = {
+    "FILE_HASH_CACHE_PATH": "file_hash_cache.sqlite3",
+    "EXIF_CACHE_PATH": "exif_cache.sqlite3",
+    "UPLOAD_LOCK_DIR": "upload_locks",
+    "UPLOAD_BANDWIDTH_BUDGET_PATH": "upload_bandwidth_budget.json",
+}
+
+
+@pytest.fixture(autouse=True)
+def isolate_user_data(tmp_path_factory, monkeypatch):
+    """
+    Keep the caches, locks and the upload history of each test in a temporary directory
+    instead of the user data directory, for this process and the commands run by the tests
+    """
+    user_data_dir = str(tmp_path_factory.mktemp("user_data"))
+    for name, basename in _USER_DATA_PATHS.items():
+        path = os.path.join(user_data_dir, basename)
+        monkeypatch.setenv(constants._ENV_PREFIX + name, path)
+        monkeypatch.setattr(constants, name, path)
+
+    history_path = os.path.join(user_data_dir, "upload_history")
+    monkeypatch.setenv("MAPILLARY_UPLOAD_HISTORY_PATH", history_path)
+    monkeypatch.setattr(upload, "MAPILLARY_UPLOAD_HISTORY_PATH", history_path)
+
+    # The default instances are opened lazily on the paths above
+    monkeypatch.setattr(file_hash_cache, "_DEFAULT_CACHE", None)
+    monkeypatch.setattr(exif_cache, "_DEFAULT_CACHE", None)
+    yield
+    for default in [
+        file_hash_cache._DEFAULT_CACHE,
+        exif_cache._DEFAULT_CACHE,
+    ]:
+        if default is not None:
+            default.close()
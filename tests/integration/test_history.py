@@ -73,3 +73,33 @@ def test_upload_blackvue(
     assert (
         len(setup_upload.listdir()) == 0
     ), "should NOT upload because it is uploaded already"
+
+
+def test_upload_images_write_legacy_history(
+    setup_data: py.path.local,
+    setup_config: py.path.local,
+    setup_history_path: py.path.local,
+    setup_upload: py.path.local,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    x = subprocess.run(
+        f"{EXECUTABLE} process_and_upload {str(setup_data)} --dry_run --user_name={USERNAME}",
+        shell=True,
+    )
+    assert x.returncode == 0, x.stderr
+    # The SQLite database only by default
+    assert [path.basename for path in setup_history_path.listdir()] == [
+        "upload_history.sqlite3"
+    ]
+    for upload in setup_upload.listdir():
+        upload.remove()
+    setup_history_path.join("upload_history.sqlite3").remove()
+
+    monkeypatch.setenv("MAPILLARY_WRITE_LEGACY_UPLOAD_HISTORY", "YES")
+    x = subprocess.run(
+        f"{EXECUTABLE} process_and_upload {str(setup_data)} --dry_run --user_name={USERNAME}",
+        shell=True,
+    )
+    assert x.returncode == 0, x.stderr
+    legacy_paths = list(setup_history_path.visit("*.json"))
+    assert 0 < len(legacy_paths) == len(setup_upload.listdir())
@@ -73,6 +73,119 @@ def test_process(setup_data: py.path.local):
         assert os.path.isfile(os.path.join(setup_data, desc["filename"]))
 
 
+def test_process_workers(setup_data: py.path.local):
+    images = setup_data.listdir(lambda path: path.ext.lower() == ".jpg")
+    for idx in range(5):
+        for image in images:
+            image.copy(setup_data.join(f"copy_{idx}_{image.basename}"))
+    setup_data.join("broken.jpg").write_binary(b"not an image")
+    desc_path = os.path.join(setup_data, "mapillary_image_description.json")
+    all_descs = []
+    for workers in [1, 3]:
+        x = subprocess.run(
+            f"{EXECUTABLE} process {setup_data} --workers {workers} --skip_process_errors",
+            shell=True,
+        )
+        assert x.returncode == 0, x.stderr
+        with open(desc_path) as fp:
+            descs = json.load(fp)
+        for desc in descs:
+            # Generated randomly
+            desc.pop("MAPSequenceUUID", None)
+        all_descs.append(descs)
+    # Same results (including the errors) in the same order
+    assert all_descs[0] == all_descs[1]
+    assert any("error" in desc for desc in all_descs[0])
+
+
+def test_process_incremental(setup_data: py.path.local):
+    images = setup_data.listdir(lambda path: path.ext.lower() == ".jpg")
+    for image in images:
+        # Not stored if modified just now
+        os.utime(image, (0, 0))
+    state_path = setup_data.join("mapillary_geotag_state.json")
+    desc_path = setup_data.join("mapillary_image_description.json")
+
+    def _process(options: str = ""):
+        x = subprocess.run(
+            f"{EXECUTABLE} process {setup_data} --incremental {options}",
+            shell=True,
+        )
+        assert x.returncode == 0, x.stderr
+        with desc_path.open() as fp:
+            return {desc["filename"]: desc for desc in json.load(fp)}
+
+    descs = _process()
+    state = json.loads(state_path.read())
+    assert set(state["images"]) == set(descs)
+
+    # The unchanged images are not geotagged again
+    first, second = sorted(descs)[:2]
+    state["images"][first]["desc"]["MAPAltitude"] = 1234.5
+    state["images"][second]["desc"]["MAPAltitude"] = 1234.5
+    state_path.write(json.dumps(state))
+    os.utime(setup_data.join(second), (1, 1))
+    descs = _process()
+    assert descs[first]["MAPAltitude"] == 1234.5
+    assert descs[second]["MAPAltitude"] != 1234.5
+
+    # The new images are geotagged
+    setup_data.join(first).copy(setup_data.join("new.jpg"))
+    os.utime(setup_data.join("new.jpg"), (0, 0))
+    descs = _process()
+    assert descs["new.jpg"]["MAPLatitude"] == descs[first]["MAPLatitude"]
+    assert "new.jpg" in json.loads(state_path.read())["images"]
+
+    # All images are geotagged if the options change
+    descs = _process("--geotag_source exif --skip_subfolders")
+    state = json.loads(state_path.read())
+    state["images"][first]["desc"]["MAPAltitude"] = 1234.5
+    state["options"]["geotag_source"] = "gpx"
+    state_path.write(json.dumps(state))
+    descs = _process()
+    assert descs[first]["MAPAltitude"] != 1234.5
+
+
+def test_process_incremental_invalid_state(setup_data: py.path.local):
+    images = setup_data.listdir(lambda path: path.ext.lower() == ".jpg")
+    for image in images:
+        os.utime(image, (0, 0))
+    state_path = setup_data.join("mapillary_geotag_state.json")
+    desc_path = setup_data.join("mapillary_image_description.json")
+
+    def _process():
+        x = subprocess.run(
+            f"{EXECUTABLE} process {setup_data} --incremental",
+            shell=True,
+        )
+        assert x.returncode == 0, x.stderr
+        with desc_path.open() as fp:
+            # The sequence UUIDs are random
+            return {
+                desc["filename"]: {
+                    key: value
+                    for key, value in desc.items()
+                    if key != "MAPSequenceUUID"
+                }
+                for desc in json.load(fp)
+            }
+
+    expected = _process()
+    state = json.loads(state_path.read())
+    first, second = sorted(expected)[:2]
+
+    # Edited by hand: an entry without the description drops the state
+    state["images"][first]["desc"]["MAPAltitude"] = 1234.5
+    del state["images"][second]["desc"]
+    state_path.write(json.dumps(state))
+    assert _process() == expected
+
+    # Truncated
+    state_path.write(state_path.read()[:100])
+    assert _process() == expected
+    assert set(json.loads(state_path.read())["images"]) == set(expected)
+
+
 def validate_and_extract_zip(filename: str):
     basename = os.path.basename(filename)
     assert basename.startswith("mly_tools_"), filename
@@ -136,6 +249,33 @@ def test_upload_image_dir(
     assert x.returncode == 0, x.stderr
 
 
+def test_upload_metrics(
+    tmpdir: py.path.local,
+    setup_config: py.path.local,
+    setup_data: py.path.local,
+    setup_upload: py.path.local,
+):
+    x = subprocess.run(
+        f"{EXECUTABLE} process {setup_data}",
+        shell=True,
+    )
+    assert x.returncode == 0, x.stderr
+    metrics_path = tmpdir.join("metrics.json")
+    x = subprocess.run(
+        f"{EXECUTABLE} upload {setup_data} --dry_run --user_name={USERNAME} --upload_metrics_path {metrics_path}",
+        shell=True,
+    )
+    assert x.returncode == 0, x.stderr
+    assert "counters" in json.loads(metrics_path.read())
+
+    # Failing to write the metrics does not fail the upload
+    x = subprocess.run(
+        f"{EXECUTABLE} upload {setup_data} --dry_run --user_name={USERNAME} --upload_metrics_path {tmpdir.join('not_found', 'metrics.json')}",
+        shell=True,
+    )
+    assert x.returncode == 0, x.stderr
+
+
 def test_upload_image_dir_twice(
     tmpdir: py.path.local,
     setup_config: py.path.local,
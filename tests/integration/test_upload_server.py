@@ -0,0 +1,197 @@
+import io
+import os
+import threading
+import time
+import typing as T
+
+import py.path
+import pytest
+import requests
+
+from mapillary_tools import exceptions, upload_api_v4, uploader
+
+from ..cli import upload_server
+
+
+def _start_server(
+    monkeypatch: pytest.MonkeyPatch, config: upload_server.UploadServerConfig
+) -> upload_server.UploadServer:
+    server = upload_server.UploadServer(config=config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(
+        upload_api_v4, "MAPILLARY_UPLOAD_ENDPOINT", server.upload_endpoint
+    )
+    monkeypatch.setattr(
+        upload_api_v4, "MAPILLARY_GRAPH_API_ENDPOINT", server.graph_api_endpoint
+    )
+    return server
+
+
+@pytest.fixture
+def start_server(monkeypatch: pytest.MonkeyPatch):
+    servers: T.List[upload_server.UploadServer] = []
+
+    def _start(config=upload_server.UploadServerConfig()):
+        servers.append(_start_server(monkeypatch, config))
+        return servers[-1]
+
+    yield _start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize("upload_engine", ["threads", "asyncio"])
+def test_upload_zipfile(tmpdir: py.path.local, start_server, upload_engine):
+    server = start_server()
+    zip_dir = tmpdir.mkdir("zip_dir")
+    uploader.zip_images(
+        [
+            {
+                "MAPLatitude": 58.5927694,
+                "MAPLongitude": 16.1840944,
+                "MAPCaptureTime": "2021_02_13_13_24_41_140",
+                "filename": "tests/unit/data/test_exif.jpg",
+            }
+        ],
+        str(zip_dir),
+    )
+    zip_path = zip_dir.listdir()[0]
+    mly_uploader = uploader.Uploader(
+        {"user_upload_token": "YOUR_USER_ACCESS_TOKEN", "MAPOrganizationKey": 1234},
+        upload_engine=upload_engine,
+    )
+    assert mly_uploader.upload_zipfile(str(zip_path)) == "1"
+
+    assert server.entities[zip_path.basename] == zip_path.read_binary()
+    assert server.finished["1"] == {
+        "file_handle": f"handle_{zip_path.basename}",
+        "file_type": "zip",
+        "organization_id": 1234,
+    }
+    stats = server.stats()
+    assert stats.injected_errors == 0
+    assert stats.wasted_bytes == 0
+    assert stats.received_bytes == zip_path.size()
+
+
+def _upload_with_retries(content: bytes) -> None:
+    service = upload_api_v4.UploadService(
+        user_access_token="YOUR_USER_ACCESS_TOKEN",
+        session_key="mly_tools_test.zip",
+        entity_size=len(content),
+    )
+    while True:
+        try:
+            offset = service.fetch_offset()
+            service.upload(io.BytesIO(content), offset=offset, chunk_size=64 * 1024)
+            return
+        except (requests.ConnectionError, requests.HTTPError):
+            pass
+
+
+def test_error_injection(start_server):
+    content = os.urandom(1024 * 1024)
+    config = upload_server.UploadServerConfig(error_ratio=0.3, seed=42)
+
+    server = start_server(config)
+    _upload_with_retries(content)
+    assert server.entities["mly_tools_test.zip"] == content
+    stats = server.stats()
+    assert 0 < stats.injected_errors
+    assert len(content) + stats.wasted_bytes == stats.received_bytes
+
+    # The same seed injects the same errors
+    other_server = start_server(config)
+    _upload_with_retries(content)
+    assert other_server.entities["mly_tools_test.zip"] == content
+    assert other_server.stats() == stats
+
+
+def _zip_sequences(zip_dir: py.path.local) -> T.List[py.path.local]:
+    uploader.zip_images(
+        [
+            {
+                "MAPLatitude": 58.5927694,
+                "MAPLongitude": 16.1840944,
+                "MAPCaptureTime": "2021_02_13_13_24_41_140",
+                "filename": f"tests/unit/data/{filename}",
+                "MAPSequenceUUID": f"sequence_{idx}",
+            }
+            for idx, filename in enumerate(
+                ["test_exif.jpg", "fixed_exif.jpg", "fixed_exif_2.jpg"]
+            )
+        ],
+        str(zip_dir),
+    )
+    return zip_dir.listdir()
+
+
+def test_upload_zipfiles_asyncio(
+    tmpdir: py.path.local, start_server, monkeypatch: pytest.MonkeyPatch
+):
+    # Every request takes the latency, so the sessions overlap only if the requests do not block the loop
+    server = start_server(upload_server.UploadServerConfig(latency=0.5))
+    zip_paths = _zip_sequences(tmpdir.mkdir("zip_dir"))
+
+    def _blocking_request(*args, **kwargs):
+        raise AssertionError("Expect no blocking requests")
+
+    monkeypatch.setattr(requests.Session, "request", _blocking_request)
+    emitter = uploader.EventEmitter()
+    threads = set()
+
+    @emitter.on("upload_progress")
+    def _upload_progress(payload):
+        threads.add(threading.get_ident())
+
+    mly_uploader = uploader.Uploader(
+        {"user_upload_token": "YOUR_USER_ACCESS_TOKEN"},
+        emitter=emitter,
+        upload_workers=len(zip_paths),
+        upload_engine="asyncio",
+    )
+    start_time = time.monotonic()
+    cluster_ids = mly_uploader.execute_sessions(
+        mly_uploader.upload_zipfile,
+        mly_uploader.upload_zipfile_async,
+        [str(zip_path) for zip_path in zip_paths],
+    )
+    # 4 requests per session (fetch offset, the chunk, the empty chunk and finish)
+    assert time.monotonic() - start_time < 4 * 0.5 * 2
+    assert sorted(cluster_ids) == ["1", "2", "3"]
+    # All on the loop
+    assert threads == {threading.get_ident()}
+    for zip_path in zip_paths:
+        assert server.entities[zip_path.basename] == zip_path.read_binary()
+
+
+def test_upload_zipfiles_asyncio_with_errors(tmpdir: py.path.local, start_server):
+    server = start_server(
+        upload_server.UploadServerConfig(error_ratio=0.2, seed=1, finish_errors=False)
+    )
+    zip_paths = _zip_sequences(tmpdir.mkdir("zip_dir"))
+    mly_uploader = uploader.Uploader(
+        {"user_upload_token": "YOUR_USER_ACCESS_TOKEN"},
+        upload_workers=len(zip_paths),
+        upload_engine="asyncio",
+    )
+    cluster_ids = mly_uploader.execute_sessions(
+        mly_uploader.upload_zipfile,
+        mly_uploader.upload_zipfile_async,
+        [str(zip_path) for zip_path in zip_paths],
+    )
+    assert len(set(cluster_ids)) == len(zip_paths)
+    assert 0 < server.stats().injected_errors
+    for zip_path in zip_paths:
+        assert server.entities[zip_path.basename] == zip_path.read_binary()
+
+
+def test_asyncio_engine_with_proxy(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.delenv("NO_PROXY", raising=False)
+    monkeypatch.delenv("no_proxy", raising=False)
+    monkeypatch.setenv("HTTPS_PROXY", "http://proxy:3128")
+    with pytest.raises(exceptions.MapillaryBadParameterError):
+        uploader.Uploader(
+            {"user_upload_token": "YOUR_USER_ACCESS_TOKEN"}, upload_engine="asyncio"
+        )
@@ -0,0 +1,179 @@
+import asyncio
+import typing as T
+
+import pytest
+import requests
+
+from mapillary_tools import async_http, upload_api_v4
+
+
+class _Server:
+    """
+    A raw HTTP server that replies to each request with the next response in the list.
+    """
+
+    def __init__(self, responses: T.List[bytes]):
+        self.responses = responses
+        self.connections = 0
+        self.bodies: T.List[bytes] = []
+        self.port = 0
+        self._server: T.Optional[asyncio.AbstractServer] = None
+
+    async def _handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.connections += 1
+        while self.responses:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in head.decode("latin-1").split("\r\n"):
+                name, _, value = line.partition(":")
+                if name.lower() == "content-length":
+                    length = int(value)
+            self.bodies.append(await reader.readexactly(length))
+            response = self.responses.pop(0)
+            if not response:
+                # Drop the connection without replying
+                break
+            writer.write(response)
+            await writer.drain()
+        writer.close()
+
+    async def __aenter__(self) -> "_Server":
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        assert self._server is not None
+        self._server.close()
+        await self._server.wait_closed()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/path?q=1"
+
+
+def _ok(body: bytes = b"{}") -> bytes:
+    return b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(body) + body
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_keep_alive():
+    async def _test():
+        client = async_http.AsyncHTTPClient()
+        async with _Server([_ok(b'{"offset": 1}'), _ok(b'{"offset": 2}')]) as server:
+            resp = await client.request("GET", server.url)
+            assert resp.json() == {"offset": 1}
+            resp = await client.request("POST", server.url, data=memoryview(b"abc"))
+            assert resp.json() == {"offset": 2}
+            assert server.connections == 1
+            assert server.bodies == [b"", b"abc"]
+        client.close()
+
+    _run(_test())
+
+
+def test_chunked_response():
+    async def _test():
+        client = async_http.AsyncHTTPClient()
+        response = (
+            b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+            b'5\r\n{"h":\r\n4\r\n"x"}\r\n0\r\n\r\n'
+        )
+        async with _Server([response]) as server:
+            resp = await client.request("POST", server.url, json_data={"a": 1})
+            assert resp.json() == {"h": "x"}
+            assert server.bodies == [b'{"a": 1}']
+        client.close()
+
+    _run(_test())
+
+
+def test_retry_closed_idle_connection():
+    async def _test():
+        client = async_http.AsyncHTTPClient()
+        # The server closes the idle connection after the first response
+        async with _Server([_ok(), b""]) as server:
+            await client.request("GET", server.url)
+            server.responses.append(_ok(b'{"offset": 3}'))
+            resp = await client.request("GET", server.url)
+            assert resp.json() == {"offset": 3}
+            assert server.connections == 2
+        client.close()
+
+    _run(_test())
+
+
+def test_errors():
+    async def _test():
+        client = async_http.AsyncHTTPClient()
+        not_found = b"HTTP/1.1 404 Not Found\r\nContent-Length: 2\r\n\r\n{}"
+        async with _Server([not_found, b""]) as server:
+            resp = await client.request("GET", server.url)
+            with pytest.raises(requests.HTTPError) as excinfo:
+                resp.raise_for_status()
+            assert excinfo.value.response.status_code == 404
+            assert "GET" in str(upload_api_v4.wrap_http_exception(excinfo.value))
+
+            # Dropped by the server on a new connection
+            client.close()
+            with pytest.raises(requests.ConnectionError):
+                await client.request("GET", server.url)
+
+        # Refused
+        with pytest.raises(requests.ConnectionError):
+            await client.request("GET", server.url)
+
+        # No response in time
+        async def _no_response(reader, writer):
+            # Until the client gives up
+            await reader.read()
+            writer.close()
+
+        silent = await asyncio.start_server(_no_response, "127.0.0.1", 0)
+        port = silent.sockets[0].getsockname()[1]
+        with pytest.raises(requests.Timeout):
+            await client.request("GET", f"http://127.0.0.1:{port}/", timeout=0.1)
+        silent.close()
+        await silent.wait_closed()
+        client.close()
+
+    _run(_test())
+
+
+def test_throttle():
+    async def _test():
+        client = async_http.AsyncHTTPClient()
+        sizes = []
+
+        async def _throttle(size: int) -> None:
+            sizes.append(size)
+
+        data = b"x" * (async_http.WRITE_BLOCK_SIZE * 2 + 1)
+        async with _Server([_ok()]) as server:
+            await client.request("POST", server.url, data=data, throttle=_throttle)
+            assert server.bodies == [data]
+        assert sizes == [async_http.WRITE_BLOCK_SIZE, async_http.WRITE_BLOCK_SIZE, 1]
+        client.close()
+
+    _run(_test())
+
+
+def test_environment_proxy(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.delenv("NO_PROXY", raising=False)
+    monkeypatch.delenv("no_proxy", raising=False)
+    monkeypatch.setenv("HTTPS_PROXY", "http://proxy:3128")
+    assert (
+        async_http.environment_proxy("https://graph.mapillary.com")
+        == "http://proxy:3128"
+    )
+    monkeypatch.setenv("NO_PROXY", "mapillary.com")
+    assert async_http.environment_proxy("https://graph.mapillary.com") is None
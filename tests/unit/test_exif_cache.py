@@ -0,0 +1,83 @@
+import os
+
+import py.path
+import pytest
+
+from mapillary_tools import exif_cache, exif_read
+
+
+this_file_dir = os.path.dirname(os.path.abspath(__file__))
+TEST_EXIF_FILE = os.path.join(this_file_dir, "data", "test_exif.jpg")
+
+
+def _extract(exif) -> dict:
+    return {
+        "lon_lat": exif.extract_lon_lat(),
+        "capture_time": exif.extract_capture_time(),
+        "direction": exif.extract_direction(),
+        "altitude": exif.extract_altitude(),
+        "orientation": exif.extract_orientation(),
+        "make": exif.extract_make(),
+        "model": exif.extract_model(),
+    }
+
+
+@pytest.fixture
+def image_path(tmpdir: py.path.local) -> str:
+    path = tmpdir.join("image.jpg")
+    py.path.local(TEST_EXIF_FILE).copy(path)
+    # Old enough to be cached
+    os.utime(str(path), (1000, 1000))
+    return str(path)
+
+
+def test_read_exif(tmpdir: py.path.local, image_path: str, monkeypatch):
+    cache = exif_cache.ExifCache(str(tmpdir.join("cache.sqlite3")))
+    expected = _extract(exif_read.ExifRead(image_path))
+    assert expected["capture_time"] is not None
+
+    exif = cache.read_exif(image_path)
+    assert isinstance(exif, exif_cache.CachedExif)
+    assert _extract(exif) == expected
+
+    # Read from the cache without reading the image
+    def _fail(path):
+        raise AssertionError(f"read {path}")
+
+    monkeypatch.setattr(exif_cache, "ExifRead", _fail)
+    assert _extract(cache.read_exif(image_path)) == expected
+
+    # Persisted across instances
+    cache.close()
+    cache = exif_cache.ExifCache(str(tmpdir.join("cache.sqlite3")))
+    assert _extract(cache.read_exif(image_path)) == expected
+
+    # Not used by other versions
+    monkeypatch.setattr(exif_cache, "VERSION", "0.0.0")
+    with pytest.raises(AssertionError):
+        cache.read_exif(image_path)
+    monkeypatch.undo()
+
+    # Modified
+    os.utime(image_path, (2000, 2000))
+    signature = exif_cache.file_hash_cache.file_signature(image_path)
+    assert cache.get(image_path, signature) is None
+    assert _extract(cache.read_exif(image_path)) == expected
+    assert cache.get(image_path, signature) is not None
+
+
+def test_racy_image(tmpdir: py.path.local, image_path: str):
+    cache = exif_cache.ExifCache(str(tmpdir.join("cache.sqlite3")))
+    # Modified just now so it could be modified again without changing the mtime
+    os.utime(image_path)
+    signature = exif_cache.file_hash_cache.file_signature(image_path)
+    assert isinstance(cache.read_exif(image_path), exif_cache.CachedExif)
+    assert cache.get(image_path, signature) is None
+
+
+def test_invalid_cache_path(tmpdir: py.path.local, image_path: str):
+    # A directory can not be opened as a database
+    cache = exif_cache.ExifCache(str(tmpdir.mkdir("cache")))
+    expected = _extract(exif_read.ExifRead(image_path))
+    assert _extract(cache.read_exif(image_path)) == expected
+    assert _extract(cache.read_exif(image_path)) == expected
@@ -5,7 +5,10 @@ import unittest
 
 import py.path
 
-from mapillary_tools.exif_write import ExifEdit
+import piexif
+import pytest
+
+from mapillary_tools.exif_write import ExifEdit, read_image_header
 from mapillary_tools.geo import decimal_to_dms
 from PIL import ExifTags, Image, TiffImagePlugin
 
@@ -389,5 +392,76 @@ def test_exif_write(tmpdir: py.path.local):
         assert image_bytes == content
 
 
+def test_dump_image_chunks():
+    for filename in [
+        EMPTY_EXIF_FILE,
+        CORRUPT_EXIF_FILE,
+        CORRUPT_EXIF_FILE_2,
+        FIXED_EXIF_FILE,
+        FIXED_EXIF_FILE_2,
+        os.path.join(data_dir, "test_exif.jpg"),
+    ]:
+        with open(filename, "rb") as fp:
+            orig = fp.read()
+
+        edit = ExifEdit(orig)
+        edit.add_image_description({"key_string": "one"})
+        chunks = edit.dump_image_chunks()
+        # the image data is a view of the original bytes
+        assert isinstance(chunks[-1], memoryview)
+        assert chunks[-1].obj is orig
+
+        edit = ExifEdit(orig)
+        edit.add_image_description({"key_string": "one"})
+        assert b"".join(chunks) == edit.dump_image_bytes(), filename
+
+
+def test_read_image_header(tmpdir: py.path.local):
+    for filename in [
+        EMPTY_EXIF_FILE,
+        CORRUPT_EXIF_FILE,
+        CORRUPT_EXIF_FILE_2,
+        FIXED_EXIF_FILE,
+        FIXED_EXIF_FILE_2,
+        os.path.join(data_dir, "test_exif.jpg"),
+    ]:
+        with open(filename, "rb") as fp:
+            orig = fp.read()
+        header = read_image_header(filename)
+        # Up to and including the SOS marker
+        assert orig.startswith(header)
+        assert header.endswith(b"\xff\xda")
+        assert len(header) < len(orig)
+
+        # Same EXIF dumped from the header
+        edit = ExifEdit(orig)
+        edit.add_image_description({"key_string": "one"})
+        header_edit = ExifEdit(header)
+        header_edit.add_image_description({"key_string": "one"})
+        assert edit._dump_app1() == header_edit._dump_app1(), filename
+        header_edit.verify_dump()
+
+    # Not a JPEG or truncated: read as a whole
+    for content in [b"not an image", orig[: len(header) - 100]]:
+        path = tmpdir.join("invalid.jpg")
+        path.write_binary(content)
+        assert read_image_header(str(path)) == content
+    with pytest.raises(piexif.InvalidImageDataError):
+        ExifEdit(read_image_header(str(path)))
+
+
+def test_verify_dump_too_large():
+    with open(FIXED_EXIF_FILE, "rb") as fp:
+        orig = fp.read()
+    edit = ExifEdit(orig)
+    edit.add_image_description({"key_string": "x" * 70000})
+    with pytest.raises(Exception) as full_exc:
+        edit.dump_image_bytes()
+    edit = ExifEdit(read_image_header(FIXED_EXIF_FILE))
+    edit.add_image_description({"key_string": "x" * 70000})
+    with pytest.raises(type(full_exc.value)):
+        edit.verify_dump()
+
+
 if __name__ == "__main__":
     unittest.main()
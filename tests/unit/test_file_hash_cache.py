@@ -0,0 +1,85 @@
+import os
+import tempfile
+
+import py.path
+
+from mapillary_tools import file_hash_cache, uploader, utils
+
+
+def _write(path: py.path.local, content: bytes, mtime: float) -> None:
+    path.write_binary(content)
+    os.utime(str(path), (mtime, mtime))
+
+
+def test_file_md5sum(tmpdir: py.path.local):
+    cache = file_hash_cache.FileHashCache(str(tmpdir.join("cache.sqlite3")))
+    path = tmpdir.join("video.mp4")
+    _write(path, b"hello", 1000)
+
+    signature = file_hash_cache.file_signature(str(path))
+    assert cache.get(str(path), signature) is None
+    assert cache.file_md5sum(str(path)) == utils.md5sum_bytes(b"hello")
+    assert cache.get(str(path), signature) == utils.md5sum_bytes(b"hello")
+
+    # The cached md5sum is returned as long as the signature is unchanged
+    cache.put(str(path), signature, "cached")
+    assert cache.file_md5sum(str(path)) == "cached"
+    assert cache.read_file(str(path)) == (b"hello", "cached")
+
+    # Same size but a different mtime
+    _write(path, b"world", 2000)
+    assert cache.file_md5sum(str(path)) == utils.md5sum_bytes(b"world")
+    assert cache.read_file(str(path)) == (b"world", utils.md5sum_bytes(b"world"))
+
+    # Persisted across instances
+    cache.close()
+    cache = file_hash_cache.FileHashCache(str(tmpdir.join("cache.sqlite3")))
+    signature = file_hash_cache.file_signature(str(path))
+    assert cache.get(str(path), signature) == utils.md5sum_bytes(b"world")
+    # Same as the EXIF cache
+    conn = cache._connect()
+    assert conn is not None
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_racy_file(tmpdir: py.path.local):
+    cache = file_hash_cache.FileHashCache(str(tmpdir.join("cache.sqlite3")))
+    path = tmpdir.join("image.jpg")
+    path.write_binary(b"hello")
+    signature = file_hash_cache.file_signature(str(path))
+    assert cache.read_file(str(path)) == (b"hello", utils.md5sum_bytes(b"hello"))
+    # Modified just now so it could be modified again without changing the mtime
+    assert cache.get(str(path), signature) is None
+
+
+def test_invalid_cache_path(tmpdir: py.path.local):
+    # A directory can not be opened as a database
+    cache = file_hash_cache.FileHashCache(str(tmpdir.mkdir("cache")))
+    path = tmpdir.join("video.mp4")
+    _write(path, b"hello", 1000)
+    assert cache.file_md5sum(str(path)) == utils.md5sum_bytes(b"hello")
+    assert cache.file_md5sum(str(path)) == utils.md5sum_bytes(b"hello")
+
+
+def test_sequence_upload_md5sum(tmpdir: py.path.local, monkeypatch):
+    sequence = {}
+    for idx, filename in enumerate(
+        ["tests/unit/data/test_exif.jpg", "tests/unit/data/fixed_exif.jpg"]
+    ):
+        image = tmpdir.join(f"image_{idx}.jpg")
+        _write(image, py.path.local(filename).read_binary(), 1000)
+        sequence[str(image)] = {
+            "MAPLatitude": 58.5927694,
+            "MAPLongitude": 16.1840944,
+            "MAPCaptureTime": f"2021_02_13_13_24_4{idx}_140",
+            "filename": str(image),
+        }
+    with tempfile.TemporaryFile() as fp:
+        expected = uploader._zip_sequence_fp(sequence, fp)
+
+    # Found in the cache, i.e. the images hashed while zipping are not read again
+    def _file_md5sum(path):
+        raise AssertionError(f"{path} is hashed again")
+
+    monkeypatch.setattr(utils, "file_md5sum", _file_md5sum)
+    assert uploader.sequence_upload_md5sum(sequence, workers=2) == expected
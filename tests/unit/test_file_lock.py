@@ -0,0 +1,38 @@
+import py.path
+
+from mapillary_tools import file_lock
+
+
+def test_file_lock(tmpdir: py.path.local):
+    path = str(tmpdir.join("locks", "test.lock"))
+    lock = file_lock.FileLock(path)
+    other = file_lock.FileLock(path)
+
+    assert lock.acquire()
+    assert lock.locked
+    assert not other.acquire(blocking=False)
+    assert not other.locked
+    lock.release()
+    assert not lock.locked
+    # Kept by default
+    assert tmpdir.join("locks", "test.lock").exists()
+
+    with other:
+        assert other.locked
+        assert not lock.acquire(blocking=False)
+    assert lock.acquire(blocking=False)
+    lock.release()
+
+
+def test_file_lock_remove(tmpdir: py.path.local):
+    path = str(tmpdir.join("test.lock"))
+    lock = file_lock.FileLock(path, remove=True)
+    with lock:
+        assert tmpdir.join("test.lock").exists()
+        assert not file_lock.FileLock(path, remove=True).acquire(blocking=False)
+    assert not tmpdir.join("test.lock").exists()
+
+    # The file is recreated
+    with lock:
+        assert tmpdir.join("test.lock").exists()
+    assert not tmpdir.join("test.lock").exists()
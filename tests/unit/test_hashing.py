@@ -0,0 +1,68 @@
+import os
+import threading
+import typing as T
+
+import py.path
+import pytest
+
+from mapillary_tools import constants, file_hash_cache, hashing, utils
+
+
+def _write_files(tmpdir: py.path.local) -> T.Dict[str, bytes]:
+    files = {}
+    for idx, size in enumerate([0, 1, 1000, 4096, 4097, 100 * 1024]):
+        path = tmpdir.join(f"file_{idx}.bin")
+        content = os.urandom(size)
+        path.write_binary(content)
+        # Old enough to be cached
+        os.utime(str(path), (1000, 1000))
+        files[str(path)] = content
+    return files
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_imap_ordered(max_workers):
+    threads = set()
+
+    def _square(x: int) -> int:
+        threads.add(threading.get_ident())
+        return x * x
+
+    assert list(hashing.imap_ordered(_square, range(20), max_workers)) == [
+        x * x for x in range(20)
+    ]
+    assert (len(threads) == 1) == (max_workers == 1)
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_file_md5sums(tmpdir: py.path.local, monkeypatch, max_workers):
+    monkeypatch.setattr(constants, "FILE_HASH_CACHE_PATH", "")
+    files = _write_files(tmpdir)
+    assert hashing.file_md5sums(list(files), max_workers=max_workers) == [
+        utils.md5sum_bytes(content) for content in files.values()
+    ]
+    assert hashing.file_md5sums([], max_workers=max_workers) == []
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_file_md5sums_cache(tmpdir: py.path.local, monkeypatch, max_workers):
+    files = _write_files(tmpdir.mkdir("files"))
+    paths = list(files)
+    cache = file_hash_cache.FileHashCache(str(tmpdir.join("cache.sqlite3")))
+    monkeypatch.setattr(file_hash_cache, "default_cache", lambda: cache)
+
+    md5sums = hashing.file_md5sums(paths, max_workers=max_workers)
+    hashed = []
+    monkeypatch.setattr(
+        utils, "file_md5sum", lambda path: hashed.append(path) or "not cached"
+    )
+    assert hashing.file_md5sums(paths, max_workers=max_workers) == md5sums
+    assert hashed == []
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_file_md5sums_error(tmpdir: py.path.local, max_workers):
+    paths = list(_write_files(tmpdir))
+    paths.insert(2, str(tmpdir.join("not_found.bin")))
+    with pytest.raises(FileNotFoundError):
+        hashing.file_md5sums(paths, max_workers=max_workers)
@@ -0,0 +1,175 @@
+import json
+
+import py.path
+
+import pytest
+
+from mapillary_tools import history, upload, uploader
+
+
+def test_write_and_read(tmpdir: py.path.local):
+    upload_history = history.UploadHistory(str(tmpdir))
+    descs = [{"filename": "hello.jpg", "MAPSequenceUUID": "sequence_1"}]
+    upload_history.write(
+        "aaaa", {"file_type": "images"}, {"sequence_uuid": "sequence_1"}, descs
+    )
+    upload_history.write("bbbb", {"file_type": "blackvue"}, {})
+
+    assert upload_history.read("aaaa") == {
+        "params": {"file_type": "images"},
+        "summary": {"sequence_uuid": "sequence_1"},
+        "descs": descs,
+    }
+    assert upload_history.read("bbbb") == {
+        "params": {"file_type": "blackvue"},
+        "summary": {},
+    }
+    assert upload_history.read("cccc") is None
+    assert upload_history.is_uploaded("aaaa")
+    assert not upload_history.is_uploaded("cccc")
+
+    with pytest.raises(ValueError):
+        upload_history.write("not md5sum", {}, {})
+
+    # No legacy history files by default
+    assert not tmpdir.join("aa").check()
+
+    # Persisted, and readable without compression
+    upload_history.close()
+    upload_history = history.UploadHistory(str(tmpdir), compress_descs=False)
+    assert upload_history.read("aaaa")["descs"] == descs
+    upload_history.write("cccc", {}, {}, descs)
+    assert upload_history.read("cccc")["descs"] == descs
+
+
+def test_write_legacy(tmpdir: py.path.local):
+    descs = [{"filename": "hello.jpg", "MAPSequenceUUID": "sequence_1"}]
+    with history.UploadHistory(str(tmpdir), write_legacy=True) as upload_history:
+        upload_history.write(
+            "aaaa", {"file_type": "images"}, {"sequence_uuid": "sequence_1"}, descs
+        )
+        upload_history.write("bbbb", {"file_type": "blackvue"}, {})
+        assert upload_history.is_uploaded("aaaa")
+    # Closed by the context manager
+    assert upload_history._conn is None
+
+    # Written in the format of the earlier versions
+    assert json.loads(tmpdir.join("aa", "aa.json").read()) == {
+        "params": {"file_type": "images"},
+        "summary": {"sequence_uuid": "sequence_1"},
+        "descs": descs,
+    }
+    assert json.loads(tmpdir.join("bb", "bb.json").read()) == {
+        "params": {"file_type": "blackvue"},
+        "summary": {},
+    }
+
+
+def test_uploaded_in_batches(tmpdir: py.path.local):
+    upload_history = history.UploadHistory(str(tmpdir))
+    md5sums = [f"{idx:032x}" for idx in range(1200)]
+    for md5sum in md5sums[::3]:
+        upload_history.write(md5sum, {}, {})
+    assert upload_history.uploaded(md5sums) == set(md5sums[::3])
+    assert upload_history.uploaded([]) == set()
+
+
+def test_import_legacy_history(tmpdir: py.path.local, monkeypatch):
+    legacy = {
+        "params": {"file_type": "images"},
+        "summary": {"sequence_uuid": "sequence_1"},
+        "descs": [{"filename": "hello.jpg"}],
+    }
+    tmpdir.mkdir("ab").join("cdef.json").write(json.dumps(legacy))
+    tmpdir.mkdir("12").join("3456.json").write("invalid JSON")
+    tmpdir.join("not_history.json").write("{}")
+
+    upload_history = history.UploadHistory(str(tmpdir))
+    assert upload_history.read("abcdef") == legacy
+    assert upload_history.uploaded(["abcdef", "123456"]) == {"abcdef"}
+    # Kept for the earlier versions
+    assert tmpdir.join("ab", "cdef.json").check()
+    assert tmpdir.join("12", "3456.json").check()
+    assert tmpdir.join("not_history.json").check()
+    upload_history.close()
+
+    # The history written by an earlier version later is imported on the next open,
+    # and only the subfolder it was written to is scanned again
+    scanned = []
+    legacy_history_paths = history.UploadHistory._legacy_history_paths
+
+    def _legacy_history_paths(self, subfolder):
+        scanned.append(subfolder)
+        return legacy_history_paths(self, subfolder)
+
+    monkeypatch.setattr(
+        history.UploadHistory, "_legacy_history_paths", _legacy_history_paths
+    )
+    tmpdir.mkdir("98").join("7654.json").write(json.dumps(legacy))
+    upload_history = history.UploadHistory(str(tmpdir))
+    assert upload_history.uploaded(["abcdef", "987654"]) == {"abcdef", "987654"}
+    assert scanned == ["98"]
+    upload_history.close()
+
+    upload_history = history.UploadHistory(str(tmpdir))
+    assert upload_history.is_uploaded("987654")
+    assert scanned == ["98"]
+
+
+@pytest.mark.parametrize("zip_prefetch", [0, 2])
+def test_upload_images_skip_uploaded(tmpdir: py.path.local, monkeypatch, zip_prefetch):
+    upload_dir = tmpdir.mkdir("mapillary_public_uploads")
+    monkeypatch.setenv("MAPILLARY_UPLOAD_PATH", str(upload_dir))
+    sequences = {
+        f"sequence_{idx}": {
+            filename: {
+                "MAPLatitude": 58.5927694,
+                "MAPLongitude": 16.1840944,
+                "MAPCaptureTime": "2021_02_13_13_24_41_140",
+                "filename": filename,
+                "MAPSequenceUUID": f"sequence_{idx}",
+            }
+        }
+        for idx, filename in enumerate(
+            [
+                "tests/unit/data/test_exif.jpg",
+                "tests/unit/data/fixed_exif.jpg",
+                "tests/unit/data/fixed_exif_2.jpg",
+            ]
+        )
+    }
+    descs = [desc for sequence in sequences.values() for desc in sequence.values()]
+    uploaded = uploader.sequence_upload_md5sum(sequences["sequence_1"])
+    upload_history = history.UploadHistory(str(tmpdir.join("history")))
+    upload_history.write(uploaded, {"file_type": "images"}, {})
+
+    lookups = []
+
+    def _uploaded_md5sums(md5sums):
+        lookups.append(md5sums)
+        return upload.uploaded_md5sums(upload_history, md5sums)
+
+    built = []
+    zip_sequence_fp = uploader._zip_sequence_fp
+
+    def _zip_sequence_fp(sequence, fp, **kwargs):
+        built.extend(desc["MAPSequenceUUID"] for desc in sequence.values())
+        return zip_sequence_fp(sequence, fp, **kwargs)
+
+    monkeypatch.setattr(uploader, "_zip_sequence_fp", _zip_sequence_fp)
+    mly_uploader = uploader.Uploader(
+        {"user_upload_token": "YOUR_USER_ACCESS_TOKEN"},
+        dry_run=True,
+        uploaded_md5sums=_uploaded_md5sums,
+        zip_prefetch=zip_prefetch,
+        zip_stream=False,
+    )
+    resp = mly_uploader.upload_images(descs)
+    upload_history.close()
+    assert set(resp.keys()) == {"sequence_0", "sequence_2"}
+    # Looked up per sequence, and the uploaded one is skipped before building its zip
+    assert sorted(len(md5sums) for md5sums in lookups) == [1, 1, 1]
+    assert sorted(built) == ["sequence_0", "sequence_2"]
+    assert f"mly_tools_{uploaded}.zip" not in [
+        upload_path.basename for upload_path in upload_dir.listdir()
+    ]
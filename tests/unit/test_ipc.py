@@ -0,0 +1,65 @@
+import json
+import os
+import time
+
+import pytest
+
+from mapillary_tools import ipc
+
+
+@pytest.fixture
+def channel(monkeypatch: pytest.MonkeyPatch):
+    read_fd, write_fd = os.pipe()
+    monkeypatch.setattr(ipc, "NODE_CHANNEL_FD", write_fd)
+    yield read_fd
+    os.close(read_fd)
+    os.close(write_fd)
+
+
+def _read_messages(read_fd: int):
+    data = os.read(read_fd, 1024 * 1024).decode("utf-8")
+    return [json.loads(line) for line in data.splitlines()]
+
+
+def test_send(channel):
+    ipc.send("upload_start", {"offset": 0})
+    assert _read_messages(channel) == [
+        {"type": "upload_start", "payload": {"offset": 0}}
+    ]
+
+
+def test_send_batch(channel):
+    ipc.send("upload_progress", {"offset": 1}, batch=True)
+    ipc.send("upload_progress", {"offset": 2}, batch=True)
+    # Written together with the next unbatched message in one frame
+    ipc.send("upload_end", {"offset": 2})
+    assert _read_messages(channel) == [
+        {"type": "upload_progress", "payload": {"offset": 1}},
+        {"type": "upload_progress", "payload": {"offset": 2}},
+        {"type": "upload_end", "payload": {"offset": 2}},
+    ]
+
+
+def test_send_batch_timeout(channel):
+    ipc.send("upload_progress", {"offset": 1}, batch=True)
+    time.sleep(ipc.BATCH_INTERVAL * 5)
+    assert _read_messages(channel) == [
+        {"type": "upload_progress", "payload": {"offset": 1}}
+    ]
+
+
+def test_send_batch_write_error(channel, monkeypatch: pytest.MonkeyPatch):
+    write = ipc._write
+    failures = [1]
+
+    def _write_once_failing(data: str):
+        if failures:
+            failures.pop()
+            raise OSError("TEST ONLY: transient error")
+        write(data)
+
+    monkeypatch.setattr(ipc, "_write", _write_once_failing)
+    ipc.send("upload_progress", {"offset": 1}, batch=True)
+    ipc.send("upload_end", {"offset": 1})
+    # The unbatched message is retried on its own
+    assert _read_messages(channel) == [{"type": "upload_end", "payload": {"offset": 1}}]
@@ -0,0 +1,118 @@
+import io
+import os
+import struct
+
+import exifread
+import piexif
+import py.path
+import pytest
+from PIL import Image
+
+from mapillary_tools import exif_read, simple_exif_parser
+
+
+this_file_dir = os.path.dirname(os.path.abspath(__file__))
+IMAGES = [
+    os.path.join(this_file_dir, "data", name)
+    for name in [
+        "test_exif.jpg",
+        "empty_exif.jpg",
+        "corrupt_exif.jpg",
+        "corrupt_exif_2.jpg",
+        "fixed_exif.jpg",
+        "fixed_exif_2.jpg",
+    ]
+]
+DECODED_NAMES = {
+    *simple_exif_parser._IMAGE_TAGS.values(),
+    *simple_exif_parser._GPS_TAGS.values(),
+}
+
+
+def _exifread_tags(fp) -> dict:
+    tags = exifread.process_file(fp, details=False, debug=True)
+    return {
+        key: tag.values
+        for key, tag in tags.items()
+        if key.split(" ", 1)[0] in ["Image", "EXIF", "GPS"]
+        and key.split(" ", 1)[1] in DECODED_NAMES
+    }
+
+
+@pytest.mark.parametrize("filename", IMAGES)
+def test_parse_jpeg_exif(filename: str):
+    with open(filename, "rb") as fp:
+        tags = simple_exif_parser.parse_jpeg_exif(fp)
+        assert {key: tag.values for key, tag in tags.items()} == _exifread_tags(fp)
+
+
+def _jpeg_with_exif(segments_before: bytes = b"") -> bytes:
+    exif_bytes = piexif.dump(
+        {
+            "0th": {piexif.ImageIFD.Make: b"Mapillary", piexif.ImageIFD.Orientation: 6},
+            "Exif": {piexif.ExifIFD.DateTimeOriginal: b"2021:02:13 13:24:41"},
+            "GPS": {
+                piexif.GPSIFD.GPSLatitudeRef: b"S",
+                piexif.GPSIFD.GPSLatitude: ((58, 1), (35, 1), (3397, 100)),
+                piexif.GPSIFD.GPSLongitudeRef: b"E",
+                piexif.GPSIFD.GPSLongitude: ((16, 1), (11, 1), (237, 100)),
+                piexif.GPSIFD.GPSImgDirection: (1234, 10),
+            },
+        }
+    )
+    buf = io.BytesIO()
+    Image.new("RGB", (16, 16)).save(buf, "JPEG")
+    output = io.BytesIO()
+    piexif.insert(exif_bytes, buf.getvalue(), output)
+    image_bytes = output.getvalue()
+    # Insert the segments right after SOI
+    return image_bytes[:2] + segments_before + image_bytes[2:]
+
+
+def _segment(marker: int, payload: bytes) -> bytes:
+    return bytes([0xFF, marker]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def test_parse_jpeg_exif_after_large_segment(tmpdir: py.path.local):
+    path = tmpdir.join("image.jpg")
+    # exifread looks for EXIF in the first 4000 bytes only
+    path.write_binary(_jpeg_with_exif(_segment(0xE2, b"\x00" * 5000)))
+
+    with open(path, "rb") as fp:
+        tags = simple_exif_parser.parse_jpeg_exif(fp)
+    assert tags["Image Make"].values == "Mapillary"
+    assert tags["EXIF DateTimeOriginal"].values == "2021:02:13 13:24:41"
+
+    exif = exif_read.ExifRead(str(path))
+    lon, lat = exif.extract_lon_lat()
+    assert lat is not None and lon is not None
+    assert lat == pytest.approx(-(58 + 35 / 60 + 33.97 / 3600))
+    assert lon == pytest.approx(16 + 11 / 60 + 2.37 / 3600)
+    assert exif.extract_direction() == 123.4
+    assert exif.extract_orientation() == 6
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"not an image",
+        # XMP before EXIF
+        _jpeg_with_exif(
+            _segment(0xE1, b"http://ns.adobe.com/xap/1.0/\x00<x:xmpmeta/>")
+        ),
+        # No EXIF
+        b"\xff\xd8" + _segment(0xDB, b"\x00" * 64),
+        # Truncated
+        _jpeg_with_exif()[:100],
+    ],
+)
+def test_parse_jpeg_exif_unsupported(tmpdir: py.path.local, data: bytes):
+    with pytest.raises(simple_exif_parser.UnsupportedExifError):
+        simple_exif_parser.parse_jpeg_exif(io.BytesIO(data))
+
+    # Fall back to exifread
+    path = tmpdir.join("image.jpg")
+    path.write_binary(data)
+    exif = exif_read.ExifRead(str(path))
+    with open(path, "rb") as fp:
+        assert exif.tags.keys() == exifread.process_file(fp, debug=True).keys()
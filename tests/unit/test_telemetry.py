@@ -0,0 +1,55 @@
+import json
+
+import py.path
+
+from mapillary_tools import telemetry
+
+
+def test_histogram():
+    histogram = telemetry.Histogram("seconds", "Seconds", [1, 0.5, 5])
+    for value in [0.1, 0.5, 0.7, 3, 100]:
+        histogram.observe(value)
+    assert histogram.buckets == [0.5, 1, 5]
+    assert histogram.count == 5
+    assert histogram.sum == 104.3
+    assert [count for _, count in histogram.cumulative_counts()] == [2, 3, 4, 5]
+    assert histogram.to_prometheus("prefix") == [
+        "# HELP prefix_seconds Seconds",
+        "# TYPE prefix_seconds histogram",
+        'prefix_seconds_bucket{le="0.5"} 2',
+        'prefix_seconds_bucket{le="1.0"} 3',
+        'prefix_seconds_bucket{le="5.0"} 4',
+        'prefix_seconds_bucket{le="+Inf"} 5',
+        "prefix_seconds_sum 104.3",
+        "prefix_seconds_count 5",
+    ]
+
+
+def test_upload_telemetry(tmpdir: py.path.local):
+    upload_telemetry = telemetry.UploadTelemetry()
+    upload_telemetry.observe_chunk(1024 * 1024, 0.5)
+    upload_telemetry.observe_chunk(512 * 1024, 0)
+    upload_telemetry.retries += 1
+    upload_telemetry.sessions += 1
+
+    metrics = upload_telemetry.to_json()
+    assert metrics["counters"] == {
+        "retries_total": 1,
+        "uploaded_bytes_total": 1536 * 1024,
+        "sessions_total": 1,
+    }
+    assert metrics["histograms"]["chunk_seconds"]["count"] == 2
+    # Chunks uploaded instantly have no throughput
+    assert metrics["histograms"]["chunk_throughput_bytes_per_second"]["count"] == 1
+
+    json_path = tmpdir.join("metrics.json")
+    upload_telemetry.write(str(json_path))
+    assert json.loads(json_path.read()) == metrics
+
+    prom_path = tmpdir.join("metrics.prom")
+    upload_telemetry.write(str(prom_path))
+    content = prom_path.read()
+    assert 'mapillary_tools_upload_chunk_seconds_bucket{le="+Inf"} 2' in content
+    assert "mapillary_tools_upload_retries_total 1" in content
+    assert "mapillary_tools_upload_uploaded_bytes_total 1572864" in content
+    assert not tmpdir.join("metrics.prom.tmp").exists()
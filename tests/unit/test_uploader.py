@@ -1,12 +1,27 @@
+import asyncio
+import datetime
+import io
 import json
 import os
 import tempfile
+import threading
+import time
+import typing as T
 import zipfile
 
 import py.path
 import pytest
 
-from mapillary_tools import exif_read, uploader
+from mapillary_tools import (
+    async_http,
+    exceptions,
+    exif_read,
+    file_lock,
+    telemetry,
+    upload,
+    upload_api_v4,
+    uploader,
+)
 
 
 def _validate_and_extract_zip(filename: str):
@@ -113,6 +128,964 @@ def test_upload_images_multiple_sequences(setup_upload: py.path.local):
     _validate_zip_dir(setup_upload)
 
 
+@pytest.mark.parametrize("upload_engine", ["threads", "asyncio"])
+def test_upload_images_concurrently(setup_upload: py.path.local, upload_engine):
+    emitter = uploader.EventEmitter()
+    events: T.Dict[str, T.List[str]] = {}
+
+    for event in [
+        "upload_start",
+        "upload_fetch_offset",
+        "upload_end",
+        "upload_finished",
+    ]:
+
+        def _collect(payload, event=event):
+            events.setdefault(payload["sequence_uuid"], []).append(event)
+
+        emitter.on(event)(_collect)
+
+    descs = [
+        {
+            "MAPLatitude": 58.5927694,
+            "MAPLongitude": 16.1840944,
+            "MAPCaptureTime": "2021_02_13_13_24_41_140",
+            "filename": "tests/unit/data/test_exif.jpg",
+            "MAPSequenceUUID": f"sequence_{idx}",
+        }
+        for idx in range(4)
+    ] + [
+        {
+            "MAPLatitude": 59.5927694,
+            "MAPLongitude": 16.1840944,
+            "MAPCaptureTime": "2021_02_13_13_25_41_140",
+            "filename": "tests/unit/data/fixed_exif.jpg",
+            "MAPSequenceUUID": "sequence_4",
+        },
+    ]
+    mly_uploader = uploader.Uploader(
+        {"user_upload_token": "YOUR_USER_ACCESS_TOKEN"},
+        emitter=emitter,
+        dry_run=True,
+        upload_workers=3,
+        upload_engine=upload_engine,
+    )
+    resp = mly_uploader.upload_images(descs)
+    assert set(resp.keys()) == {f"sequence_{idx}" for idx in range(5)}
+    assert len(setup_upload.listdir()) == 2
+    _validate_zip_dir(setup_upload)
+    for sequence_uuid, sequence_events in events.items():
+        assert sequence_events[0] == "upload_start", sequence_uuid
+        assert sequence_events[-2:] == ["upload_end", "upload_finished"], sequence_uuid
+
+
+def test_upload_sessions_overlap_and_contend(setup_upload: py.path.local, monkeypatch):
+    # The first session of each distinct zip waits in finish() until the other two join,
+    # so the upload only succeeds if the three run concurrently
+    barrier = threading.Barrier(3, timeout=10)
+    lock = threading.Lock()
+    finished: T.Set[str] = set()
+    active: T.Dict[str, int] = {}
+    max_active: T.Dict[str, int] = {}
+    init = upload_api_v4.FakeUploadService.__init__
+    fetch_offset = upload_api_v4.FakeUploadService.fetch_offset
+    finish = upload_api_v4.FakeUploadService.finish
+
+    def _init(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        self._error_ratio = 0
+
+    def _fetch_offset(self):
+        with lock:
+            active[self.session_key] = active.get(self.session_key, 0) + 1
+            max_active[self.session_key] = max(
+                max_active.get(self.session_key, 0), active[self.session_key]
+            )
+        return fetch_offset(self)
+
+    def _finish(self, file_handle):
+        with lock:
+            first = self.session_key not in finished
+            finished.add(self.session_key)
+        if first:
+            barrier.wait()
+        with lock:
+            active[self.session_key] -= 1
+        return finish(self, file_handle)
+
+    monkeypatch.setattr(upload_api_v4.FakeUploadService, "__init__", _init)
+    monkeypatch.setattr(upload_api_v4.FakeUploadService, "fetch_offset", _fetch_offset)
+    monkeypatch.setattr(upload_api_v4.FakeUploadService, "finish", _finish)
+
+    sequences = _sequences()
+    # The same zip as sequence_0
+    sequences["sequence_3"] = {
+        filename: {**desc, "MAPSequenceUUID": "sequence_3"}
+        for filename, desc in sequences["sequence_0"].items()
+    }
+    descs = [desc for sequence in sequences.values() for desc in sequence.values()]
+    mly_uploader = uploader.Uploader(
+        {"user_upload_token": "YOUR_USER_ACCESS_TOKEN"},
+        dry_run=True,
+        upload_workers=4,
+        zip_prefetch=4,
+    )
+    resp = mly_uploader.upload_images(T.cast(T.Any, descs))
+    assert set(resp.keys()) == set(sequences.keys())
+    assert not barrier.broken
+    # The sessions of the same zip never run at the same time
+    assert len(max_active) == 3
+    assert set(max_active.values()) == {1}
+    assert len(setup_upload.listdir()) == 3
+
+
+def test_emitter_coalescing():
+    emitter = uploader.EventEmitter()
+    received = []
+    progress = []
+    emitter.on("upload_progress")(lambda payload: progress.append(payload["offset"]))
+    emitter.on("upload_progress", max_rate=1 / 60)(
+        lambda payload: received.append(("upload_progress", payload["offset"]))
+    )
+    emitter.on("upload_end")(
+        lambda payload: received.append(("upload_end", payload["offset"]))
+    )
+
+    payload_a = {"md5sum": "a", "offset": 0}
+    payload_b = {"md5sum": "b", "offset": 0}
+    for offset in range(1, 5):
+        payload_a["offset"] = offset
+        emitter.emit("upload_progress", payload_a)
+        payload_b["offset"] = offset * 10
+        emitter.emit("upload_progress", payload_b)
+    # Listeners without max_rate get all events
+    assert progress == [1, 10, 2, 20, 3, 30, 4, 40]
+    # The first event of each session, and the others are held
+    assert received == [("upload_progress", 1), ("upload_progress", 10)]
+
+    # The last held progress is delivered before the end
+    emitter.emit("upload_end", payload_a)
+    assert received[2:] == [("upload_progress", 4), ("upload_end", 4)]
+    emitter.emit("upload_end", payload_b)
+    assert received[4:] == [("upload_progress", 40), ("upload_end", 40)]
+
+    # The last held progress is delivered when the session fails
+    payload_c = {"md5sum": "c", "offset": 0}
+    for offset in range(1, 3):
+        payload_c["offset"] = offset
+        emitter.emit("upload_progress", payload_c)
+    assert received[6:] == [("upload_progress", 1)]
+    with pytest.raises(ValueError):
+        uploader._prepare_retry(
+            ValueError("not retriable"),
+            0,
+            2,
+            True,
+            T.cast(upload_api_v4.UploadService, None),
+            upload_api_v4.ChunkSizeController(1024, 1024, 1024),
+            T.cast(uploader.Progress, payload_c),
+            emitter=emitter,
+        )
+    assert received[7:] == [("upload_progress", 2)]
+
+
+def test_coalescer_deadline():
+    now = [0.0]
+    received = []
+    coalescer = uploader._Coalescer(
+        lambda payload: received.append(dict(payload)), 1, clock=lambda: now[0]
+    )
+    payload_a = {"md5sum": "a", "offset": 1}
+    coalescer("a", payload_a)
+    payload_a["offset"] = 2
+    now[0] = 0.5
+    coalescer("a", payload_a)
+    assert received == [{"md5sum": "a", "offset": 1}]
+
+    # Not due yet
+    now[0] = 0.9
+    coalescer.flush_due()
+    assert len(received) == 1
+
+    # Due on an event of another session
+    now[0] = 1.5
+    coalescer("b", {"md5sum": "b", "offset": 10})
+    assert received[1:] == [
+        {"md5sum": "a", "offset": 2},
+        {"md5sum": "b", "offset": 10},
+    ]
+
+    # Superseded by a later event of the same session after the deadline
+    coalescer("b", {"md5sum": "b", "offset": 20})
+    now[0] = 3
+    coalescer("b", {"md5sum": "b", "offset": 30})
+    assert received[3:] == [{"md5sum": "b", "offset": 30}]
+
+    # Due on a flush without new events
+    coalescer("b", {"md5sum": "b", "offset": 40})
+    now[0] = 4
+    coalescer.flush_due()
+    assert received[4:] == [{"md5sum": "b", "offset": 40}]
+
+
+def test_emitter_coalescing_deadline():
+    emitter = uploader.EventEmitter()
+    received = []
+    emitter.on("upload_progress", max_rate=20)(
+        lambda payload: received.append(payload["offset"])
+    )
+    emitter.on("upload_fetch_offset")(lambda payload: None)
+
+    payload_a = {"md5sum": "a", "offset": 1}
+    emitter.emit("upload_progress", payload_a)
+    payload_a["offset"] = 2
+    emitter.emit("upload_progress", payload_a)
+    assert received == [1]
+    time.sleep(0.1)
+    # Delivered on any later event, not only the ones of the coalesced listener
+    emitter.emit("upload_fetch_offset", {"md5sum": "b", "offset": 0})
+    assert received == [1, 2]
+
+
+def test_execute_concurrently():
+    assert uploader.execute_concurrently(lambda x: x * 2, range(10), 4) == [
+        x * 2 for x in range(10)
+    ]
+
+    def _fail(x):
+        if x == 3:
+            raise ValueError(x)
+        return x
+
+    with pytest.raises(ValueError):
+        uploader.execute_concurrently(_fail, range(10), 4)
+
+
+def test_execute_concurrently_async():
+    running = 0
+    max_running = 0
+
+    async def _double(x):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        if x == 7:
+            raise ValueError(x)
+        return x * 2
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(
+            uploader.execute_concurrently_async(_double, range(7), 3)
+        ) == [x * 2 for x in range(7)]
+        assert max_running == 3
+        with pytest.raises(ValueError):
+            loop.run_until_complete(
+                uploader.execute_concurrently_async(_double, range(10), 3)
+            )
+    finally:
+        loop.close()
+
+
+def test_run_async_threads():
+    threads = set()
+
+    def _block():
+        threads.add(threading.get_ident())
+        time.sleep(0.01)
+
+    async def _main(client):
+        assert isinstance(client, async_http.AsyncHTTPClient)
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*[loop.run_in_executor(None, _block) for _ in range(8)])
+
+    uploader._run_async(_main, max_workers=2)
+    # The blocking calls share one executor
+    assert len(threads) <= 2
+
+
+def _sequences():
+    filenames = [
+        "tests/unit/data/test_exif.jpg",
+        "tests/unit/data/fixed_exif.jpg",
+        "tests/unit/data/fixed_exif_2.jpg",
+    ]
+    return {
+        f"sequence_{idx}": {
+            filename: {
+                "MAPLatitude": 58.5927694,
+                "MAPLongitude": 16.1840944,
+                "MAPCaptureTime": "2021_02_13_13_24_41_140",
+                "filename": filename,
+                "MAPSequenceUUID": f"sequence_{idx}",
+            }
+        }
+        for idx, filename in enumerate(filenames)
+    }
+
+
+@pytest.mark.parametrize(
+    "prefetch,max_size,stream",
+    [(0, None, False), (1, None, False), (2, 1, False), (0, None, True), (2, 1, True)],
+)
+def test_zip_prefetcher(prefetch, max_size, stream):
+    sequences = _sequences()
+    expected = {}
+    for sequence_uuid, sequence in sequences.items():
+        with tempfile.TemporaryFile() as fp:
+            expected[sequence_uuid] = uploader._zip_sequence_fp(sequence, fp)
+
+    actual = {}
+    with uploader._SequenceZipPrefetcher(
+        sequences, prefetch=prefetch, max_size=max_size, stream=stream
+    ) as prefetcher:
+        for sequence_uuid in sequences:
+            with prefetcher.open(sequence_uuid) as (fp, upload_md5sum):
+                fp.seek(0)
+                with zipfile.ZipFile(fp) as ziph:
+                    assert uploader._hash_zipfile(ziph) == upload_md5sum
+                actual[sequence_uuid] = upload_md5sum
+    assert expected == actual
+
+
+def _record_builds(monkeypatch) -> T.Dict[str, threading.Event]:
+    built: T.Dict[str, threading.Event] = {
+        sequence_uuid: threading.Event() for sequence_uuid in _sequences()
+    }
+    zip_sequence_fp = uploader._zip_sequence_fp
+
+    def _zip_sequence_fp(sequence, fp, **kwargs):
+        upload_md5sum = zip_sequence_fp(sequence, fp, **kwargs)
+        desc, *_ = sequence.values()
+        built[desc["MAPSequenceUUID"]].set()
+        return upload_md5sum
+
+    monkeypatch.setattr(uploader, "_zip_sequence_fp", _zip_sequence_fp)
+    return built
+
+
+def test_zip_prefetcher_builds_ahead(monkeypatch):
+    built = _record_builds(monkeypatch)
+    with uploader._SequenceZipPrefetcher(_sequences(), prefetch=2) as prefetcher:
+        with prefetcher.open("sequence_0"):
+            # The next zips are built while the first one is uploading
+            assert built["sequence_1"].wait(10)
+            assert built["sequence_2"].wait(10)
+        with prefetcher.open("sequence_1"):
+            pass
+        with prefetcher.open("sequence_2"):
+            pass
+
+
+def test_zip_prefetcher_max_size(monkeypatch):
+    built = _record_builds(monkeypatch)
+    with uploader._SequenceZipPrefetcher(
+        _sequences(), prefetch=2, max_size=1
+    ) as prefetcher:
+        with prefetcher.open("sequence_0"):
+            # No room on disk for the next zip while the first one is open
+            assert not built["sequence_1"].wait(0.5)
+        assert built["sequence_1"].wait(10)
+        with prefetcher.open("sequence_1"):
+            assert not built["sequence_2"].wait(0.5)
+        with prefetcher.open("sequence_2"):
+            pass
+
+
+def test_zip_prefetcher_error(tmpdir: py.path.local):
+    sequences = _sequences()
+    invalid_image = tmpdir.join("invalid.jpg")
+    invalid_image.write(b"not an image")
+    sequences["sequence_1"][str(invalid_image)] = {
+        **sequences["sequence_1"]["tests/unit/data/fixed_exif.jpg"],
+        "filename": str(invalid_image),
+    }
+    with uploader._SequenceZipPrefetcher(sequences, prefetch=1) as prefetcher:
+        with prefetcher.open("sequence_0"):
+            pass
+        with pytest.raises(Exception):
+            with prefetcher.open("sequence_1"):
+                pass
+        with pytest.raises(Exception):
+            with prefetcher.open("sequence_2"):
+                pass
+
+
+def test_zip_cache(tmpdir: py.path.local):
+    image = tmpdir.join("image.jpg")
+    py.path.local("tests/unit/data/test_exif.jpg").copy(image)
+    sequence = _sequences()["sequence_0"]
+    sequence = {
+        str(image): {
+            **sequence["tests/unit/data/test_exif.jpg"],
+            "filename": str(image),
+        }
+    }
+    with tempfile.TemporaryFile() as fp:
+        expected = uploader._zip_sequence_fp(sequence, fp)
+
+    cache = uploader.SequenceZipCache(str(tmpdir.join("cache")))
+    fp, upload_md5sum = cache.open(sequence)
+    with fp:
+        assert upload_md5sum == expected
+    zip_paths = tmpdir.join("cache").listdir()
+    assert [os.path.basename(p) for p in zip_paths] == [
+        f"mly_tools_{cache.sequence_md5sum(sequence)}.zip"
+    ]
+
+    # found in the cache
+    zip_paths[0].setmtime(0)
+    fp, upload_md5sum = cache.open(sequence)
+    with fp:
+        assert upload_md5sum == expected
+    assert tmpdir.join("cache").listdir() == zip_paths
+    assert zip_paths[0].mtime() != 0
+
+    # not found in the cache if the image description changes
+    other = {str(image): {**sequence[str(image)], "MAPLatitude": 1.0}}
+    assert cache.sequence_md5sum(other) != cache.sequence_md5sum(sequence)
+    # but the sequence UUID does not matter
+    same = {str(image): {**sequence[str(image)], "MAPSequenceUUID": "another"}}
+    assert cache.sequence_md5sum(same) == cache.sequence_md5sum(sequence)
+
+    cache.remove(sequence)
+    assert tmpdir.join("cache").listdir() == []
+
+
+def test_zip_cache_eviction(tmpdir: py.path.local):
+    sequences = _sequences()
+    cache = uploader.SequenceZipCache(str(tmpdir.join("cache")), max_size=1)
+    for sequence in sequences.values():
+        fp, _ = cache.open(sequence)
+        fp.close()
+        # the one just built is never evicted
+        assert [os.path.basename(p) for p in tmpdir.join("cache").listdir()] == [
+            f"mly_tools_{cache.sequence_md5sum(sequence)}.zip"
+        ]
+
+
+def test_zip_cache_expiration(tmpdir: py.path.local):
+    sequences = list(_sequences().values())
+    cache_dir = tmpdir.join("cache")
+    cache = uploader.SequenceZipCache(str(cache_dir), max_age=3600)
+    for sequence in sequences[:2]:
+        fp, _ = cache.open(sequence)
+        fp.close()
+    # e.g. the zip of a cancelled session, and a build of a killed process
+    expired = cache_dir.join(f"mly_tools_{cache.sequence_md5sum(sequences[0])}.zip")
+    expired.setmtime(time.time() - 7200)
+    wip = cache_dir.join("mly_tools_abc.zip.123.456.wip")
+    wip.write_binary(b"partial")
+    wip.setmtime(time.time() - 7200)
+    fresh_wip = cache_dir.join("mly_tools_def.zip.123.789.wip")
+    fresh_wip.write_binary(b"building")
+
+    # Removed on the next open, even if found in the cache
+    fp, _ = cache.open(sequences[1])
+    fp.close()
+    assert sorted(os.path.basename(p) for p in cache_dir.listdir()) == sorted(
+        [
+            f"mly_tools_{cache.sequence_md5sum(sequences[1])}.zip",
+            "mly_tools_def.zip.123.789.wip",
+        ]
+    )
+
+    # Not removed without max_age
+    cache = uploader.SequenceZipCache(str(cache_dir), max_age=None)
+    fp, _ = cache.open(sequences[2])
+    fp.close()
+    for p in cache_dir.listdir():
+        p.setmtime(0)
+    fp, _ = cache.open(sequences[2])
+    fp.close()
+    assert len(cache_dir.listdir()) == 3
+
+
+def test_upload_images_with_zip_cache(
+    tmpdir: py.path.local, setup_upload: py.path.local
+):
+    sequences = _sequences()
+    descs = [desc for sequence in sequences.values() for desc in sequence.values()]
+    cache = uploader.SequenceZipCache(str(tmpdir.join("cache")))
+    mly_uploader = uploader.Uploader(
+        {"user_upload_token": "YOUR_USER_ACCESS_TOKEN"},
+        dry_run=True,
+        zip_cache=cache,
+    )
+    resp = mly_uploader.upload_images(descs)
+    assert len(resp) == 3
+    _validate_zip_dir(setup_upload)
+    # removed once uploaded
+    assert tmpdir.join("cache").listdir() == []
+
+
+@pytest.mark.parametrize("upload_engine", ["threads", "asyncio"])
+def test_upload_images_cancelled_keeps_zip_cache(
+    tmpdir: py.path.local, setup_upload: py.path.local, upload_engine
+):
+    sequences = _sequences()
+    descs = [desc for sequence in sequences.values() for desc in sequence.values()]
+    cache = uploader.SequenceZipCache(str(tmpdir.join("cache")))
+    emitter = uploader.EventEmitter()
+
+    @emitter.on("upload_start")
+    def _cancel(payload):
+        # e.g. uploaded by the process that held the session
+        raise uploader.UploadCancelled()
+
+    mly_uploader = uploader.Uploader(
+        {"user_upload_token": "YOUR_USER_ACCESS_TOKEN"},
+        emitter=emitter,
+        dry_run=True,
+        zip_cache=cache,
+        upload_engine=upload_engine,
+    )
+    assert mly_uploader.upload_images(descs) == {}
+    assert len(tmpdir.join("cache").listdir()) == 3
+
+
+def test_chunk_size_controller():
+    MB = 1024 * 1024
+    controller = upload_api_v4.ChunkSizeController(2 * MB, MB, 16 * MB, target_time=10)
+    assert controller.chunk_size == 2 * MB
+
+    # fast network: grows at most 2x at a time until the max
+    controller.record_success(2 * MB, 0.1)
+    assert controller.chunk_size == 4 * MB
+    for _ in range(10):
+        controller.record_success(controller.chunk_size, 0.1)
+    assert controller.chunk_size == 16 * MB
+
+    # small chunks are ignored
+    controller.record_success(1024, 10)
+    assert controller.chunk_size == 16 * MB
+
+    # failures halve it until the min
+    controller.record_failure()
+    assert controller.chunk_size == 8 * MB
+    for _ in range(10):
+        controller.record_failure()
+    assert controller.chunk_size == MB
+
+    # slow network (0.2 MB/s): shrinks to what can be uploaded in the target time
+    controller = upload_api_v4.ChunkSizeController(16 * MB, MB, 16 * MB, target_time=10)
+    for _ in range(10):
+        controller.record_success(
+            controller.chunk_size, controller.chunk_size / (0.2 * MB)
+        )
+    assert controller.chunk_size == 2 * MB
+
+    # rate limited (0.5 MB/s): capped to what can be sent in the target time at the rate
+    controller = upload_api_v4.ChunkSizeController(
+        16 * MB, MB, 16 * MB, target_time=10, max_rate=0.5 * MB
+    )
+    assert controller.chunk_size == 5 * MB
+    for _ in range(10):
+        controller.record_success(controller.chunk_size, 0.1)
+    assert controller.chunk_size == 5 * MB
+    # but not below the min
+    controller = upload_api_v4.ChunkSizeController(
+        2 * MB, MB, 16 * MB, target_time=10, max_rate=0.01 * MB
+    )
+    assert controller.chunk_size == MB
+
+
+def test_bandwidth_limiter():
+    with pytest.raises(ValueError):
+        upload_api_v4.BandwidthLimiter(rate=0)
+
+    limiter = upload_api_v4.BandwidthLimiter(rate=1024 * 1024)
+    # within the burst
+    assert limiter.acquire(1024 * 1024) == 0
+    waited = limiter.acquire(100 * 1024)
+    assert 0.05 < waited <= 0.1
+    assert upload_api_v4.BandwidthLimiter().acquire(1024 * 1024) == 0
+
+    chunk = upload_api_v4._ThrottledChunk(b"x" * 300 * 1024, limiter)
+    assert len(chunk) == 300 * 1024
+    assert bytes(chunk.read(200 * 1024)) == b"x" * 200 * 1024
+    assert bytes(chunk.read()) == b"x" * 100 * 1024
+    assert chunk.read(1) == b""
+    assert 0.2 < chunk.throttled_time
+
+
+class _FakeResponse:
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return {"h": "file_handle"}
+
+
+class _FakeClock:
+    """
+    Replace the time module of upload_api_v4, so that sleeping advances the clock instantly
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+class _FakeSession:
+    def __init__(self, clock: T.Optional[_FakeClock] = None, post_time: float = 0):
+        self.received = bytearray()
+        self.clock = clock
+        self.post_time = post_time
+
+    def post(self, url, headers, data, timeout):
+        # Read file-like bodies block by block as requests does
+        if hasattr(data, "read"):
+            while True:
+                block = data.read(8192)
+                if not block:
+                    break
+                self.received += block
+        else:
+            self.received += data
+        if self.clock is not None:
+            self.clock.sleep(self.post_time)
+        return _FakeResponse()
+
+
+def test_upload_throttled_chunk_time(monkeypatch):
+    KB = 1024
+    clock = _FakeClock()
+    monkeypatch.setattr(upload_api_v4, "time", clock)
+    limiter = upload_api_v4.BandwidthLimiter(rate=2048 * KB)
+    # Use up the burst so that every chunk waits
+    limiter.acquire(2048 * KB)
+    session = _FakeSession(clock, post_time=0.01)
+    service = upload_api_v4.UploadService(
+        "TEST",
+        "session_key",
+        1024 * KB,
+        session=T.cast(T.Any, session),
+        bandwidth_limiter=limiter,
+    )
+    chunk_upload_times = []
+    service.callbacks.append(
+        lambda chunk, _: chunk_upload_times.append(service.last_chunk_upload_time)
+        if chunk
+        else None
+    )
+    data = os.urandom(1024 * KB)
+    assert (
+        service.upload(io.BytesIO(data), offset=0, chunk_size=512 * KB)
+        == "file_handle"
+    )
+    assert bytes(session.received) == data
+    # Waited for 1024KB at 2048KB/s, less the tokens refilled while the first chunk was posted
+    assert service.throttled_time == pytest.approx(0.5 - 0.01)
+    # The waits for the limiter are not counted as the network time
+    assert chunk_upload_times == [pytest.approx(0.01), pytest.approx(0.01)]
+
+
+def test_upload_rate_limited_chunk_size(monkeypatch):
+    KB = 1024
+    clock = _FakeClock()
+    monkeypatch.setattr(upload_api_v4, "time", clock)
+    limiter = upload_api_v4.BandwidthLimiter(rate=100 * KB)
+    # A fast network (100 MB/s) but the chunks are sent at 100KB/s
+    session = _FakeSession(clock, post_time=0.01)
+    service = upload_api_v4.UploadService(
+        "TEST",
+        "session_key",
+        4096 * KB,
+        session=T.cast(T.Any, session),
+        bandwidth_limiter=limiter,
+    )
+    controller = upload_api_v4.ChunkSizeController(
+        1024 * KB, 64 * KB, 16 * 1024 * KB, target_time=10, max_rate=limiter.rate
+    )
+    # Capped to what can be sent in the target time at the rate
+    assert controller.chunk_size == 1000 * KB
+    chunk_sizes = []
+    service.callbacks.append(lambda chunk, _: chunk_sizes.append(len(chunk)))
+    data = os.urandom(4096 * KB)
+    assert (
+        service.upload(io.BytesIO(data), offset=0, chunk_size_controller=controller)
+        == "file_handle"
+    )
+    assert bytes(session.received) == data
+    assert max(chunk_sizes) == 1000 * KB
+    assert controller.chunk_size == 1000 * KB
+
+
+def test_summarize_throttled_speed():
+    stats = [{"entity_size": 1024 * 1024, "upload_total_time": 2.0}]
+    assert upload._summarize(stats)["speed"] == 0.5
+    stats[0]["throttled_time"] = 1.0
+    assert upload._summarize(stats)["speed"] == 1.0
+    # The throttled time is measured separately and might exceed the upload time
+    for throttled_time in [2.0, 2.5]:
+        stats[0]["throttled_time"] = throttled_time
+        assert upload._summarize(stats)["speed"] == 0
+
+
+def test_bandwidth_limiter_time_windows():
+    limiter = upload_api_v4.BandwidthLimiter(
+        time_windows=upload_api_v4.parse_time_windows("22:00-06:00,12:00-13:30")
+    )
+    day = datetime.datetime(2022, 1, 1)
+    assert limiter.seconds_until_window(day.replace(hour=23)) == 0
+    assert limiter.seconds_until_window(day.replace(hour=5, minute=59)) == 0
+    assert limiter.seconds_until_window(day.replace(hour=12)) == 0
+    assert limiter.seconds_until_window(day.replace(hour=6)) == 6 * 3600
+    assert limiter.seconds_until_window(day.replace(hour=13, minute=30)) == 8.5 * 3600
+    assert upload_api_v4.BandwidthLimiter().seconds_until_window(day) == 0
+
+    with pytest.raises(ValueError):
+        upload_api_v4.parse_time_windows("22:00")
+    with pytest.raises(ValueError):
+        upload_api_v4.parse_time_windows("22:00-25:00")
+
+
+def test_shared_bandwidth_limiter(tmpdir: py.path.local):
+    budget_path = str(tmpdir.join("budget.json"))
+    limiter = upload_api_v4.SharedBandwidthLimiter(budget_path, rate=1024 * 1024)
+    other = upload_api_v4.SharedBandwidthLimiter(budget_path, rate=1024 * 1024)
+    # within the burst
+    assert limiter.reserve(1024 * 1024) == 0
+    # the other process pays the debt
+    assert 0.05 < other.reserve(100 * 1024) <= 0.2
+    budget = json.loads(tmpdir.join("budget.json").read())
+    assert budget["tokens"] < 0
+
+    # a torn budget file is reset
+    tmpdir.join("budget.json").write("{")
+    assert upload_api_v4.SharedBandwidthLimiter(budget_path, rate=1024).reserve(1) == 0
+
+
+def test_shared_bandwidth_limiter_fallback(tmpdir: py.path.local):
+    # not accessible because the parent is a file
+    tmpdir.join("file").write("")
+    limiter = upload_api_v4.SharedBandwidthLimiter(
+        str(tmpdir.join("file", "budget.json")), rate=1024 * 1024
+    )
+    assert limiter.reserve(1024 * 1024) == 0
+    assert 0.05 < limiter.reserve(100 * 1024) <= 0.1
+
+
+def test_session_lock(tmpdir: py.path.local, monkeypatch):
+    monkeypatch.setattr(uploader.constants, "UPLOAD_LOCK_DIR", str(tmpdir))
+    session_lock = uploader._SessionLock("session_key")
+    # held by another process
+    with file_lock.FileLock(str(tmpdir.join("session_key.lock"))):
+        assert not session_lock.acquire(blocking=False)
+        # the thread lock is released too
+        assert session_lock._thread_lock.acquire(blocking=False)
+        session_lock._thread_lock.release()
+    with session_lock:
+        assert not session_lock.acquire(blocking=False)
+        assert not file_lock.FileLock(str(tmpdir.join("session_key.lock"))).acquire(
+            blocking=False
+        )
+    assert not tmpdir.join("session_key.lock").exists()
+
+    monkeypatch.setattr(uploader.constants, "UPLOAD_LOCK_DIR", "")
+    session_lock = uploader._SessionLock("session_key")
+    assert session_lock.acquire(blocking=False)
+    assert not session_lock.acquire(blocking=False)
+    session_lock.release()
+
+
+def test_session_lock_registry(tmpdir: py.path.local, monkeypatch):
+    monkeypatch.setattr(uploader.constants, "UPLOAD_LOCK_DIR", str(tmpdir))
+    lock = uploader._session_lock("session_key")
+    assert uploader._session_lock("session_key") is lock
+    # Dropped once not referenced
+    del lock
+    assert "session_key" not in uploader._SESSION_LOCKS
+
+
+def test_acquire_session_lock_async(tmpdir: py.path.local, monkeypatch):
+    monkeypatch.setattr(uploader.constants, "UPLOAD_LOCK_DIR", str(tmpdir))
+    lock = uploader._session_lock("session_key")
+
+    async def _wait_for_lock():
+        # Held by a session in another thread
+        assert lock.acquire()
+        loop = asyncio.get_event_loop()
+        loop.call_later(0.2, lock.release)
+        await uploader._acquire_session_lock_async(lock)
+        lock.release()
+
+        assert lock.acquire()
+        task = asyncio.ensure_future(uploader._acquire_session_lock_async(lock))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        lock.release()
+        # The cancelled waiter gets the lock and releases it
+        await asyncio.sleep(0.2)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_wait_for_lock())
+    finally:
+        loop.close()
+    assert lock.acquire(blocking=False)
+    lock.release()
+
+
+@pytest.mark.parametrize("upload_engine", ["threads", "asyncio"])
+def test_upload_zip_throttled(
+    tmpdir: py.path.local, setup_upload: py.path.local, upload_engine
+):
+    emitter = uploader.EventEmitter()
+    ends = []
+    emitter.on("upload_end")(ends.append)
+    zip_dir = tmpdir.mkdir("zip_dir")
+    uploader.zip_images(
+        [
+            {
+                "MAPLatitude": 58.5927694,
+                "MAPLongitude": 16.1840944,
+                "MAPCaptureTime": "2021_02_13_13_24_41_140",
+                "filename": "tests/unit/data/test_exif.jpg",
+            }
+        ],
+        str(zip_dir),
+    )
+    zip_path = zip_dir.listdir()[0]
+    zip_size = zip_path.size()
+    mly_uploader = uploader.Uploader(
+        {"user_upload_token": "YOUR_USER_ACCESS_TOKEN"},
+        emitter=emitter,
+        dry_run=True,
+        # the burst is one second worth of bytes, so the zip takes at least 1 second
+        bandwidth_limiter=upload_api_v4.BandwidthLimiter(rate=zip_size / 2),
+        upload_engine=upload_engine,
+    )
+    assert mly_uploader.upload_zipfile(str(zip_path)) is not None
+    assert len(ends) == 1
+    assert 0.5 < ends[0]["throttled_time"]
+
+
+def test_upload_zip_telemetry(tmpdir: py.path.local, setup_upload: py.path.local):
+    emitter = uploader.EventEmitter()
+    upload_telemetry = telemetry.UploadTelemetry()
+    upload._setup_telemetry(emitter, upload_telemetry)
+    test_upload_zip(tmpdir, setup_upload, emitter=emitter)
+    assert upload_telemetry.sessions == 2
+    # The fake upload service fails randomly
+    assert upload_telemetry.retries == upload_telemetry.retry_wait_seconds.count
+    assert (
+        2 <= upload_telemetry.fetch_offset_seconds.count <= 2 + upload_telemetry.retries
+    )
+    # A chunk could be written by the fake service before it fails, so the retry
+    # might find nothing left to upload
+    assert upload_telemetry.chunk_seconds.count == upload_telemetry.chunk_bytes.count
+    assert upload_telemetry.uploaded_bytes == upload_telemetry.chunk_bytes.sum
+    # Partially uploaded bytes are not counted
+    assert upload_telemetry.uploaded_bytes <= sum(
+        zip_path.size() for zip_path in setup_upload.listdir()
+    )
+
+
+def test_chunk_reader(tmpdir: py.path.local):
+    content = os.urandom(1000)
+    path = tmpdir.join("data.bin")
+    path.write_binary(content)
+
+    with open(path, "rb") as fp:
+        fp.seek(100)
+        reader = upload_api_v4.ChunkReader(fp)
+        chunks = []
+        while True:
+            chunk = reader.read(300)
+            if not chunk:
+                break
+            assert isinstance(chunk, memoryview)
+            chunks.append(bytes(chunk))
+        assert chunk == b""
+    assert [len(c) for c in chunks] == [300, 300, 300]
+    assert b"".join(chunks) == content[100:]
+
+    # fall back to read() for streams without readinto()
+    class _Stream:
+        def __init__(self):
+            self._fp = io.BytesIO(content)
+
+        def read(self, size):
+            return self._fp.read(size)
+
+    reader = upload_api_v4.ChunkReader(T.cast(T.IO[bytes], _Stream()))
+    assert reader.read(600) == content[:600]
+    assert reader.read(600) == content[600:]
+    assert reader.read(600) == b""
+
+
+@pytest.mark.parametrize(
+    "compression,compress_type",
+    [
+        ("auto", zipfile.ZIP_STORED),
+        ("stored", zipfile.ZIP_STORED),
+        ("deflated", zipfile.ZIP_DEFLATED),
+    ],
+)
+def test_zip_compression(compression, compress_type):
+    sequence = _sequences()["sequence_0"]
+    zip_contents = []
+    for _ in range(2):
+        with tempfile.TemporaryFile() as fp:
+            uploader._zip_sequence_fp(sequence, fp, compression=compression)
+            fp.seek(0)
+            with zipfile.ZipFile(fp) as ziph:
+                assert [info.compress_type for info in ziph.infolist()] == [
+                    compress_type
+                ]
+            fp.seek(0)
+            zip_contents.append(fp.read())
+    # deterministic
+    assert zip_contents[0] == zip_contents[1]
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_zip_workers(tmpdir: py.path.local, workers):
+    sequence = {}
+    for idx in range(12):
+        filename = str(tmpdir.join(f"image_{idx}.jpg"))
+        py.path.local("tests/unit/data/test_exif.jpg").copy(py.path.local(filename))
+        # Make the image contents (and hence the arcnames) different
+        with open(filename, "ab") as fp:
+            fp.write(bytes([idx]))
+        sequence[filename] = {
+            "MAPLatitude": 58.5927694,
+            "MAPLongitude": 16.1840944,
+            "MAPCaptureTime": f"2021_02_13_13_24_{idx:02d}_140",
+            "filename": filename,
+            "MAPSequenceUUID": "sequence_1",
+        }
+    with tempfile.TemporaryFile() as fp:
+        expected = uploader._zip_sequence_fp(sequence, fp)
+        fp.seek(0)
+        expected_content = fp.read()
+    with tempfile.TemporaryFile() as fp:
+        assert expected == uploader._zip_sequence_fp(sequence, fp, workers=workers)
+        fp.seek(0)
+        assert expected_content == fp.read()
+
+
+def test_zip_compress_type():
+    with open("tests/unit/data/test_exif.jpg", "rb") as fp:
+        jpeg = fp.read()
+    assert uploader._zip_compress_type(jpeg, "auto") == zipfile.ZIP_STORED
+    assert uploader._zip_compress_type(b"II*\x00", "auto") == zipfile.ZIP_DEFLATED
+    assert uploader._zip_compress_type(jpeg, "deflated") == zipfile.ZIP_DEFLATED
+    with pytest.raises(ValueError):
+        uploader._zip_compress_type(jpeg, T.cast(T.Any, "bzip2"))
+
+
 def test_upload_zip(tmpdir: py.path.local, setup_upload: py.path.local, emitter=None):
     same_basename = tmpdir.join("text_exif.jpg")
     py.path.local("tests/unit/data/test_exif.jpg").copy(tmpdir.join("text_exif.jpg"))
@@ -159,7 +1132,10 @@ def test_upload_zip(tmpdir: py.path.local, setup_upload: py.path.local, emitter=
     _validate_zip_dir(setup_upload)
 
 
-def test_upload_blackvue(tmpdir: py.path.local, setup_upload: py.path.local):
+@pytest.mark.parametrize("upload_engine", ["threads", "asyncio"])
+def test_upload_blackvue(
+    tmpdir: py.path.local, setup_upload: py.path.local, upload_engine
+):
     mly_uploader = uploader.Uploader(
         {
             "user_upload_token": "YOUR_USER_ACCESS_TOKEN",
@@ -167,6 +1143,7 @@ def test_upload_blackvue(tmpdir: py.path.local, setup_upload: py.path.local):
             # "MAPOrganizationKey": "3011753992432185",
         },
         dry_run=True,
+        upload_engine=upload_engine,
     )
     blackvue_path = tmpdir.join("blackvue.mp4")
     with open(blackvue_path, "wb") as fp:
@@ -181,6 +1158,100 @@ def test_upload_blackvue(tmpdir: py.path.local, setup_upload: py.path.local):
             assert fp.read() == b"this is a fake video"
 
 
+def test_upload_blackvues_hash_batch(
+    tmpdir: py.path.local, setup_upload: py.path.local, monkeypatch
+):
+    video_paths = []
+    for idx in range(3):
+        video_path = tmpdir.join(f"blackvue_{idx}.mp4")
+        video_path.write_binary(f"this is a fake video {idx}".encode("utf-8"))
+        video_paths.append(str(video_path))
+
+    def _check_blackvue(video_path):
+        if video_path == video_paths[1]:
+            raise exceptions.MapillaryStationaryVideoError("stationary")
+
+    batches = []
+    file_md5sums = upload.hashing.file_md5sums
+
+    def _file_md5sums(paths, max_workers=1):
+        batches.append((list(paths), max_workers))
+        return file_md5sums(paths, max_workers=max_workers)
+
+    monkeypatch.setattr(upload, "_check_blackvue", _check_blackvue)
+    monkeypatch.setattr(upload.hashing, "file_md5sums", _file_md5sums)
+    mly_uploader = uploader.Uploader(
+        {"user_upload_token": "YOUR_USER_ACCESS_TOKEN"},
+        dry_run=True,
+        upload_workers=2,
+        zip_workers=3,
+    )
+    upload._upload_blackvues(mly_uploader, video_paths, [])
+    # Only the checked videos, in one batch with all the hashing workers
+    assert batches == [([video_paths[0], video_paths[2]], 3)]
+    assert len(setup_upload.listdir()) == 2
+
+
+def test_upload_blackvues_hash_error(
+    tmpdir: py.path.local, setup_upload: py.path.local, monkeypatch
+):
+    def _file_md5sums(paths, max_workers=1):
+        raise OSError("unreadable video")
+
+    monkeypatch.setattr(upload.hashing, "file_md5sums", _file_md5sums)
+    mly_uploader = uploader.Uploader(
+        {"user_upload_token": "YOUR_USER_ACCESS_TOKEN"}, dry_run=True
+    )
+    blackvue_path = tmpdir.join("blackvue.mp4")
+    blackvue_path.write_binary(b"this is a fake video")
+    # Unlike the failed checks, the hashing errors fail the upload
+    with pytest.raises(OSError):
+        upload._upload_blackvues(mly_uploader, [str(blackvue_path)], [])
+    assert not setup_upload.listdir()
+
+
+def test_upload_zipfiles_one_event_loop(
+    tmpdir: py.path.local, setup_upload: py.path.local, monkeypatch
+):
+    zip_dir = tmpdir.mkdir("zip_dir")
+    uploader.zip_images(
+        [
+            {
+                "MAPLatitude": 58.5927694 + idx,
+                "MAPLongitude": 16.1840944,
+                "MAPCaptureTime": "2021_02_13_13_24_41_140",
+                "filename": f"tests/unit/data/{filename}",
+                "MAPSequenceUUID": f"sequence_{idx}",
+            }
+            for idx, filename in enumerate(
+                ["test_exif.jpg", "fixed_exif.jpg", "fixed_exif_2.jpg"]
+            )
+        ],
+        str(zip_dir),
+    )
+    loops = []
+    run_async = uploader._run_async
+
+    def _count_run_async(*args, **kwargs):
+        loops.append(1)
+        return run_async(*args, **kwargs)
+
+    monkeypatch.setattr(uploader, "_run_async", _count_run_async)
+    mly_uploader = uploader.Uploader(
+        {"user_upload_token": "YOUR_USER_ACCESS_TOKEN"},
+        dry_run=True,
+        upload_workers=2,
+        upload_engine="asyncio",
+    )
+    upload._upload_zipfiles(
+        mly_uploader, [str(zip_path) for zip_path in zip_dir.listdir()], []
+    )
+    # All sessions are multiplexed on one event loop
+    assert len(loops) == 1
+    assert len(setup_upload.listdir()) == 3
+    _validate_zip_dir(setup_upload)
+
+
 def test_upload_zip_with_emitter(tmpdir: py.path.local, setup_upload: py.path.local):
     emitter = uploader.EventEmitter()
 
@@ -0,0 +1,186 @@
+import io
+import os
+import tempfile
+import typing as T
+import zipfile
+
+import py.path
+import pytest
+
+from mapillary_tools import upload_api_v4, uploader, zip_stream
+
+IMAGES = [
+    "tests/unit/data/test_exif.jpg",
+    "tests/unit/data/fixed_exif.jpg",
+    "tests/unit/data/fixed_exif_2.jpg",
+]
+
+
+@pytest.fixture
+def setup_upload(tmpdir: py.path.local, monkeypatch):
+    upload_dir = tmpdir.mkdir("mapillary_public_uploads")
+    monkeypatch.setenv("MAPILLARY_UPLOAD_PATH", str(upload_dir))
+    return upload_dir
+
+
+def _copy_sequence(
+    tmpdir: py.path.local, filenames: T.List[str], sequence_uuid: str = "sequence_0"
+) -> T.Dict[str, T.Any]:
+    """
+    Copy the images into tmpdir so that the tests can change them.
+    """
+    sequence = {}
+    for idx, filename in enumerate(filenames):
+        image = tmpdir.join(f"image_{idx}.jpg")
+        py.path.local(filename).copy(image)
+        sequence[str(image)] = {
+            "MAPLatitude": 58.5927694,
+            "MAPLongitude": 16.1840944,
+            "MAPCaptureTime": f"2021_02_13_13_24_4{idx}_140",
+            "filename": str(image),
+            "MAPSequenceUUID": sequence_uuid,
+        }
+    return sequence
+
+
+def test_stream_sequence_zip(tmpdir: py.path.local):
+    sequence = _copy_sequence(tmpdir, IMAGES)
+    with tempfile.TemporaryFile() as fp:
+        expected_md5sum = uploader._zip_sequence_fp(sequence, fp)
+        fp.seek(0)
+        expected = fp.read()
+
+    streamed = uploader._stream_sequence_zip(sequence)
+    assert streamed is not None
+    stream, upload_md5sum = streamed
+    assert upload_md5sum == expected_md5sum
+    # The layout keeps the EXIF segments only, and refers to the image data in the files
+    assert stream.seek(0, io.SEEK_END) == len(expected)
+    # resume from an offset
+    stream.seek(1234)
+    reader = upload_api_v4.ChunkReader(stream)
+    assert bytes(reader.read(3000)) == expected[1234:4234]
+    stream.seek(0)
+    assert stream.read() == expected
+    stream.close()
+
+    # not streamable
+    assert uploader._stream_sequence_zip(sequence, compression="deflated") is None
+
+
+def test_stream_sequence_zip_not_streamable(tmpdir: py.path.local, monkeypatch):
+    sequence = _copy_sequence(tmpdir, IMAGES[:1])
+    not_jpeg = tmpdir.join("image_1.jpg")
+    # deflated with the auto compression
+    not_jpeg.write_binary(b"not a JPEG image")
+    sequence[str(not_jpeg)] = {
+        **sequence[str(tmpdir.join("image_0.jpg"))],
+        "MAPCaptureTime": "2021_02_13_13_24_41_140",
+        "filename": str(not_jpeg),
+    }
+    prepared = []
+    prepare_zip_entry = uploader._prepare_zip_entry
+
+    def _count_prepare_zip_entry(desc, compression):
+        prepared.append(desc["filename"])
+        return prepare_zip_entry(desc, compression)
+
+    monkeypatch.setattr(uploader, "_prepare_zip_entry", _count_prepare_zip_entry)
+    # Decided before preparing any entry
+    assert uploader._stream_sequence_zip(sequence) is None
+    assert prepared == []
+    assert uploader._is_streamable(str(tmpdir.join("image_0.jpg")), "auto")
+    assert not uploader._is_streamable(str(tmpdir.join("image_0.jpg")), "deflated")
+
+
+def test_stream_sequence_zip_file_changed(tmpdir: py.path.local):
+    sequence = _copy_sequence(tmpdir, IMAGES[:1])
+    streamed = uploader._stream_sequence_zip(sequence)
+    assert streamed is not None
+    stream, _ = streamed
+    with open(str(tmpdir.join("image_0.jpg")), "ab") as fp:
+        fp.write(b"changed")
+    with pytest.raises(zip_stream.FileChangedError):
+        stream.read()
+
+
+def test_stream_sequence_zip_file_changed_while_reading(
+    tmpdir: py.path.local, monkeypatch
+):
+    sequence = _copy_sequence(tmpdir, IMAGES[:1])
+    prepare_zip_entry = uploader._prepare_zip_entry
+
+    def _prepare_zip_entry_and_change(desc, compression):
+        prepared = prepare_zip_entry(desc, compression)
+        with open(desc["filename"], "ab") as fp:
+            fp.write(b"changed")
+        return prepared
+
+    monkeypatch.setattr(uploader, "_prepare_zip_entry", _prepare_zip_entry_and_change)
+    # Falls back to the temporary zip file
+    assert uploader._stream_sequence_zip(sequence) is None
+
+
+@pytest.mark.parametrize("upload_engine", ["threads", "asyncio"])
+def test_upload_images_without_temp_files(
+    tmpdir: py.path.local, setup_upload: py.path.local, monkeypatch, upload_engine
+):
+    sequences = [
+        _copy_sequence(tmpdir.mkdir(f"sequence_{idx}"), [filename], f"sequence_{idx}")
+        for idx, filename in enumerate(IMAGES)
+    ]
+    descs = [desc for sequence in sequences for desc in sequence.values()]
+    with tempfile.TemporaryDirectory() as expected_dir:
+        for sequence in sequences:
+            uploader.zip_images(list(sequence.values()), expected_dir)
+        expected = sorted(os.listdir(expected_dir))
+
+    def _no_temp_file(*args, **kwargs):
+        raise AssertionError("The streamed zips are not written to temporary files")
+
+    monkeypatch.setattr(uploader.tempfile, "NamedTemporaryFile", _no_temp_file)
+    mly_uploader = uploader.Uploader(
+        {"user_upload_token": "YOUR_USER_ACCESS_TOKEN"},
+        dry_run=True,
+        zip_prefetch=2,
+        upload_engine=upload_engine,
+    )
+    resp = mly_uploader.upload_images(descs)
+    assert set(resp.keys()) == {"sequence_0", "sequence_1", "sequence_2"}
+    # The same zips as the ones built on disk
+    assert sorted(os.path.basename(p) for p in setup_upload.listdir()) == expected
+
+
+@pytest.mark.parametrize("upload_engine", ["threads", "asyncio"])
+def test_upload_images_rebuild_changed_stream(
+    tmpdir: py.path.local, setup_upload: py.path.local, monkeypatch, upload_engine
+):
+    sequence = _copy_sequence(tmpdir, IMAGES[:1])
+    image = tmpdir.join("image_0.jpg")
+    streams = []
+    stream_sequence_zip = uploader._stream_sequence_zip
+
+    def _stream_and_change(sequence, **kwargs):
+        streamed = stream_sequence_zip(sequence, **kwargs)
+        streams.append(streamed)
+        # Changed after its layout is built
+        with open(str(image), "ab") as fp:
+            fp.write(b"changed")
+        return streamed
+
+    monkeypatch.setattr(uploader, "_stream_sequence_zip", _stream_and_change)
+    mly_uploader = uploader.Uploader(
+        {"user_upload_token": "YOUR_USER_ACCESS_TOKEN"},
+        dry_run=True,
+        upload_engine=upload_engine,
+    )
+    assert mly_uploader.zip_stream
+    resp = mly_uploader.upload_images(list(sequence.values()))
+    assert set(resp.keys()) == {"sequence_0"}
+    # Streamed once, then rebuilt in a temporary file with the changed image
+    assert len(streams) == 1 and streams[0] is not None
+    assert streams[0][1] != uploader.sequence_upload_md5sum(sequence)
+    uploaded = setup_upload.listdir()
+    assert len(uploaded) == 1
+    with zipfile.ZipFile(str(uploaded[0])) as ziph:
+        assert ziph.read(ziph.namelist()[0]).endswith(b"changed")